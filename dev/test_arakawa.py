@@ -0,0 +1,199 @@
+#!/usr/bin/python
+# -*- encoding: utf8 -*-
+
+"""
+Regression test of the vectorized Arakawa jacobian (time_stepper._computeADV_uniform),
+computed over the tile interior and rim (time_stepper._computeRHS),
+against the original point by point loop: results must be identical.
+Curvilinear advection and dissipation (_computeADV_curv, _computeDISS_curv) are compared
+with their loops on grids with random metric terms and land points, to round off.
+
+mpirun -n 4 python test_arakawa.py
+"""
+
+import sys
+
+sys.path.append('../')
+from qgsolver.qg import qg_model
+
+import numpy as np
+from petsc4py import PETSc
+
+
+def computeADV_uniform_loop(tstepper, da, grid, Q, PSI, RHS):
+    """ Original loop implementation of time_stepper._computeADV_uniform
+    """
+    local_Q  = da.createLocalVec()
+    local_PSI  = da.createLocalVec()
+    da.globalToLocal(Q, local_Q)
+    da.globalToLocal(PSI, local_PSI)
+    q = da.getVecArray(local_Q)
+    psi = da.getVecArray(local_PSI)
+    dq = da.getVecArray(RHS)
+    #
+    idx, idy = 1./grid.dx, 1./grid.dy
+    (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
+    for k in range(zs, ze):
+        for j in range(ys, ye):
+            for i in range(xs, xe):
+                if (i <= grid.istart or i >= grid.iend or j <= grid.jstart or j >= grid.jend) \
+                        and tstepper.petscBoundaryType != 'periodic':
+                    dq[i, j, k] = 0.
+                else:
+                    J_pp =   ( q[i+1,j,k] - q[i-1,j,k] ) * ( psi[i,j+1,k] - psi[i,j-1,k] ) \
+                           - ( q[i,j+1,k] - q[i,j-1,k] ) * ( psi[i+1,j,k] - psi[i-1,j,k] )
+                    J_pp *= idx*idy*0.25
+                    J_pc =   q[i+1,j,k] * (psi[i+1,j+1,k]-psi[i+1,j-1,k]) \
+                           - q[i-1,j,k] * (psi[i-1,j+1,k]-psi[i-1,j-1,k]) \
+                           - q[i,j+1,k] * (psi[i+1,j+1,k]-psi[i-1,j+1,k]) \
+                           + q[i,j-1,k] * (psi[i+1,j-1,k]-psi[i-1,j-1,k])
+                    J_pc *= idx*idy*0.25
+                    J_cp =   q[i+1,j+1,k] * (psi[i,j+1,k]-psi[i+1,j,k]) \
+                           - q[i-1,j-1,k] * (psi[i-1,j,k]-psi[i,j-1,k]) \
+                           - q[i-1,j+1,k] * (psi[i,j+1,k]-psi[i-1,j,k]) \
+                           + q[i+1,j-1,k] * (psi[i+1,j,k]-psi[i,j-1,k])
+                    J_cp *= idx*idy*0.25
+                    dq[i, j, k] += ( J_pp + J_pc + J_cp )/3.
+
+
+def computeRHS_curv_loop(tstepper, da, grid, Q, PSI, RHS):
+    """ Original loop implementation of time_stepper._computeADV_curv and _computeDISS_curv
+    """
+    local_Q  = da.createLocalVec()
+    local_PSI  = da.createLocalVec()
+    da.globalToLocal(Q, local_Q)
+    da.globalToLocal(PSI, local_PSI)
+    q = da.getVecArray(local_Q)
+    psi = da.getVecArray(local_PSI)
+    dq = da.getVecArray(RHS)
+    D = grid.get_local_D()
+    kdxu, kdyu, kdxv, kdyv = grid._k_dxu, grid._k_dyu, grid._k_dxv, grid._k_dyv
+    kdxt, kdyt, kf, kmask = grid._k_dxt, grid._k_dyt, grid._k_f, grid._k_mask
+    #
+    def jacobian(q, psi, i, j, k):
+        J_pp =   ( q(i+1,j,k) - q(i-1,j,k) ) * ( psi[i,j+1,k] - psi[i,j-1,k] ) \
+               - ( q(i,j+1,k) - q(i,j-1,k) ) * ( psi[i+1,j,k] - psi[i-1,j,k] )
+        J_pp *= 0.25
+        J_pc =   q(i+1,j,k) * (psi[i+1,j+1,k]-psi[i+1,j-1,k]) \
+               - q(i-1,j,k) * (psi[i-1,j+1,k]-psi[i-1,j-1,k]) \
+               - q(i,j+1,k) * (psi[i+1,j+1,k]-psi[i-1,j+1,k]) \
+               + q(i,j-1,k) * (psi[i+1,j-1,k]-psi[i-1,j-1,k])
+        J_pc *= 0.25
+        J_cp =   q(i+1,j+1,k) * (psi[i,j+1,k]-psi[i+1,j,k]) \
+               - q(i-1,j-1,k) * (psi[i-1,j,k]-psi[i,j-1,k]) \
+               - q(i-1,j+1,k) * (psi[i,j+1,k]-psi[i-1,j,k]) \
+               + q(i+1,j-1,k) * (psi[i+1,j,k]-psi[i,j-1,k])
+        J_cp *= 0.25
+        return ( J_pp + J_pc + J_cp )/3. /D[i,j,kdxt]/D[i,j,kdyt]
+    #
+    (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
+    for k in range(zs, ze):
+        for j in range(ys, ye):
+            for i in range(xs, xe):
+                if ((i <= grid.istart or i >= grid.iend or j <= grid.jstart or j >= grid.jend)
+                        and tstepper.petscBoundaryType != 'periodic') or D[i,j,kmask] == 0.:
+                    dq[i, j, k] = 0.
+                else:
+                    dq[i, j, k] += jacobian(lambda i, j, k: q[i,j,k], psi, i, j, k)
+                    dq[i, j, k] += jacobian(lambda i, j, k: D[i,j,kf], psi, i, j, k)
+                    dq[i, j, k] += tstepper.K/D[i,j,kdxt]/D[i,j,kdyt] * (
+                                        (q[i+1,j,k]-q[i,j,k]) * D[i,j,kdyu]/D[i,j,kdxu]
+                                       -(q[i,j,k]-q[i-1,j,k]) * D[i-1,j,kdyu]/D[i-1,j,kdxu]
+                                       +(q[i,j+1,k]-q[i,j,k]) * D[i,j,kdxv]/D[i,j,kdyv]
+                                       -(q[i,j,k]-q[i,j-1,k]) * D[i,j-1,kdxv]/D[i,j-1,kdyv])
+
+
+def fill_random(da, V, seed):
+    """ Fill a vector with random numbers, independently of the tiling
+    """
+    mx, my, mz = da.getSizes()
+    (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
+    v = np.random.RandomState(seed).randn(mx, my, mz)
+    da.getVecArray(V)[xs:xe, ys:ye, zs:ze] = v[xs:xe, ys:ye, zs:ze]
+
+
+def arakawa_test(boundary_types, ncores_x=2, ncores_y=2):
+    """ Compare loop and vectorized jacobians
+    """
+    qg = qg_model(hgrid = {'Nx':32, 'Ny':24}, vgrid = {'Nz':4},
+                  boundary_types=boundary_types,
+                  ncores_x=ncores_x, ncores_y=ncores_y,
+                  dt = 0.5*86400., K = 0., verbose=0)
+    da = qg.da
+    fill_random(da, qg.state.Q, 0)
+    fill_random(da, qg.state.PSI, 1)
+    #
+    RHS_ref = da.createGlobalVec()
+    RHS_ref.set(1.)
+    qg.tstepper._RHS.set(1.)
+    #
+    computeADV_uniform_loop(qg.tstepper, da, qg.grid, qg.state.Q, qg.state.PSI, RHS_ref)
+    # K=0: dissipation does not modify the RHS
+    qg.tstepper._computeRHS(da, qg.grid, qg.state)
+    #
+    RHS_ref.axpy(-1., qg.tstepper._RHS)
+    err = RHS_ref.norm(PETSc.NormType.INFINITY)
+    if qg.rank == 0:
+        print('%s: max |loop - vectorized| = %e' %(str(boundary_types), err))
+    assert err == 0.
+    return qg
+
+
+def set_random_metric(qg, seed):
+    """ Random metric terms and coriolis parameter, random land points
+    """
+    grid, da = qg.grid, qg.da
+    (xs, xe), (ys, ye), _ = da.getRanges()
+    D = grid.da2D.getVecArray(grid.D)
+    rng = np.random.RandomState(seed)
+    for kD in [grid._k_dxt, grid._k_dyt, grid._k_dxu, grid._k_dyu, grid._k_dxv, grid._k_dyv]:
+        D[xs:xe, ys:ye, kD] = grid.dx*(1.+0.3*rng.rand(grid.Nx, grid.Ny)[xs:xe, ys:ye])
+    D[xs:xe, ys:ye, grid._k_f] = qg.state.f0*(1.+0.1*rng.randn(grid.Nx, grid.Ny)[xs:xe, ys:ye])
+    D[xs:xe, ys:ye, grid._k_mask] = rng.rand(grid.Nx, grid.Ny)[xs:xe, ys:ye] > 0.2
+    grid._reset_local_D()
+
+
+def curv_test(boundary_types, ncores_x=2, ncores_y=2):
+    """ Compare loop and vectorized curvilinear advection and dissipation. Results agree
+    to round off only: both jacobians are summed before they are divided by the cell area.
+    Metric terms are then modified, coefficients of the vectorized kernels must be updated.
+    """
+    qg = qg_model(hgrid = {'Nx':32, 'Ny':24}, vgrid = {'Nz':4},
+                  boundary_types=boundary_types, mask=True,
+                  ncores_x=ncores_x, ncores_y=ncores_y,
+                  dt = 0.5*86400., K = 50., verbose=0)
+    da = qg.da
+    qg.tstepper._flag_hgrid_uniform = False
+    fill_random(da, qg.state.Q, 0)
+    fill_random(da, qg.state.PSI, 1)
+    da.getVecArray(qg.state.Q)[...] *= 1.e-5
+    RHS_ref = da.createGlobalVec()
+    #
+    for seed in [2, 3]:
+        set_random_metric(qg, seed)
+        RHS_ref.set(1.)
+        qg.tstepper._RHS.set(1.)
+        computeRHS_curv_loop(qg.tstepper, da, qg.grid, qg.state.Q, qg.state.PSI, RHS_ref)
+        qg.tstepper._computeRHS(da, qg.grid, qg.state)
+        #
+        norm = RHS_ref.norm(PETSc.NormType.INFINITY)
+        RHS_ref.axpy(-1., qg.tstepper._RHS)
+        err = RHS_ref.norm(PETSc.NormType.INFINITY)/norm
+        if qg.rank == 0:
+            print('%s, curvilinear, metric %i: max |loop - vectorized|/max |loop| = %e' \
+                  %(str(boundary_types), seed, err))
+        assert err < 1.e-12
+    return qg
+
+
+def main():
+    arakawa_test({'periodic': True})
+    arakawa_test({})
+    curv_test({'periodic': True})
+    qg = curv_test({})
+    if qg.rank == 0:
+        print('Arakawa jacobian test done')
+
+
+if __name__ == "__main__":
+    main()
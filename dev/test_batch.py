@@ -0,0 +1,130 @@
+#!/usr/bin/python
+# -*- encoding: utf8 -*-
+
+"""
+Batched PV inversion of several PV fields (pvinversion.solve_batch) compared with
+inversions one at a time: solutions, iterations and throughput in fields per second.
+Block Krylov solvers are selected with petsc options (petsc must be built with HPDDM),
+other solvers invert fields one after the other, e.g.:
+
+mpirun -n 4 python test_batch.py
+mpirun -n 4 python test_batch.py 32 -ksp_type hpddm -ksp_hpddm_type bgmres
+"""
+
+import sys
+import time
+
+sys.path.append('../')
+from qgsolver.qg import qg_model
+
+import numpy as np
+from petsc4py import PETSc
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1].isdigit():
+        n = int(sys.argv.pop(1))
+    else:
+        n = 16
+    # closed domain: with periodic lateral and Neumann vertical boundary conditions, the
+    # operator is singular and noisy fields are not in its range
+    qg = qg_model(hgrid = {'Nx':64, 'Ny':64}, vgrid = {'Nz':20},
+                  ncores_x=2, ncores_y=2, verbose=0)
+    qg.pvinv.ksp.setTolerances(rtol=1.e-6, max_it=1000)
+    da = qg.da
+    comm = da.getComm().tompi4py()
+    # PV fields: analytical field with random amplitudes and noise
+    qg.set_q()
+    (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
+    Q = []
+    for j in range(n):
+        rng = np.random.RandomState(j)
+        V = qg.state.Q.copy()
+        q = da.getVecArray(V)
+        q[...] *= rng.rand()
+        q[...] += 1.e-4*np.abs(q[...]).max()*rng.randn(*q[...].shape)
+        Q.append(V)
+    #
+    # one at a time
+    PSI_loop = []
+    niter_loop = 0
+    comm.barrier()
+    t0 = time.time()
+    for j in range(n):
+        qg.state.PSI.set(0.)
+        niter_loop += qg.pvinv.solve(da, qg.grid, qg.state, Q=Q[j], numit=True)
+        assert qg.pvinv.ksp.getConvergedReason() > 0
+        PSI_loop.append(qg.state.PSI.copy())
+    comm.barrier()
+    t_loop = time.time()-t0
+    #
+    # batch, list of vectors, the psi diagnostic is fired for each field
+    PSI = [qg.state.PSI.duplicate() for j in range(n)]
+    for V in PSI:
+        V.set(0.)
+    fired = []
+    qg.pvinv.diagnostics.register('psi', lambda da, grid, psi:
+                                  fired.append(qg.pvinv.ksp.getConvergedReason()))
+    comm.barrier()
+    t0 = time.time()
+    PSI, niter = qg.pvinv.solve_batch(da, qg.grid, qg.state, Q, PSI=PSI, numit=True)
+    comm.barrier()
+    t_batch = time.time()-t0
+    qg.pvinv.diagnostics.remove('psi')
+    assert len(fired) == n and min(fired) > 0
+    if not qg.pvinv.block_solver():
+        # identical solves, iterations are summed over fields
+        assert niter == niter_loop
+    #
+    def max_err(PSI):
+        err = 0.
+        for j in range(n):
+            PSI[j].axpy(-1., PSI_loop[j])
+            err = max(err, PSI[j].norm(PETSc.NormType.INFINITY)
+                           /PSI_loop[j].norm(PETSc.NormType.INFINITY))
+        return err
+    err = max_err(PSI)
+    #
+    # batch, dense matrix
+    B = PETSc.Mat().createDense((Q[0].getSizes(), (PETSc.DECIDE, n)), comm=Q[0].getComm())
+    B.setUp()
+    for j in range(n):
+        Q[j].copy(B.getDenseColumnVec(j, 'w'))
+        B.restoreDenseColumnVec(j, 'w')
+    X = qg.invert_pv_batch(B)
+    assert X.getSize() == B.getSize()
+    #
+    # the initial guess is updated after each field of a batch
+    # fields are nearly proportional, the projection onto previous solutions saves iterations
+    qg_guess = qg_model(hgrid = {'Nx':64, 'Ny':64}, vgrid = {'Nz':20},
+                        ncores_x=2, ncores_y=2, verbose=0, guess='projection')
+    qg_guess.pvinv.ksp.setTolerances(rtol=1.e-6, max_it=1000)
+    for V in PSI:
+        V.set(0.)
+    fired = []
+    qg_guess.pvinv.diagnostics.register('psi', lambda da, grid, psi:
+                                        fired.append(qg_guess.pvinv.ksp.getConvergedReason()))
+    PSI, niter_guess = qg_guess.pvinv.solve_batch(da, qg.grid, qg.state, Q, PSI=PSI,
+                                                  numit=True)
+    assert len(fired) == n and min(fired) > 0
+    assert qg_guess.pvinv._guess.solves == n
+    err_guess = max_err(PSI)
+    #
+    if qg.rank == 0:
+        print('%i fields: one at a time %.1f fields/s (%i iterations),'
+              ' batch %.1f fields/s (%s, %s, %i iterations)' \
+              %(n, n/t_loop, niter_loop, n/t_batch, qg.pvinv.ksp.getType(),
+                'block solver' if qg.pvinv.block_solver() else 'one after the other', niter))
+        print('batch with projected initial guess: %i iterations, %s' \
+              %(niter_guess, qg_guess.pvinv._guess.report()))
+        print('max relative difference of psi %.1e (batch), %.1e (initial guess)' \
+              %(err, err_guess))
+    # solutions agree within the solver tolerance
+    assert err < 1.e-4 and err_guess < 1.e-4
+    assert niter_guess < niter_loop
+    if qg.rank == 0:
+        print('Batch test done')
+
+
+if __name__ == "__main__":
+    main()
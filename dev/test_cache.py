@@ -0,0 +1,94 @@
+#!/usr/bin/python
+# -*- encoding: utf8 -*-
+
+"""
+Check that PV inversion operators and solvers are shared between qg_model objects
+with identical grids (including metric terms and mask values), stratification, boundary
+conditions and tiling (cache=True)
+
+mpirun -n 4 python test_cache.py
+"""
+
+import sys
+import time
+
+sys.path.append('../')
+from qgsolver.qg import qg_model
+from qgsolver.pvinv import pvinversion
+from qgsolver.cache import solvers
+
+import numpy as np
+
+
+def create_model(N2=1.e-3, boundary_types={}, ncores_x=2, ncores_y=2, **kwargs):
+    """ Create a model and returns the setup time
+    """
+    t0 = time.time()
+    qg = qg_model(hgrid = {'Nx':128, 'Ny':96}, vgrid = {'Nz':10},
+                  boundary_types=boundary_types, N2=N2,
+                  ncores_x=ncores_x, ncores_y=ncores_y, verbose=0,
+                  cache=True, **kwargs)
+    return qg, time.time() - t0
+
+
+def main():
+    qg1, t1 = create_model()
+    qg1.set_q()
+    numit1 = qg1.pvinv.solve(qg1.da, qg1.grid, qg1.state, numit=True)
+    #
+    # identical parameters: operator and solver are shared
+    qg2, t2 = create_model()
+    assert qg2.pvinv.L.handle == qg1.pvinv.L.handle
+    assert qg2.pvinv.ksp.handle == qg1.pvinv.ksp.handle
+    assert qg2.pvinv._cache_entry.refcount == 2
+    qg2.set_q()
+    numit2 = qg2.pvinv.solve(qg2.da, qg2.grid, qg2.state, numit=True)
+    assert numit2 == numit1
+    #
+    # different stratification or boundary conditions: new operators
+    qg3, t3 = create_model(N2=2.e-3)
+    qg4, t4 = create_model(boundary_types={'top': 'D'})
+    assert qg3.pvinv.L.handle != qg1.pvinv.L.handle
+    assert qg4.pvinv.L.handle != qg1.pvinv.L.handle
+    assert len(solvers) == 3
+    if qg1.rank == 0:
+        print('setup times: first %.2f s, cached %.2f s, new N2 %.2f s, new bdy_type %.2f s' \
+              %(t1, t2, t3, t4))
+    #
+    # mask modified in-process: shared until it changes, new operator afterwards
+    qg5, t5 = create_model(mask=True)
+    qg6, t6 = create_model(mask=True, flag_pvinv=False)
+    pvinv6 = pvinversion(qg6.da_op, qg6.grid, qg6.bdy_type, sparam=qg6.state._sparam,
+                         verbose=0, cache=True)
+    assert pvinv6.L.handle == qg5.pvinv.L.handle
+    pvinv6.release()
+    (xs, xe), (ys, ye), _ = qg6.da.getRanges()
+    D = qg6.grid.da2D.getVecArray(qg6.grid.D)
+    D[xs:xe, ys:ye, qg6.grid._k_mask] = np.random.RandomState(0).rand(xe-xs, ye-ys) > 0.1
+    qg6.grid._reset_local_D()
+    pvinv6 = pvinversion(qg6.da_op, qg6.grid, qg6.bdy_type, sparam=qg6.state._sparam,
+                         verbose=0, cache=True)
+    assert pvinv6.L.handle != qg5.pvinv.L.handle
+    assert len(solvers) == 5
+    qg5.pvinv.release()
+    pvinv6.release()
+    #
+    # eviction: objects are destroyed once released by all users
+    entry = qg1.pvinv._cache_entry
+    solvers.evict(entry.key)
+    assert len(solvers) == 4 and entry.objects
+    qg1.pvinv.release()
+    assert entry.objects
+    qg2.pvinv.release()
+    assert not entry.objects
+    #
+    qg3.pvinv.release()
+    qg4.pvinv.release()
+    solvers.evict()
+    assert len(solvers) == 0
+    if qg1.rank == 0:
+        print('Cache test done')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/python
+# -*- encoding: utf8 -*-
+
+"""
+Diagnostics hooks of the omega equation solver: intermediate fields of the RHS are handed
+to registered callbacks only
+
+mpirun -n 4 python test_diagnostics.py
+"""
+
+import os
+import sys
+
+sys.path.append('../')
+from qgsolver.qg import qg_model
+from qgsolver.omegainv import omegainv
+from qgsolver.diagnostics import nc_writer
+
+import numpy as np
+from netCDF4 import Dataset
+
+
+def main():
+    qg = qg_model(hgrid = {'Nx':32, 'Ny':24}, vgrid = {'Nz':6},
+                  ncores_x=2, ncores_y=2, verbose=0)
+    da, grid, state = qg.da, qg.grid, qg.state
+    # metric terms, no land
+    grid.set_uniform_metric(da)
+    grid._flag_hgrid_uniform = False
+    (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
+    grid.da2D.getVecArray(grid.D)[xs:xe, ys:ye, grid._k_mask] = 1.
+    grid._reset_local_D()
+    #
+    mx, my, mz = da.getSizes()
+    da.getVecArray(state.PSI)[xs:xe, ys:ye, zs:ze] = \
+        np.random.RandomState(0).randn(mx, my, mz)[xs:xe, ys:ye, zs:ze]
+    W = da.createGlobalVec()
+    W.set(0.)
+    omega = omegainv(qg.da_op, grid, {'bottom': 'D', 'top': 'D'}, state.f0, state.N2)
+    #
+    calls = []
+    def count(da, grid, **fields):
+        calls.append(sorted(fields))
+    # no callbacks
+    omega.set_rhs(qg.da_op, grid, W, state.PSI, None, None, None)
+    assert calls == []
+    # callbacks on u/v and on the rhs
+    omega.diagnostics.register('uv', nc_writer('diag_uv.nc'))
+    omega.diagnostics.register('rhs', count)
+    omega.set_rhs(qg.da_op, grid, W, state.PSI, None, None, None)
+    assert calls == [['rhs']]
+    if qg.rank == 0:
+        nc = Dataset('diag_uv.nc', 'r')
+        assert 'u' in nc.variables and 'v' in nc.variables
+        nc.close()
+        os.remove('diag_uv.nc')
+    # callbacks removed
+    omega.diagnostics.remove('uv')
+    omega.diagnostics.remove('rhs', count)
+    assert not omega.diagnostics
+    omega.set_rhs(qg.da_op, grid, W, state.PSI, None, None, None)
+    assert calls == [['rhs']]
+    qg.comm.barrier()
+    assert not os.path.exists('diag_uv.nc')
+    if qg.rank == 0:
+        print('Diagnostics test done')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/python
+# -*- encoding: utf8 -*-
+
+"""
+Iterations of the PV inversions of the time stepping with initial guesses computed from
+previous solutions (pvinversion guess option, see guess.initial_guess): previous solution,
+polynomial extrapolation in time and projection onto previous solutions (default kind,
+guess=True)
+
+mpirun -n 4 python test_guess.py
+"""
+
+import sys
+
+sys.path.append('../')
+from qgsolver.qg import qg_model
+
+from petsc4py import PETSc
+
+
+def guess_test(guess, nt=10):
+    """ Time step and return iterations statistics and the final streamfunction
+    """
+    qg = qg_model(hgrid = {'Nx':64, 'Ny':64}, vgrid = {'Nz':10},
+                  boundary_types={'periodic': True},
+                  ncores_x=2, ncores_y=2,
+                  dt = 0.5*86400., K = 1.e2, verbose=0, guess=guess)
+    qg.set_q()
+    qg.invert_pv()
+    qg.tstep(nt)
+    g = qg.pvinv._guess
+    if qg.rank == 0:
+        print(g.report())
+    return g.iterations, qg.state.PSI.copy(), qg.rank
+
+
+def main():
+    it_ref, PSI_ref, rank = guess_test('previous')
+    its = {}
+    for kind, guess in [('extrapolation', 'extrapolation'), ('projection', True)]:
+        it, PSI, rank = guess_test(guess)
+        its[kind] = it
+        PSI.axpy(-1., PSI_ref)
+        err = PSI.norm(PETSc.NormType.INFINITY)/PSI_ref.norm(PETSc.NormType.INFINITY)
+        if rank == 0:
+            print('%s: %i iterations saved out of %i, relative difference of psi %.1e' \
+                  %(kind, it_ref-it, it_ref, err))
+        # solutions agree within the solver tolerance
+        assert err < 1.e-2
+        assert it <= it_ref
+    # stages of the time stepping are not equally spaced, extrapolation saves fewer iterations
+    assert its['projection'] < its['extrapolation']
+    if rank == 0:
+        print('Initial guess test done')
+
+
+if __name__ == "__main__":
+    main()
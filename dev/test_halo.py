@@ -0,0 +1,54 @@
+#!/usr/bin/python
+# -*- encoding: utf8 -*-
+
+"""
+Fused halo exchange of Q and PSI (halo.halo_exchange): ghosted arrays must be identical
+to those filled by separate globalToLocal scatters
+
+mpirun -n 4 python test_halo.py
+"""
+
+import sys
+
+sys.path.append('../')
+from qgsolver.qg import qg_model
+from qgsolver.halo import halo_exchange
+
+import numpy as np
+
+
+def halo_test(boundary_types, ncores_x=2, ncores_y=2):
+    """ Compare fused and separate exchanges
+    """
+    qg = qg_model(hgrid = {'Nx':32, 'Ny':24}, vgrid = {'Nz':4},
+                  boundary_types=boundary_types,
+                  ncores_x=ncores_x, ncores_y=ncores_y, verbose=0)
+    da = qg.da
+    (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
+    for seed, V in enumerate([qg.state.Q, qg.state.PSI]):
+        da.getVecArray(V)[...] = np.random.RandomState(seed+qg.rank).randn(xe-xs, ye-ys, ze-zs)
+    #
+    halo = halo_exchange(da, 2)
+    halo.begin(da, qg.state.Q, qg.state.PSI)
+    fields = halo.end()
+    #
+    lV = da.createLocalVec()
+    for V, f in zip([qg.state.Q, qg.state.PSI], fields):
+        da.globalToLocal(V, lV)
+        assert (da.getVecArray(lV)[...] == f).all()
+    lV.destroy()
+    halo.destroy()
+    if qg.rank == 0:
+        print('%s: fused halo exchange ok' %str(boundary_types))
+    return qg
+
+
+def main():
+    halo_test({'periodic': True})
+    qg = halo_test({})
+    if qg.rank == 0:
+        print('Halo exchange test done')
+
+
+if __name__ == "__main__":
+    main()
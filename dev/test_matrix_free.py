@@ -0,0 +1,134 @@
+#!/usr/bin/python
+# -*- encoding: utf8 -*-
+
+"""
+Matrix free PV inversion operator (matrix_free=True, see pvinv.stencil_mat): products and
+diagonal are compared with the assembled operators (_set_L and _set_L_curv, with and without
+land points) and inversions with each preconditioner (mf_pc) with assembled inversions.
+Multigrid (pc='mg') requires mf_pc='assembled'.
+
+mpirun -n 4 python test_matrix_free.py
+"""
+
+import sys
+
+sys.path.append('../')
+from qgsolver.qg import qg_model
+from qgsolver.pvinv import pvinversion
+
+import numpy as np
+from petsc4py import PETSc
+
+
+def fill_random(da, V, seed):
+    """ Fill a vector with random values, independent of the tiling
+    """
+    mx, my, mz = da.getSizes()
+    (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
+    v = np.random.RandomState(seed).randn(mx, my, mz)
+    da.getVecArray(V)[xs:xe, ys:ye, zs:ze] = v[xs:xe, ys:ye, zs:ze]
+
+
+def create_model(curv, mask):
+    """ Model on a uniform grid, or on a grid with random metric terms and possibly land points
+    """
+    qg = qg_model(hgrid = {'Nx':32, 'Ny':24}, vgrid = {'Nz':6}, mask=mask,
+                  ncores_x=2, ncores_y=2, verbose=0, flag_pvinv=False)
+    da, grid = qg.da, qg.grid
+    if curv:
+        grid._create_D(da)
+        grid._flag_hgrid_uniform = False
+        (xs, xe), (ys, ye), _ = da.getRanges()
+        D = grid.da2D.getVecArray(grid.D)
+        for seed, kD in enumerate([grid._k_dxt, grid._k_dyt, grid._k_dxu, grid._k_dyu,
+                                   grid._k_dxv, grid._k_dyv]):
+            D[xs:xe, ys:ye, kD] = grid.dx*(1.+0.3*np.random.RandomState(seed).rand(xe-xs, ye-ys))
+        D[xs:xe, ys:ye, grid._k_mask] = 1.
+        if mask:
+            D[xs:xe, ys:ye, grid._k_mask] = np.random.RandomState(10).rand(xe-xs, ye-ys) > 0.2
+        grid._reset_local_D()
+    return qg
+
+
+def create_pvinv(qg, **kwargs):
+    pvinv = pvinversion(qg.da_op, qg.grid, qg.bdy_type, sparam=qg.state._sparam, verbose=0,
+                        **kwargs)
+    pvinv.ksp.setTolerances(rtol=1.e-10, max_it=2000)
+    return pvinv
+
+
+def matrix_free_test(curv, mask):
+    """ Compare matrix free and assembled operators and inversions
+    """
+    qg = create_model(curv, mask)
+    da = qg.da_op
+    pvinv_ref = create_pvinv(qg)
+    L_ref = pvinv_ref.L
+    #
+    # products and diagonal
+    X, Y, Y_ref = [da.createGlobalVec() for _ in range(3)]
+    fill_random(da, X, 0)
+    pvinv = create_pvinv(qg, matrix_free=True)
+    assert pvinv.L.getType() == PETSc.Mat.Type.PYTHON
+    pvinv.L.mult(X, Y)
+    L_ref.mult(X, Y_ref)
+    Y.axpy(-1., Y_ref)
+    err_mult = Y.norm(PETSc.NormType.INFINITY)/Y_ref.norm(PETSc.NormType.INFINITY)
+    d, d_ref = pvinv.L.getDiagonal(), L_ref.getDiagonal()
+    d.axpy(-1., d_ref)
+    err_diag = d.norm(PETSc.NormType.INFINITY)/d_ref.norm(PETSc.NormType.INFINITY)
+    if qg.rank == 0:
+        print('curvilinear=%s, mask=%s: |Lx - L_ref x| %.1e, |diag(L) - diag(L_ref)| %.1e' \
+              %(curv, mask, err_mult, err_diag))
+    assert err_mult < 1.e-13 and err_diag < 1.e-13
+    pvinv.release()
+    pvinv_ref.release()
+    #
+    # inversions compared with assembled inversions with the same preconditioner
+    # psi on boundaries and land is zero
+    fill_random(da, qg.state.Q, 1)
+    for mf_pc, pc in [('jacobi', 'jacobi'), ('assembled', None), ('none', 'none')]:
+        pvinv_ref = create_pvinv(qg, pc=pc)
+        qg.state.PSI.set(0.)
+        niter_ref = pvinv_ref.solve(da, qg.grid, qg.state, numit=True)
+        PSI_ref = qg.state.PSI.copy()
+        pvinv = create_pvinv(qg, matrix_free=True, mf_pc=mf_pc)
+        qg.state.PSI.set(0.)
+        niter = pvinv.solve(da, qg.grid, qg.state, numit=True)
+        qg.state.PSI.axpy(-1., PSI_ref)
+        err = qg.state.PSI.norm(PETSc.NormType.INFINITY)/PSI_ref.norm(PETSc.NormType.INFINITY)
+        reason, reason_ref = pvinv.ksp.getConvergedReason(), pvinv_ref.ksp.getConvergedReason()
+        if qg.rank == 0:
+            print('  mf_pc=%s: %i iterations (assembled %i), converged reason %i (assembled %i),'
+                  ' relative difference of psi %.1e' \
+                  %(mf_pc, niter, niter_ref, reason, reason_ref, err))
+        assert reason == reason_ref
+        if reason > 0:
+            assert err < 1.e-6
+        else:
+            # without preconditioner, gmres breaks down on the badly scaled operator (identity
+            # rows on boundaries, 1/dx**2 inside): both solves stop at the same iteration
+            assert mf_pc == 'none' and niter == niter_ref
+        pvinv.release()
+        pvinv_ref.release()
+    # multigrid smoothers use the assembled operator (coarse grids do not resolve random land)
+    if not mask:
+        pvinv = create_pvinv(qg, matrix_free=True, mf_pc='assembled', pc='mg')
+        qg.state.PSI.set(0.)
+        niter = pvinv.solve(da, qg.grid, qg.state, numit=True)
+        if qg.rank == 0:
+            print('  mf_pc=assembled, pc=mg: %i iterations' %niter)
+        assert pvinv.ksp.getConvergedReason() > 0
+        pvinv.release()
+    return qg
+
+
+def main():
+    for curv, mask in [(False, False), (True, False), (True, True)]:
+        qg = matrix_free_test(curv, mask)
+    if qg.rank == 0:
+        print('Matrix free test done')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+#!/usr/bin/python
+# -*- encoding: utf8 -*-
+
+"""
+Check that memory stays flat over thousands of time steps
+(no per call allocation of work vectors in the time stepper)
+
+mpirun -n 4 python test_memory.py
+"""
+
+import sys
+import os
+
+sys.path.append('../')
+from qgsolver.qg import qg_model
+
+
+def get_rss():
+    """ Current resident memory in MB
+    """
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/1.e6
+
+
+def memory_test(nt=2000, nchunks=10, ncores_x=2, ncores_y=2):
+    """ Time step by chunks and monitor memory
+    """
+    qg = qg_model(hgrid = {'Nx':32, 'Ny':32}, vgrid = {'Nz':4},
+                  K = 1.e2, dt = 0.1*86400.e0,
+                  ncores_x=ncores_x, ncores_y=ncores_y, verbose=0)
+    qg.set_q()
+    qg.invert_pv()
+    bstate = qg.set_bstate(psi0=0., q0=0., beta=1.e-11)
+    #
+    rss = []
+    for c in range(nchunks):
+        qg.tstep(nt//nchunks, bstate=bstate)
+        rss.append(get_rss())
+        if qg.rank == 0:
+            print('step %i: rss = %.1f MB' %((c+1)*nt//nchunks, rss[-1]))
+    # the first chunk includes setup allocations (solver, numpy)
+    growth = rss[-1] - rss[1]
+    if qg.rank == 0:
+        print('memory growth over %i steps: %.2f MB' %(nt - nt//nchunks, growth))
+    assert growth < 1.
+    return qg
+
+
+def main():
+    qg = memory_test()
+    if qg.rank == 0:
+        print('Memory test done')
+
+
+if __name__ == "__main__":
+    main()
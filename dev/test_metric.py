@@ -0,0 +1,44 @@
+#!/usr/bin/python
+# -*- encoding: utf8 -*-
+
+"""
+Storage of metric terms in the 2D DMDA of the grid (grid.da2D, grid.D): tiles and ghost
+ranges are aligned with the 3D DMDA, memory is compared to that of a 3D vector
+
+mpirun -n 4 python test_metric.py
+"""
+
+import sys
+
+sys.path.append('../')
+from qgsolver.qg import qg_model
+
+
+def main():
+    qg = qg_model(hgrid = {'Nx':64, 'Ny':48}, vgrid = {'Nz':30}, mask=True,
+                  ncores_x=2, ncores_y=2, verbose=0)
+    grid, da = qg.grid, qg.da
+    #
+    # tiles and ghost ranges along x and y match
+    assert grid.da2D.getRanges() == da.getRanges()[:2]
+    assert grid.da2D.getGhostRanges() == da.getGhostRanges()[:2]
+    #
+    # mask is set to 1 without mask file, also over ghost points
+    D = grid.get_local_D()
+    (gxs, gxe), (gys, gye) = grid.da2D.getGhostRanges()
+    assert D[...].shape == (gxe-gxs, gye-gys, 10)
+    assert (D[gxs:gxe, gys:gye, grid._k_mask] == 1.).all()
+    # ghosted vector is cached
+    lD = grid._lD
+    grid.get_local_D()
+    assert grid._lD is lD
+    #
+    size2D, size3D = grid.D.getSize(), qg.state.Q.getSize()
+    if qg.rank == 0:
+        print('metric terms: %i values, %i values for a 3D vector (ratio %.1f)' \
+              %(size2D, size3D, float(size3D)/size2D))
+        print('Metric test done')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/python
+# -*- encoding: utf8 -*-
+
+"""
+Iteration counts of the PV inversion with the default preconditioner and with
+geometric multigrid (pc='mg') for increasing horizontal resolutions
+
+mpirun -n 4 python test_mg.py
+"""
+
+import sys
+
+sys.path.append('../')
+from qgsolver.qg import qg_model
+
+from petsc4py import PETSc
+
+
+def inversion_numit(N, boundary_types, ncores_x=2, ncores_y=2, **kwargs):
+    """ Number of iterations of an inversion of the analytical PV distribution
+    """
+    qg = qg_model(hgrid = {'Nx':N, 'Ny':N}, vgrid = {'Nz':5},
+                  boundary_types=boundary_types,
+                  ncores_x=ncores_x, ncores_y=ncores_y, verbose=0, **kwargs)
+    qg.pvinv.ksp.setTolerances(rtol=1e-8, max_it=1000)
+    qg.set_q()
+    qg.state.PSI.set(0.)
+    numit = qg.pvinv.solve(qg.da, qg.grid, qg.state, numit=True)
+    return qg, numit
+
+
+def mg_test(boundary_types, sizes, ncores):
+    """ Print iteration counts, multigrid counts should not grow with resolution
+    """
+    numits = []
+    for N in sizes:
+        qg, numit_ref = inversion_numit(N, boundary_types, ncores_x=ncores, ncores_y=ncores)
+        qg, numit_mg = inversion_numit(N, boundary_types, ncores_x=ncores, ncores_y=ncores,
+                                       pc='mg')
+        numits.append(numit_mg)
+        if qg.rank == 0:
+            print('%s N=%i: default %i iterations, mg %i iterations' \
+                  %(str(boundary_types), N, numit_ref, numit_mg))
+    assert max(numits) <= 2*min(numits)
+    return qg
+
+
+def main():
+    ncores = int(round(PETSc.COMM_WORLD.getSize()**0.5))
+    mg_test({}, [64, 128, 256], ncores)
+    qg = mg_test({'periodic': True}, [64, 128, 256], ncores)
+    if qg.rank == 0:
+        print('Multigrid test done')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/python
+# -*- encoding: utf8 -*-
+
+"""
+Diagnosis of the vertical velocity of all time records of a streamfunction file
+(qg_model.invert_omega_records): each inversion starts from the previous w, the next record
+is read while the current one is inverted and w is written to one output file.
+Results are compared with inversions of records read one at a time, and memory must stay
+flat over records.
+
+mpirun -n 4 python test_omega_records.py
+"""
+
+import os
+import sys
+import time
+
+sys.path.append('../')
+from qgsolver.qg import qg_model
+from qgsolver.omegainv import omegainv
+from qgsolver.inout import write_nc, read_nc_petsc
+
+import numpy as np
+from petsc4py import PETSc
+
+
+def get_rss():
+    """ Current resident memory in MB
+    """
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/1.e6
+
+
+def main():
+    nt = 10
+    qg = qg_model(hgrid = {'Nx':64, 'Ny':64}, vgrid = {'Nz':10},
+                  ncores_x=2, ncores_y=2, verbose=0, flag_pvinv=False)
+    da, grid = qg.da, qg.grid
+    # metric terms, no land
+    grid.set_uniform_metric(da)
+    grid._flag_hgrid_uniform = False
+    (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
+    grid.da2D.getVecArray(grid.D)[xs:xe, ys:ye, grid._k_mask] = 1.
+    grid._reset_local_D()
+    qg.omegainv = omegainv(qg.da_op, grid, {'bottom': 'D', 'top': 'D'}, qg.state.f0,
+                           qg.state.N2)
+    #
+    # streamfunction records of a drifting eddy field
+    mx, my, mz = da.getSizes()
+    i, j, k = np.meshgrid(np.arange(xs, xe), np.arange(ys, ye), np.arange(zs, ze), indexing='ij')
+    for it in range(nt):
+        da.getVecArray(qg.state.PSI)[...] = 1.e3 * np.sin(2.*np.pi*(i+0.5*it)/mx) \
+                                            * np.sin(3.*np.pi*j/my) * np.cos(np.pi*k/mz)
+        write_nc([qg.state.PSI], ['psi'], 'records_psi.nc', da, grid, append=(it>0))
+    #
+    comm = da.getComm().tompi4py()
+    comm.barrier()
+    t0 = time.time()
+    qg.invert_omega_records('records_psi.nc', output_file='records_w.nc')
+    comm.barrier()
+    t_records = time.time()-t0
+    # further passes must not allocate, the second one completes setup allocations (netcdf)
+    qg.invert_omega_records('records_psi.nc', output_file='records_w.nc')
+    rss = get_rss()
+    for n in range(3):
+        qg.invert_omega_records('records_psi.nc', output_file='records_w.nc')
+    growth = comm.allreduce(get_rss() - rss, op=max)
+    #
+    # records one at a time, zero initial guess
+    W = qg.state.W.duplicate()
+    err = 0.
+    for it in range(nt):
+        read_nc_petsc(qg.state.PSI, 'psi', 'records_psi.nc', da, grid, it=it)
+        qg.state.W.set(0.)
+        qg.invert_omega()
+        read_nc_petsc(W, 'w', 'records_w.nc', da, grid, it=it)
+        W.axpy(-1., qg.state.W)
+        err = max(err, W.norm(PETSc.NormType.INFINITY)
+                       /qg.state.W.norm(PETSc.NormType.INFINITY))
+    if qg.rank == 0:
+        print('%i records diagnosed in %.2f s, max relative difference of w %.1e,'
+              ' memory growth over %i records %.2f MB' %(nt, t_records, err, 3*nt, growth))
+        os.remove('records_psi.nc')
+        os.remove('records_w.nc')
+    # solutions agree within the solver tolerance
+    assert err < 1.e-2
+    assert growth < 1.
+    if qg.rank == 0:
+        print('Omega records test done')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/python
+# -*- encoding: utf8 -*-
+
+"""
+Regression test of the vectorized omega equation RHS (omegainv.set_uv_from_psi,
+set_rho_from_psi, set_Q and compute_divQ) against the original point by point loops:
+results must be identical. Loops need corner ghost points and are computed on a box stencil DMDA,
+the vectorized RHS is computed on box and star stencil DMDAs.
+
+mpirun -n 4 python test_omega_rhs.py
+"""
+
+import sys
+import time
+
+sys.path.append('../')
+from qgsolver.qg import qg_model
+from qgsolver.omegainv import omegainv
+from qgsolver.utils import g, rho0
+
+import numpy as np
+from petsc4py import PETSc
+
+
+def rhs_loop(omega, da, grid, PSI):
+    """ Original loop implementation of the omega equation RHS, returns U, V, RHO, QXU, QYV, RHS
+    """
+    f0 = omega.f0
+    mx, my, mz = da.getSizes()
+    (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
+    D = grid.get_local_D()
+    kdxu, kdyu, kdxv, kdyv = grid._k_dxu, grid._k_dyu, grid._k_dxv, grid._k_dyv
+    kdxt, kdyt = grid._k_dxt, grid._k_dyt
+    #
+    U, V, RHO, QXU, QYV, RHS = [da.createGlobalVec() for _ in range(6)]
+    local_PSI, local_U, local_V, local_RHO, local_QXU, local_QYV = \
+        [da.createLocalVec() for _ in range(6)]
+    # set u=-dpsidy and v=dpsidx
+    da.globalToLocal(PSI, local_PSI)
+    u, v, psi = da.getVecArray(U), da.getVecArray(V), da.getVecArray(local_PSI)
+    for k in range(zs,ze):
+        for j in range(ys, ye):
+            for i in range(xs, xe):
+                if (i==0 or j==0 or i==mx-1 or j==my-1):
+                    u[i, j, k] = 0.
+                    v[i, j, k] = 0.
+                else:
+                    u[i,j,k] = - 1. /D[i,j,kdyu] * \
+                         ( 0.25*(psi[i+1,j,k]+psi[i+1,j+1,k]+psi[i,j+1,k]+psi[i,j,k]) -
+                           0.25*(psi[i+1,j-1,k]+psi[i+1,j,k]+psi[i,j,k]+psi[i,j-1,k]) )
+                    v[i,j,k] =   1. /D[i,j,kdxv] * \
+                         ( 0.25*(psi[i+1,j,k]+psi[i+1,j+1,k]+psi[i,j+1,k]+psi[i,j,k]) -
+                           0.25*(psi[i,j,k]+psi[i,j+1,k]+psi[i-1,j+1,k]+psi[i-1,j,k]) )
+    # set rho=-rho0*f0/g dpsidz
+    rho = da.getVecArray(RHO)
+    for k in range(zs,ze):
+        for j in range(ys, ye):
+            for i in range(xs, xe):
+                if (k==0 or k==mz-1):
+                    rho[i, j, k] = 0.
+                else:
+                    rho[i,j,k] = - rho0*f0/g/grid.dzt[k] * \
+                                    ( 0.5*(psi[i,j,k+1]+psi[i,j,k]) -
+                                    0.5*(psi[i,j,k]+psi[i,j,k-1]) )
+    # Q vector
+    da.globalToLocal(U, local_U)
+    da.globalToLocal(V, local_V)
+    da.globalToLocal(RHO, local_RHO)
+    u, v, rho = da.getVecArray(local_U), da.getVecArray(local_V), da.getVecArray(local_RHO)
+    qxu, qyv = da.getVecArray(QXU), da.getVecArray(QYV)
+    for k in range(zs,ze):
+        for j in range(ys, ye):
+            for i in range(xs, xe):
+                if (i==0 or j==0 or i==mx-1 or j==my-1 ):
+                    qxu[i, j, k] = 0.
+                    qyv[i, j, k] = 0.
+                else:
+                    qxu[i,j,k] = g/f0/rho0 * (
+                          (0.5*(u[i+1,j,k]+u[i,j,k])-0.5*(u[i,j,k]+u[i-1,j,k]))/D[i,j,kdxu] *
+                          (rho[i+1,j,k]-rho[i,j,k])/D[i,j,kdxu] +
+                          (0.5*(v[i+1,j,k]+v[i+1,j-1,k])-0.5*(v[i,j,k]+v[i,j-1,k]))/D[i,j,kdxu] *
+                          (0.25*(rho[i+1,j,k]+rho[i+1,j+1,k]+rho[i,j+1,k]+rho[i,j,k]) -
+                           0.25*(rho[i+1,j-1,k]+rho[i+1,j,k]+rho[i,j,k]+rho[i,j-1,k]) )/D[i,j,kdyu])
+                    qyv[i,j,k] = g/f0/rho0 * (
+                          (0.5*(u[i,j+1,k]+u[i-1,j+1,k])-0.5*(u[i,j,k]+u[i-1,j,k]))/D[i,j,kdyv] *
+                          (0.25*(rho[i+1,j,k]+rho[i+1,j+1,k]+rho[i,j+1,k]+rho[i,j,k]) -
+                           0.25*(rho[i,j,k]+rho[i,j+1,k]+rho[i-1,j+1,k]+rho[i-1,j,k]))/D[i,j,kdxv] +
+                          (0.5*(v[i,j,k]+v[i,j+1,k]) - 0.5*(v[i,j,k]+v[i,j-1,k]))/D[i,j,kdyv] *
+                          (rho[i,j+1,k]-rho[i,j,k])/D[i,j,kdyv] )
+    # Q vector divergence
+    da.globalToLocal(QXU, local_QXU)
+    da.globalToLocal(QYV, local_QYV)
+    qxu, qyv = da.getVecArray(local_QXU), da.getVecArray(local_QYV)
+    rhs = da.getVecArray(RHS)
+    for k in range(zs,ze):
+        for j in range(ys, ye):
+            for i in range(xs, xe):
+                if (i==0 or j==0 or i==mx-1 or j==my-1 or k==0 or k==mz-1 ):
+                    rhs[i, j, k] = 0.
+                else:
+                    qxi = 0.5*(qxu[i,j,k+1]+qxu[i,j,k])
+                    qxim = 0.5*(qxu[i-1,j,k+1]+qxu[i-1,j,k])
+                    qyj = 0.5*(qyv[i,j,k+1]+qyv[i,j,k])
+                    qyjm = 0.5*(qyv[i,j-1,k+1]+qyv[i,j-1,k])
+                    rhs[i,j,k] = 2.*f0 / D[i,j,kdxt] / D[i,j,kdyt] * (
+                                 (D[i,j,kdyu]*qxi - D[i-1,j,kdyu]*qxim) +
+                                 (D[i,j,kdxv]*qyj - D[i,j-1,kdxv]*qyjm) )
+    for L in [local_PSI, local_U, local_V, local_RHO, local_QXU, local_QYV]:
+        L.destroy()
+    return U, V, RHO, QXU, QYV, RHS
+
+
+def rhs_vec(omega, da, grid, PSI):
+    """ Vectorized omega equation RHS
+    """
+    omega.set_uv_from_psi(da, grid, PSI)
+    omega.set_rho_from_psi(da, grid, PSI)
+    omega.set_Q(da, grid)
+    omega.compute_divQ(da, grid)
+    return omega._U, omega._V, omega._RHO, omega._QXU, omega._QYV, omega._RHS
+
+
+def omega_rhs_test(stencil_type):
+    """ Compare loop and vectorized RHS on a grid with random metric terms, the vectorized
+    RHS is computed on a DMDA with stencil_type
+    """
+    qg = qg_model(hgrid = {'Nx':32, 'Ny':24}, vgrid = {'Nz':6},
+                  ncores_x=2, ncores_y=2, verbose=0)
+    da, grid, state = qg.da, qg.grid, qg.state
+    (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
+    grid.set_uniform_metric(da)
+    D = grid.da2D.getVecArray(grid.D)
+    for seed, k in enumerate([grid._k_dxt, grid._k_dyt, grid._k_dxu, grid._k_dyu,
+                              grid._k_dxv, grid._k_dyv]):
+        D[xs:xe, ys:ye, k] *= 1.+0.1*np.random.RandomState(seed).rand(xe-xs, ye-ys)
+    grid._reset_local_D()
+    grid._flag_hgrid_uniform = False
+    #
+    PSI = da.createGlobalVec()
+    mx, my, mz = da.getSizes()
+    da.getVecArray(PSI)[xs:xe, ys:ye, zs:ze] = \
+        np.random.RandomState(10).randn(mx, my, mz)[xs:xe, ys:ye, zs:ze]
+    omega = omegainv(da, grid, qg.bdy_type, state.f0, state.N2)
+    #
+    da.getComm().barrier()
+    t0 = time.time()
+    ref = rhs_loop(omega, da, grid, PSI)
+    t_loop = time.time()-t0
+    da_vec = da.duplicate(stencil_type=stencil_type)
+    omega = omegainv(da_vec, grid, qg.bdy_type, state.f0, state.N2)
+    t0 = time.time()
+    vec = rhs_vec(omega, da_vec, grid, PSI)
+    t_vec = time.time()-t0
+    err = 0.
+    for V_ref, V in zip(ref, vec):
+        V_ref.axpy(-1., V)
+        err = max(err, V_ref.norm(PETSc.NormType.INFINITY))
+    if qg.rank == 0:
+        print('%s stencil: loops %.3f s, vectorized %.3f s, max |loop - vectorized| = %e' \
+              %(stencil_type, t_loop, t_vec, err))
+    assert err == 0.
+    return qg
+
+
+def main():
+    for stencil_type in ['box', 'star']:
+        qg = omega_rhs_test(stencil_type)
+    if qg.rank == 0:
+        print('Omega RHS test done')
+
+
+if __name__ == "__main__":
+    main()
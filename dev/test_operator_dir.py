@@ -0,0 +1,96 @@
+#!/usr/bin/python
+# -*- encoding: utf8 -*-
+
+"""
+Check that the PV inversion operator stored on disk (operator_dir) is loaded when inputs
+are unchanged, reassembled otherwise (including a mask modified in-process), and identical
+to the assembled operator
+
+mpirun -n 4 python test_operator_dir.py
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.append('../')
+from qgsolver.qg import qg_model
+from qgsolver.pvinv import pvinversion
+
+import numpy as np
+from petsc4py import PETSc
+
+
+def create_model(operator_dir, N2=1.e-3, ncores_x=2, ncores_y=2, **kwargs):
+    """ Create a model and returns the setup time
+    """
+    t0 = time.time()
+    qg = qg_model(hgrid = {'Nx':128, 'Ny':96}, vgrid = {'Nz':20}, N2=N2,
+                  ncores_x=ncores_x, ncores_y=ncores_y, verbose=0,
+                  operator_dir=operator_dir, **kwargs)
+    return qg, time.time() - t0
+
+
+def main():
+    rank = PETSc.COMM_WORLD.getRank()
+    operator_dir = tempfile.mkdtemp() if rank == 0 else None
+    operator_dir = PETSc.COMM_WORLD.tompi4py().bcast(operator_dir, root=0)
+    filename = os.path.join(operator_dir, 'pvinv_L')
+    #
+    # first run: assembled and stored
+    qg1, t1 = create_model(operator_dir)
+    assert os.path.isfile(filename+'.dat') and os.path.isfile(filename+'.hash')
+    mtime = os.stat(filename+'.dat').st_mtime
+    #
+    # second run: loaded
+    qg2, t2 = create_model(operator_dir)
+    assert os.stat(filename+'.dat').st_mtime == mtime
+    L = qg2.pvinv.L.copy()
+    L.axpy(-1., qg1.pvinv.L, structure=PETSc.Mat.Structure.DIFFERENT_NONZERO_PATTERN)
+    err = L.norm(PETSc.NormType.FROBENIUS)
+    assert err == 0.
+    #
+    # different stratification: assembled and stored again
+    with open(filename+'.hash') as f:
+        hash = f.read()
+    qg3, t3 = create_model(operator_dir, N2=2.e-3)
+    with open(filename+'.hash') as f:
+        assert f.read() != hash
+    #
+    # mask modified after the operator is stored: assembled again, not loaded
+    # (operator of curvilinear grids, the only one with land points)
+    qg4, t4 = create_model(None, mask=True, flag_pvinv=False)
+    qg4.grid.set_uniform_metric(qg4.da)
+    qg4.grid._flag_hgrid_uniform = False
+    pvinv_args = (qg4.da_op, qg4.grid, qg4.bdy_type)
+    pvinv_kwargs = {'sparam': qg4.state._sparam, 'verbose': 0}
+    pvinvs = [pvinversion(*pvinv_args, operator_dir=operator_dir, **pvinv_kwargs)]
+    with open(filename+'.hash') as f:
+        hash = f.read()
+    (xs, xe), (ys, ye), _ = qg4.da.getRanges()
+    D = qg4.grid.da2D.getVecArray(qg4.grid.D)
+    D[xs:xe, ys:ye, qg4.grid._k_mask] = np.random.RandomState(0).rand(xe-xs, ye-ys) > 0.1
+    qg4.grid._reset_local_D()
+    pvinvs.append(pvinversion(*pvinv_args, operator_dir=operator_dir, **pvinv_kwargs))
+    with open(filename+'.hash') as f:
+        assert f.read() != hash
+    # reference without storage
+    pvinvs.append(pvinversion(*pvinv_args, **pvinv_kwargs))
+    errs = []
+    for pvinv in pvinvs[:2]:
+        L = pvinv.L.copy()
+        L.axpy(-1., pvinvs[2].L, structure=PETSc.Mat.Structure.DIFFERENT_NONZERO_PATTERN)
+        errs.append(L.norm(PETSc.NormType.FROBENIUS))
+    assert errs[0] > 0. and errs[1] == 0.
+    #
+    if rank == 0:
+        print('|L_loaded - L| = %e' %err)
+        print('setup times: assembled %.2f s, loaded %.2f s, new N2 %.2f s' %(t1, t2, t3))
+        shutil.rmtree(operator_dir)
+        print('Operator storage test done')
+
+
+if __name__ == "__main__":
+    main()
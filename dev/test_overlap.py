@@ -0,0 +1,84 @@
+#!/usr/bin/python
+# -*- encoding: utf8 -*-
+
+"""
+Timing of the RK stage RHS with the halo exchange overlapped with the computation over
+the tile interior (time_stepper._computeRHS) and with the exchange completed first,
+64x64 points per tile by default. The RHS must not depend on a background state used
+by a previous time stepping.
+
+mpirun -n 4 python test_overlap.py
+mpirun -n 16 python test_overlap.py 64 64 50 4 4
+"""
+
+import sys
+import time
+
+sys.path.append('../')
+from qgsolver.qg import qg_model
+
+from petsc4py import PETSc
+
+
+def timing(func, n=20):
+    """ Average time of func over processes
+    """
+    comm = PETSc.COMM_WORLD.tompi4py()
+    comm.barrier()
+    t0 = time.time()
+    for i in range(n):
+        func()
+    comm.barrier()
+    return (time.time()-t0)/n
+
+
+def main():
+    if len(sys.argv) > 1:
+        nx, ny, Nz, ncores_x, ncores_y = [int(a) for a in sys.argv[1:6]]
+    else:
+        nx, ny, Nz, ncores_x, ncores_y = 64, 64, 50, 2, 2
+    qg = qg_model(hgrid = {'Nx':nx*ncores_x, 'Ny':ny*ncores_y}, vgrid = {'Nz':Nz},
+                  boundary_types={'periodic': True},
+                  ncores_x=ncores_x, ncores_y=ncores_y,
+                  dt = 0.5*86400., K = 1.e2, verbose=0)
+    da, grid, ts = qg.da, qg.grid, qg.tstepper
+    qg.set_q()
+    qg.invert_pv()
+    #
+    def sequential():
+        # exchange completed first, then whole block
+        q, psi = ts._halo.exchange(da, qg.state.Q, qg.state.PSI)
+        gsl, lsl = ts._get_tile_slices(da, grid)
+        ts._computeRHS_block(da, grid, (gsl, lsl, gsl[:2], True), q, psi)
+    #
+    ts._RHS.set(0.)
+    sequential()
+    RHS_ref = ts._RHS.copy()
+    ts._RHS.set(0.)
+    ts._computeRHS(da, grid, qg.state)
+    RHS_ref.axpy(-1., ts._RHS)
+    assert RHS_ref.norm(PETSc.NormType.INFINITY) == 0.
+    #
+    # time stepping with a background state, then without
+    bstate = qg.set_bstate(psi0=0., q0=0., beta=1.e-11)
+    qg.tstep(1, rho_sb=False, bstate=bstate)
+    qg.tstep(1, rho_sb=False)
+    ts._RHS.set(0.)
+    sequential()
+    RHS_ref = ts._RHS.copy()
+    ts._RHS.set(0.)
+    ts._computeRHS(da, grid, qg.state)
+    RHS_ref.axpy(-1., ts._RHS)
+    assert RHS_ref.norm(PETSc.NormType.INFINITY) == 0.
+    #
+    t_exchange = timing(lambda: ts._halo.exchange(da, qg.state.Q, qg.state.PSI))
+    t_sequential = timing(sequential)
+    t_overlap = timing(lambda: ts._computeRHS(da, grid, qg.state))
+    if qg.rank == 0:
+        print('tile %ix%ix%i: exchange %.2e s, sequential RHS %.2e s, overlapped RHS %.2e s' \
+              %(nx, ny, Nz, t_exchange, t_sequential, t_overlap))
+        print('Overlap test done')
+
+
+if __name__ == "__main__":
+    main()
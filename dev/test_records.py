@@ -0,0 +1,86 @@
+#!/usr/bin/python
+# -*- encoding: utf8 -*-
+
+"""
+Inversion of all time records of a PV file (qg_model.invert_pv_records), psi is written
+to one output file. PV records are computed from streamfunction records whose boundary
+values change in time, boundary values are read with each record and inverted psi must
+match the streamfunctions. Timings with and without reading the next record in a background
+thread (prefetch) are compared, an error of the background read must be raised.
+
+mpirun -n 4 python test_records.py
+"""
+
+import os
+import sys
+import time
+
+sys.path.append('../')
+from qgsolver.qg import qg_model
+from qgsolver.inout import write_nc, read_nc_petsc
+
+import numpy as np
+from petsc4py import PETSc
+
+
+def main():
+    nt = 8
+    qg = qg_model(hgrid = {'Nx':64, 'Ny':64}, vgrid = {'Nz':10},
+                  ncores_x=2, ncores_y=2, verbose=0)
+    qg.pvinv.ksp.setTolerances(rtol=1.e-8, max_it=1000)
+    da, grid = qg.da, qg.grid
+    #
+    # records of a drifting streamfunction and of its PV
+    mx, my, mz = da.getSizes()
+    (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
+    i, j, k = np.meshgrid(np.arange(xs, xe), np.arange(ys, ye), np.arange(zs, ze), indexing='ij')
+    PSI_true = qg.state.PSI.duplicate()
+    for it in range(nt):
+        da.getVecArray(PSI_true)[...] = (1.+0.1*it) * np.cos(2.*np.pi*(i+2.*it)/mx) \
+                                        * np.cos(np.pi*(j-it)/my) * np.cos(np.pi*k/mz)
+        qg.pvinv.q_from_psi(qg.state.Q, PSI_true)
+        write_nc([qg.state.Q, PSI_true], ['q', 'psi'], 'records_q.nc', da, grid,
+                 append=(it>0))
+    #
+    comm = da.getComm().tompi4py()
+    PSI = qg.state.PSI.duplicate()
+    for prefetch in [False, True]:
+        qg.state.PSI.set(0.)
+        comm.barrier()
+        t0 = time.time()
+        qg.invert_pv_records('records_q.nc', output_file='records_psi.nc', bpsiname='psi',
+                             prefetch=prefetch)
+        comm.barrier()
+        t_records = time.time()-t0
+        #
+        # inverted and true streamfunctions
+        err = 0.
+        for it in range(nt):
+            read_nc_petsc(PSI_true, 'psi', 'records_q.nc', da, grid, it=it)
+            read_nc_petsc(PSI, 'psi', 'records_psi.nc', da, grid, it=it)
+            PSI.axpy(-1., PSI_true)
+            err = max(err, PSI.norm(PETSc.NormType.INFINITY)
+                           /PSI_true.norm(PETSc.NormType.INFINITY))
+        if qg.rank == 0:
+            print('prefetch=%s: %i records inverted in %.2f s, max relative difference with'
+                  ' true psi %.1e' %(prefetch, nt, t_records, err))
+        assert err < 1.e-4
+    #
+    # the record following record 0 does not exist, it is read in the background
+    try:
+        qg.invert_pv_records('records_q.nc', output_file='records_psi.nc', bpsiname='psi',
+                             records=[0, nt])
+        raised = False
+    except IndexError:
+        raised = True
+    assert raised
+    comm.barrier()
+    if qg.rank == 0:
+        os.remove('records_q.nc')
+        os.remove('records_psi.nc')
+    if qg.rank == 0:
+        print('Records test done')
+
+
+if __name__ == "__main__":
+    main()
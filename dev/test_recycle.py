@@ -0,0 +1,58 @@
+#!/usr/bin/python
+# -*- encoding: utf8 -*-
+
+"""
+Iterations of the PV inversions of the time stepping with a deflation space recycled
+across solves (pvinversion recycle option, see recycle.deflation_space), for several sizes
+of the deflation space
+
+mpirun -n 4 python test_recycle.py
+"""
+
+import sys
+
+sys.path.append('../')
+from qgsolver.qg import qg_model
+
+from petsc4py import PETSc
+
+
+def recycle_test(recycle, nt=10):
+    """ Time step and return the number of iterations and the final streamfunction
+    """
+    qg = qg_model(hgrid = {'Nx':64, 'Ny':64}, vgrid = {'Nz':10},
+                  boundary_types={'periodic': True},
+                  ncores_x=2, ncores_y=2,
+                  dt = 0.5*86400., K = 1.e2, verbose=0, guess='previous', recycle=recycle)
+    qg.set_q()
+    qg.invert_pv()
+    qg.tstep(nt)
+    if recycle is not None:
+        # the space is held by the vectors allocated with it
+        space = qg.pvinv._recycle
+        banks = [v.handle for v in sum(space._U+space._C, [])]
+        assert len(banks) == 4*recycle
+        assert all(v.handle in banks for v in space.U+space.C)
+        if qg.rank == 0:
+            print(space.report())
+    return qg.pvinv._guess.iterations, qg.state.PSI.copy(), qg.rank
+
+
+def main():
+    it_ref, PSI_ref, rank = recycle_test(None)
+    for recycle in [4, 8]:
+        it, PSI, rank = recycle_test(recycle)
+        PSI.axpy(-1., PSI_ref)
+        err = PSI.norm(PETSc.NormType.INFINITY)/PSI_ref.norm(PETSc.NormType.INFINITY)
+        if rank == 0:
+            print('deflation space of %i vectors: %i iterations instead of %i, relative difference of psi %.1e' \
+                  %(recycle, it, it_ref, err))
+        # solutions agree within the solver tolerance
+        assert err < 1.e-2
+        assert it < it_ref
+    if rank == 0:
+        print('Recycling test done')
+
+
+if __name__ == "__main__":
+    main()
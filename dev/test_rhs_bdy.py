@@ -0,0 +1,118 @@
+#!/usr/bin/python
+# -*- encoding: utf8 -*-
+
+"""
+Regression test of the vectorized boundary conditions and mask of the PV inversion RHS
+(pvinversion.set_rhs_bdy and set_rhs_mask) against the original point by point loops:
+results must be identical for all boundary conditions
+
+mpirun -n 4 python test_rhs_bdy.py
+"""
+
+import sys
+
+sys.path.append('../')
+from qgsolver.qg import qg_model
+from qgsolver.utils import g, rho0
+
+import numpy as np
+from petsc4py import PETSc
+
+
+def set_rhs_loop(pvinv, da, grid, state, PSI, RHO, topdown_rho, RHS):
+    """ Original loop implementation of pvinversion.set_rhs_bdy and set_rhs_mask
+    """
+    rhs, psi, rho = da.getVecArray(RHS), da.getVecArray(PSI), da.getVecArray(RHO)
+    (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
+    kdown, kup = grid.kdown, grid.kup
+    bottom, top = pvinv.bdy_type['bottom'], pvinv.bdy_type['top']
+    for j in range(ys, ye):
+        for i in range(xs, xe):
+            for k in range(zs, kdown):
+                rhs[i, j, k] = psi[i, j, k]
+            k = kdown
+            if bottom == 'N_RHO' or topdown_rho:
+                rhs[i, j, k] = - g*rho[i, j, k]/(rho0*state.f0)
+            elif bottom == 'N_PSI':
+                rhs[i, j, k] = (psi[i,j,k+1]-psi[i,j,k])/grid.dzw[k]
+            else:
+                rhs[i, j, k] = psi[i,j,k]
+            for k in range(kup+1, ze):
+                rhs[i, j, k] = psi[i, j, k]
+            k = kup
+            if top == 'N_RHO' or topdown_rho:
+                krho = k if topdown_rho else k-1
+                rhs[i, j, k] = - g*rho[i, j, krho]/(rho0*state.f0)
+            elif top == 'N_PSI':
+                rhs[i, j, k] = (psi[i,j,k]-psi[i,j,k-1])/grid.dzw[k-1]
+            else:
+                rhs[i, j, k] = psi[i,j,k]
+    if pvinv.petscBoundaryType != 'periodic':
+        for k in range(zs, ze):
+            for j in range(ys, ye):
+                for i in range(xs, xe):
+                    if i <= grid.istart or i >= grid.iend or j <= grid.jstart or j >= grid.jend:
+                        rhs[i, j, k] = psi[i, j, k]
+    if grid.mask:
+        mask = grid.da2D.getVecArray(grid.D)
+        for k in range(zs, ze):
+            for j in range(ys, ye):
+                for i in range(xs, xe):
+                    if mask[i, j, grid._k_mask] == 0.:
+                        rhs[i, j, k] = psi[i, j, k]
+
+
+def fill_random(da, V, seed):
+    """ Fill a vector with random values, independent of the tiling
+    """
+    mx, my, mz = da.getSizes()
+    (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
+    v = np.random.RandomState(seed).randn(mx, my, mz)
+    da.getVecArray(V)[xs:xe, ys:ye, zs:ze] = v[xs:xe, ys:ye, zs:ze]
+
+
+def rhs_bdy_test(boundary_types, topdown_rho, ncores_x=2, ncores_y=2):
+    """ Compare loop and vectorized RHS
+    """
+    qg = qg_model(hgrid = {'Nx':32, 'Ny':24}, vgrid = {'Nz':6},
+                  boundary_types=boundary_types, mask=True,
+                  ncores_x=ncores_x, ncores_y=ncores_y, verbose=0)
+    da, grid, state = qg.da, qg.grid, qg.state
+    (xs, xe), (ys, ye), _ = da.getRanges()
+    for seed, V in enumerate([state.Q, state.PSI, state.RHO]):
+        fill_random(da, V, seed)
+    RHS_ref = state.Q.copy()
+    # land points, changed after a first inversion: cached land points are recomputed
+    for mask_seed in [3, 4]:
+        D = grid.da2D.getVecArray(grid.D)
+        D[xs:xe, ys:ye, grid._k_mask] = np.random.RandomState(mask_seed).rand(xe-xs, ye-ys) > 0.3
+        grid._reset_local_D()
+        #
+        state.Q.copy(RHS_ref)
+        set_rhs_loop(qg.pvinv, da, grid, state, state.PSI, state.RHO, topdown_rho, RHS_ref)
+        #
+        state.Q.copy(qg.pvinv._RHS)
+        qg.pvinv.set_rhs_bdy(da, grid, state, state.PSI, state.RHO, topdown_rho)
+        qg.pvinv.set_rhs_mask(da, grid, state.PSI)
+        #
+        RHS_ref.axpy(-1., qg.pvinv._RHS)
+        err = RHS_ref.norm(PETSc.NormType.INFINITY)
+        if qg.rank == 0:
+            print('%s, topdown_rho=%s, mask %i: max |loop - vectorized| = %e' \
+                  %(str(boundary_types), topdown_rho, mask_seed, err))
+        assert err == 0.
+    return qg
+
+
+def main():
+    for bdy in ['N_RHO', 'N_PSI', 'D']:
+        for periodic in [False, True]:
+            boundary_types = {'bottom': bdy, 'top': bdy, 'periodic': periodic}
+            qg = rhs_bdy_test(boundary_types, False)
+    qg = rhs_bdy_test({}, True)
+    if qg.rank == 0:
+        print('RHS boundary conditions test done')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+#!/usr/bin/python
+# -*- encoding: utf8 -*-
+
+"""
+Check that the bulk (COO) assembly of the PV inversion operator produces the same
+matrix as the original point by point assembly (setValueStencil loops), on uniform grids
+(_set_L) and on grids with non uniform metric terms and land points (_set_L_curv)
+
+mpirun -n 4 python test_set_L.py
+"""
+
+import sys
+import time
+
+sys.path.append('../')
+from qgsolver.qg import qg_model
+
+import numpy as np
+from petsc4py import PETSc
+
+
+def set_L_loop(pvinv, L, da, grid, sparam):
+    """ Original loop implementation of pvinversion._set_L
+    """
+    idz = 1./grid.dz
+    idx2, idy2, idz2 = [1.0/dl**2 for dl in [grid.dx, grid.dy, grid.dz]]
+    (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
+    kdown, kup = grid.kdown, grid.kup
+    #
+    L.zeroEntries()
+    row = PETSc.Mat.Stencil()
+    col = PETSc.Mat.Stencil()
+    for k in range(zs, ze):
+        for j in range(ys, ye):
+            for i in range(xs, xe):
+                row.index = (i,j,k)
+                row.field = 0
+                if (i <= grid.istart or i >= grid.iend or j <= grid.jstart or j >= grid.jend) \
+                        and pvinv.petscBoundaryType != 'periodic':
+                    values = [((i,j,k), 1.0)]
+                elif k == kdown:
+                    if pvinv.bdy_type['bottom'] in ['N_RHO', 'N_PSI']:
+                        values = [((i,j,k), -idz), ((i,j,k+1), idz)]
+                    else:
+                        values = [((i,j,k), 1.0)]
+                elif k == kup:
+                    if pvinv.bdy_type['top'] in ['N_RHO', 'N_PSI']:
+                        values = [((i,j,k-1), -idz), ((i,j,k), idz)]
+                    else:
+                        values = [((i,j,k), 1.0)]
+                elif k < kdown or k > kup:
+                    values = [((i,j,k), 0.0)]
+                else:
+                    values = [((i,j,k-1), sparam[k-1]*idz2),
+                              ((i,j-1,k), idy2),
+                              ((i-1,j,k), idx2),
+                              ((i, j, k), -2.*(idx2+idy2)-(sparam[k]*idz2+sparam[k-1]*idz2)),
+                              ((i+1,j,k), idx2),
+                              ((i,j+1,k), idy2),
+                              ((i,j,k+1), sparam[k]*idz2)]
+                for index, value in values:
+                    col.index = index
+                    col.field = 0
+                    L.setValueStencil(row, col, value)
+    L.assemble()
+
+
+def set_L_curv_loop(pvinv, L, da, grid, sparam):
+    """ Original loop implementation of pvinversion._set_L_curv
+    """
+    D = grid.get_local_D()
+    kmask, kdxu, kdyu, kdxv, kdyv, kdxt, kdyt = grid._k_mask, grid._k_dxu, grid._k_dyu, \
+                                                grid._k_dxv, grid._k_dyv, grid._k_dxt, grid._k_dyt
+    idzt, idzw = 1./grid.dzt, 1./grid.dzw
+    (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
+    kdown, kup = grid.kdown, grid.kup
+    #
+    L.zeroEntries()
+    row = PETSc.Mat.Stencil()
+    col = PETSc.Mat.Stencil()
+    for k in range(zs, ze):
+        for j in range(ys, ye):
+            for i in range(xs, xe):
+                row.index = (i,j,k)
+                row.field = 0
+                if D[i,j,kmask] == 0.:
+                    values = [((i,j,k), 1.0)]
+                elif (i <= grid.istart or i >= grid.iend or j <= grid.jstart or j >= grid.jend) \
+                        and pvinv.petscBoundaryType != 'periodic':
+                    values = [((i,j,k), 1.0)]
+                elif k == kdown:
+                    if pvinv.bdy_type['bottom'] in ['N_RHO', 'N_PSI']:
+                        values = [((i,j,k), -idzw[k]), ((i,j,k+1), idzw[k])]
+                    else:
+                        values = [((i,j,k), 1.0)]
+                elif k == kup:
+                    if pvinv.bdy_type['top'] in ['N_RHO', 'N_PSI']:
+                        values = [((i,j,k-1), -idzw[k-1]), ((i,j,k), idzw[k-1])]
+                    else:
+                        values = [((i,j,k), 1.0)]
+                elif k < kdown or k > kup:
+                    values = [((i,j,k), 1.0)]
+                else:
+                    iA = 1./D[i,j,kdxt]/D[i,j,kdyt]
+                    values = [((i,j,k-1), sparam[k-1]*idzt[k]*idzw[k-1]),
+                              ((i,j-1,k), iA * D[i,j-1,kdxv]/D[i,j-1,kdyv]),
+                              ((i-1,j,k), iA * D[i-1,j,kdyu]/D[i-1,j,kdxu]),
+                              ((i, j, k), -iA*(D[i,j,kdyu]/D[i,j,kdxu]
+                                               +D[i-1,j,kdyu]/D[i-1,j,kdxu]
+                                               +D[i,j,kdxv]/D[i,j,kdyv]
+                                               +D[i,j-1,kdxv]/D[i,j-1,kdyv])
+                                          - (sparam[k]*idzt[k]*idzw[k]
+                                             +sparam[k-1]*idzt[k]*idzw[k-1])),
+                              ((i+1,j,k), iA * D[i,j,kdyu]/D[i,j,kdxu]),
+                              ((i,j+1,k), iA * D[i,j,kdxv]/D[i,j,kdyv]),
+                              ((i,j,k+1), sparam[k]*idzt[k]*idzw[k])]
+                for index, value in values:
+                    col.index = index
+                    col.field = 0
+                    L.setValueStencil(row, col, value)
+    L.assemble()
+
+
+def set_L_test(boundary_types, ncores_x=2, ncores_y=2):
+    """ Compare loop and bulk assemblies, prints timings
+    """
+    qg = qg_model(hgrid = {'Nx':64, 'Ny':48}, vgrid = {'Nz':10},
+                  boundary_types=boundary_types,
+                  ncores_x=ncores_x, ncores_y=ncores_y, verbose=0)
+    da = qg.da
+    #
+    L_ref = da.createMat()
+    t0 = time.time()
+    set_L_loop(qg.pvinv, L_ref, da, qg.grid, qg.state._sparam)
+    t_loop = time.time() - t0
+    #
+    L = da.createMat()
+    t0 = time.time()
+    qg.pvinv._set_L(L, da, qg.grid, qg.state._sparam)
+    t_coo = time.time() - t0
+    #
+    L_ref.axpy(-1., L, structure=PETSc.Mat.Structure.DIFFERENT_NONZERO_PATTERN)
+    err = L_ref.norm(PETSc.NormType.FROBENIUS)
+    if qg.rank == 0:
+        print('%s: |L_loop - L_coo| = %e, loop %.2f s, coo %.2f s' \
+              %(str(boundary_types), err, t_loop, t_coo))
+    assert err == 0.
+    return qg
+
+
+def set_L_curv_test(boundary_types, ncores_x=2, ncores_y=2):
+    """ Compare loop and bulk assemblies on a grid with random metric terms and land points
+    """
+    qg = qg_model(hgrid = {'Nx':64, 'Ny':48}, vgrid = {'Nz':10},
+                  boundary_types=boundary_types, mask=True,
+                  ncores_x=ncores_x, ncores_y=ncores_y, verbose=0)
+    da, grid = qg.da, qg.grid
+    (xs, xe), (ys, ye), _ = da.getRanges()
+    D = grid.da2D.getVecArray(grid.D)
+    for seed, kD in enumerate([grid._k_dxt, grid._k_dyt, grid._k_dxu, grid._k_dyu,
+                               grid._k_dxv, grid._k_dyv]):
+        D[xs:xe, ys:ye, kD] = grid.dx*(1.+0.3*np.random.RandomState(seed).rand(xe-xs, ye-ys))
+    D[xs:xe, ys:ye, grid._k_mask] = np.random.RandomState(10).rand(xe-xs, ye-ys) > 0.2
+    grid._reset_local_D()
+    #
+    L_ref = da.createMat()
+    t0 = time.time()
+    set_L_curv_loop(qg.pvinv, L_ref, da, grid, qg.state._sparam)
+    t_loop = time.time() - t0
+    #
+    L = da.createMat()
+    t0 = time.time()
+    qg.pvinv._set_L_curv(L, da, grid, qg.state._sparam)
+    t_coo = time.time() - t0
+    #
+    L_ref.axpy(-1., L, structure=PETSc.Mat.Structure.DIFFERENT_NONZERO_PATTERN)
+    err = L_ref.norm(PETSc.NormType.FROBENIUS)
+    if qg.rank == 0:
+        print('%s, curvilinear with mask: |L_loop - L_coo| = %e, loop %.2f s, coo %.2f s' \
+              %(str(boundary_types), err, t_loop, t_coo))
+    assert err == 0.
+    return qg
+
+
+def main():
+    set_L_test({'periodic': True})
+    set_L_test({})
+    set_L_test({'top': 'D', 'bottom': 'D'})
+    set_L_test({'top': 'N_RHO', 'bottom': 'D'})
+    set_L_curv_test({'periodic': True})
+    set_L_curv_test({})
+    qg = set_L_curv_test({'top': 'N_RHO', 'bottom': 'D'})
+    if qg.rank == 0:
+        print('Operator assembly test done')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/python
+# -*- encoding: utf8 -*-
+
+"""
+Operator memory and halo exchange volume of DMDAs with the former stencil (box, width 2)
+and with the stencils used now (box, width 1 for time stepping, star, width 1 for operators)
+
+mpirun -n 4 python test_stencil.py
+mpirun -n 16 python test_stencil.py 1024 512 300 4 4
+"""
+
+import sys
+import time
+import numpy as np
+from petsc4py import PETSc
+
+
+def halo_points(da):
+    """ Number of ghost points filled by a global to local scatter over the tile
+    """
+    (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
+    (gxs, gxe), (gys, gye), (gzs, gze) = da.getGhostRanges()
+    xm, ym, zm = xe-xs, ye-ys, ze-zs
+    gxm, gym, gzm = gxe-gxs, gye-gys, gze-gzs
+    if da.getStencilType() == PETSc.DMDA.StencilType.STAR:
+        # corners are not exchanged
+        return (gxm-xm)*ym*zm + xm*(gym-ym)*zm + xm*ym*(gzm-zm)
+    return gxm*gym*gzm - xm*ym*zm
+
+
+def stencil_test(da, label, assemble=True):
+    """ Print the memory of an operator created by the DMDA (values and column indices of
+    allocated nonzeros, not given by the petsc matrix info) and the halo exchange volume
+    """
+    mpicomm = da.getComm().tompi4py()
+    halo = mpicomm.allreduce(halo_points(da))
+    #
+    V = da.createGlobalVec()
+    lV = da.createLocalVec()
+    V.set(1.)
+    t0 = time.time()
+    for i in range(10):
+        da.globalToLocal(V, lV)
+    t_exchange = mpicomm.allreduce(time.time()-t0)/10./mpicomm.Get_size()
+    #
+    nz = None
+    report = '%-16s halo %.3e points (%.1f MB), exchange %.2e s' \
+             %(label, halo, halo*8./1.e6, t_exchange)
+    if assemble:
+        L = da.createMat()
+        nz = L.getInfo(PETSc.Mat.InfoType.GLOBAL_SUM)['nz_allocated']
+        L.destroy()
+        mem = nz*(np.dtype(PETSc.ScalarType).itemsize + np.dtype(PETSc.IntType).itemsize)
+        report += ', operator %.3e nonzeros (%.1f MB)' %(nz, mem/1.e6)
+    if mpicomm.Get_rank() == 0:
+        print(report)
+    V.destroy()
+    lV.destroy()
+    return halo, nz
+
+
+def main():
+    if len(sys.argv) > 1:
+        Nx, Ny, Nz, ncores_x, ncores_y = [int(a) for a in sys.argv[1:6]]
+    else:
+        Nx, Ny, Nz, ncores_x, ncores_y = 128, 64, 30, 2, 2
+    da2 = PETSc.DMDA().create(sizes=[Nx, Ny, Nz], proc_sizes=[ncores_x, ncores_y, 1],
+                              stencil_width=2)
+    da = PETSc.DMDA().create(sizes=[Nx, Ny, Nz], proc_sizes=[ncores_x, ncores_y, 1],
+                             stencil_width=1, stencil_type='box')
+    da_op = da.duplicate(stencil_type='star')
+    assert all(np.array_equal(l_op, l) for l_op, l in zip(da_op.getOwnershipRanges(),
+                                                          da.getOwnershipRanges()))
+    #
+    halo2, nz2 = stencil_test(da2, 'box, width 2')
+    halo1, nz1 = stencil_test(da, 'box, width 1', assemble=False)
+    halo_op, nz_op = stencil_test(da_op, 'star, width 1')
+    # 7 points operator, fewer entries along boundaries
+    assert nz_op <= 7*Nx*Ny*Nz
+    assert halo1 < halo2 and halo_op < halo1
+    if da.getComm().getRank() == 0:
+        print('Stencil test done')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/python
+# -*- encoding: utf8 -*-
+
+"""
+Check the vertical modes direct solver (solver='vmodes') of the PV inversion:
+the residual of the assembled operator must be at round-off level, communicators of the
+solver are freed when the inversion is released
+
+mpirun -n 4 python test_vmodes.py
+"""
+
+import sys
+import time
+
+sys.path.append('../')
+from qgsolver.qg import qg_model
+
+from petsc4py import PETSc
+from mpi4py import MPI
+
+
+def vmodes_test(boundary_types, ncores_x=2, ncores_y=2):
+    """ Inversion of the analytical PV distribution, prints residual and timings
+    """
+    qg = qg_model(hgrid = {'Nx':128, 'Ny':96}, vgrid = {'Nz':10},
+                  boundary_types=boundary_types,
+                  ncores_x=ncores_x, ncores_y=ncores_y, verbose=0,
+                  solver='vmodes')
+    qg.set_q()
+    qg.state.PSI.set(0.)
+    pvinv = qg.pvinv
+    t0 = time.time()
+    pvinv.solve(qg.da, qg.grid, qg.state)
+    t_vmodes = time.time() - t0
+    #
+    R = qg.da.createGlobalVec()
+    pvinv.L.mult(qg.state.PSI, R)
+    R.axpy(-1., pvinv._RHS)
+    err = R.norm()/pvinv._RHS.norm()
+    #
+    # same inversion with the petsc solver
+    pvinv.ksp.setTolerances(rtol=1e-10, max_it=10000)
+    qg.state.PSI.set(0.)
+    t0 = time.time()
+    pvinv.ksp.solve(pvinv._RHS, qg.state.PSI)
+    t_ksp = time.time() - t0
+    if qg.rank == 0:
+        print('%s: |L psi - rhs|/|rhs| = %e, vmodes %.2f s, ksp %.2f s (%i iterations)' \
+              %(str(boundary_types), err, t_vmodes, t_ksp, pvinv.ksp.getIterationNumber()))
+    assert err < 1e-10
+    #
+    comms = list(pvinv._vmodes._pencils._comms)
+    pvinv.release()
+    assert all(comm == MPI.COMM_NULL for comm in comms)
+    return qg
+
+
+def main():
+    vmodes_test({})
+    vmodes_test({'top': 'D', 'bottom': 'D'})
+    vmodes_test({'periodic': True, 'top': 'D', 'bottom': 'N_PSI'})
+    qg = vmodes_test({'periodic': True, 'top': 'D', 'bottom': 'D'})
+    if qg.rank == 0:
+        print('Vertical modes solver test done')
+
+
+if __name__ == "__main__":
+    main()
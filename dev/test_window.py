@@ -0,0 +1,47 @@
+#!/usr/bin/python
+# -*- encoding: utf8 -*-
+
+"""
+Window inversion with levels solved as independent 2D problems (decoupled solve) compared
+to the 3D solve
+
+mpirun -n 4 python test_window.py
+"""
+
+import sys
+import time
+
+sys.path.append('../')
+from qgsolver.window import window
+
+from petsc4py import PETSc
+
+
+def window_test(decoupled):
+    """ Compute a window and return it with the time of the inversion
+    """
+    win = window(hgrid={'Nx':128, 'Ny':128}, vgrid={'Nz':20}, K=1.e-5,
+                 ncores_x=2, ncores_y=2, decoupled=decoupled, verbose=0)
+    win.set_q()
+    win.comm.barrier()
+    t0 = time.time()
+    win.invert_win()
+    return win.PSI, time.time()-t0, win.rank
+
+
+def main():
+    PSI_ref, t_ref, rank = window_test(False)
+    PSI, t, rank = window_test(True)
+    PSI.axpy(-1., PSI_ref)
+    err = PSI.norm(PETSc.NormType.INFINITY)/PSI_ref.norm(PETSc.NormType.INFINITY)
+    if rank == 0:
+        print('3D solve: %.2f s, decoupled 2D solves: %.2f s, relative difference %.1e' \
+              %(t_ref, t, err))
+    # solutions agree within the solver tolerance
+    assert err < 1.e-4
+    if rank == 0:
+        print('Window test done')
+
+
+if __name__ == "__main__":
+    main()
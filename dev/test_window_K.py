@@ -0,0 +1,79 @@
+#!/usr/bin/python
+# -*- encoding: utf8 -*-
+
+"""
+Windows for a list of wavenumbers K computed in one pass (window.invert_win_K: the operator
+diagonal is shifted for each K) compared to windows of models created for each K,
+with decoupled 2D solves, with the 3D operator (decoupled=False) and with a 3D mask
+
+mpirun -n 4 python test_window_K.py
+"""
+
+import os
+import sys
+import time
+
+sys.path.append('../')
+from qgsolver.window import window
+
+from petsc4py import PETSc
+from netCDF4 import Dataset
+
+
+def create_window(K, **kwargs):
+    return window(hgrid={'Nx':128, 'Ny':128}, vgrid={'Nz':10}, K=K,
+                  ncores_x=2, ncores_y=2, verbose=0, **kwargs)
+
+
+def window_K_test(**kwargs):
+    """ Compare windows computed in one pass with windows of models created for each K,
+    kwargs are passed to the window models
+    """
+    Ks = [1.e-5, 2.e-5, 5.e-5, 1.e-4]
+    # one model per K
+    t0 = time.time()
+    PSI_ref = []
+    for K in Ks:
+        win = create_window(K, **kwargs)
+        win.set_q()
+        win.invert_win()
+        PSI_ref.append(win.PSI)
+    t_ref = time.time()-t0
+    # one pass
+    t0 = time.time()
+    win = create_window(Ks[0], **kwargs)
+    win.invert_win_K(Ks, output_file='window_K.nc')
+    t = time.time()-t0
+    # the last window is compared
+    PSI_ref[-1].axpy(-1., win.PSI)
+    err = PSI_ref[-1].norm(PETSc.NormType.INFINITY)/win.PSI.norm(PETSc.NormType.INFINITY)
+    if win.rank == 0:
+        print('%s, decoupled=%s: %i windows, one model per K %.2f s, one pass %.2f s,'
+              ' relative difference %.1e' \
+              %(str(kwargs), win.wininv.decoupled, len(Ks), t_ref, t, err))
+        nc = Dataset('window_K.nc', 'r')
+        assert nc.variables['window'].dimensions[0] == 'K'
+        assert list(nc.variables['K'][:]) == Ks
+        nc.close()
+        os.remove('window_K.nc')
+    assert err < 1.e-4
+    return win
+
+
+def main():
+    win_2D = window_K_test()
+    win_3D = window_K_test(decoupled=False)
+    # the 2D operator of decoupled levels and the 3D operator give the same windows
+    win_3D.PSI.axpy(-1., win_2D.PSI)
+    err = win_3D.PSI.norm(PETSc.NormType.INFINITY)/win_2D.PSI.norm(PETSc.NormType.INFINITY)
+    if win_2D.rank == 0:
+        print('decoupled and 3D windows: relative difference %.1e' %err)
+    assert err < 1.e-4
+    win = window_K_test(mask3D=True)
+    assert not win.wininv.decoupled
+    if win.rank == 0:
+        print('Window K test done')
+
+
+if __name__ == "__main__":
+    main()
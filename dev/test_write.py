@@ -0,0 +1,71 @@
+#!/usr/bin/python
+# -*- encoding: utf8 -*-
+
+"""
+Write bandwidth of write_nc with variables gathered and written by rank 0 and with tiles
+written collectively by all processes (parallel=True, requires netcdf4 with parallel hdf5),
+files must be identical. Run with increasing numbers of processes, e.g.:
+
+mpirun -n 4 python test_write.py
+mpirun -n 16 python test_write.py 256 256 100 4 4
+"""
+
+import sys
+import time
+
+sys.path.append('../')
+from qgsolver.qg import qg_model
+from qgsolver.inout import write_nc, has_parallel_nc, read_nc_petsc
+
+from petsc4py import PETSc
+
+
+def bandwidth(qg, filename, parallel, n=3):
+    """ Write bandwidth in MB/s (3 fields per write)
+    """
+    comm = qg.comm.tompi4py()
+    V = [qg.state.PSI, qg.state.Q, qg.state.RHO]
+    comm.barrier()
+    t0 = time.time()
+    for i in range(n):
+        write_nc(V, ['psi', 'q', 'rho'], filename, qg.da, qg.grid, append=(i>0),
+                 parallel=parallel)
+    comm.barrier()
+    return n*len(V)*qg.state.Q.getSize()*8./1.e6/(time.time()-t0)
+
+
+def main():
+    if len(sys.argv) > 1:
+        Nx, Ny, Nz, ncores_x, ncores_y = [int(a) for a in sys.argv[1:6]]
+    else:
+        Nx, Ny, Nz, ncores_x, ncores_y = 128, 128, 50, 2, 2
+    qg = qg_model(hgrid = {'Nx':Nx, 'Ny':Ny}, vgrid = {'Nz':Nz},
+                  ncores_x=ncores_x, ncores_y=ncores_y, mask=True, verbose=0)
+    qg.set_q()
+    qg.set_psi()
+    qg.set_rho()
+    #
+    bw_serial = bandwidth(qg, 'write_serial.nc', False)
+    if qg.rank == 0:
+        print('%i processes, rank 0 write: %.1f MB/s' %(qg.comm.getSize(), bw_serial))
+    if not has_parallel_nc(qg.da):
+        if qg.rank == 0:
+            print('netcdf4 without parallel hdf5 support, parallel write not tested')
+        return
+    bw_parallel = bandwidth(qg, 'write_parallel.nc', True)
+    if qg.rank == 0:
+        print('%i processes, parallel write: %.1f MB/s' %(qg.comm.getSize(), bw_parallel))
+    #
+    # last records are identical
+    V, W = qg.state.Q.duplicate(), qg.state.Q.duplicate()
+    for name in ['psi', 'q', 'rho']:
+        read_nc_petsc(V, name, 'write_serial.nc', qg.da, qg.grid)
+        read_nc_petsc(W, name, 'write_parallel.nc', qg.da, qg.grid)
+        V.axpy(-1., W)
+        assert V.norm(PETSc.NormType.INFINITY) == 0.
+    if qg.rank == 0:
+        print('Write test done')
+
+
+if __name__ == "__main__":
+    main()
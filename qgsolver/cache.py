@@ -0,0 +1,291 @@
+#!/usr/bin/python
+# -*- encoding: utf8 -*-
+
+
+import os
+import hashlib
+import numpy as np
+from petsc4py import PETSc
+
+#
+#==================== In-process cache of operators and solvers ============================================
+#
+
+
+class cache_entry():
+    ''' Objects (operators, solvers) shared between inversion objects
+    '''
+
+    def __init__(self, key, objects):
+        '''
+        Parameters
+        ----------
+        key : tuple
+            cache key, see solver_key
+        objects : dict
+            shared objects, e.g. {'L': L, 'ksp': ksp}
+        '''
+        self.key = key
+        self.objects = objects
+        self.refcount = 1
+        self.evicted = False
+
+    def destroy(self):
+        ''' Destroy petsc objects
+        '''
+        done = set()
+        for obj in self.objects.values():
+            if hasattr(obj, 'destroy') and id(obj) not in done:
+                obj.destroy()
+                done.add(id(obj))
+        self.objects = {}
+
+
+class solver_cache():
+    ''' In-process cache of assembled operators and solvers (with preconditioner setup), reference
+    counted: entries are kept after their last release so that new objects with identical keys
+    reuse them, until they are evicted. Objects of evicted entries are destroyed once released by
+    all their users.
+    '''
+
+    def __init__(self):
+        self._entries = {}
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def acquire(self, key):
+        ''' Get an entry and increment its reference count
+
+        Parameters
+        ----------
+        key : tuple
+            cache key
+
+        Returns
+        -------
+        entry : cache_entry, None
+            None if the key is not in the cache
+        '''
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry.refcount += 1
+        return entry
+
+    def add(self, key, objects):
+        ''' Store objects, the caller holds a reference
+
+        Parameters
+        ----------
+        key : tuple
+            cache key
+        objects : dict
+            shared objects
+
+        Returns
+        -------
+        entry : cache_entry
+        '''
+        self.evict(key)
+        entry = cache_entry(key, objects)
+        self._entries[key] = entry
+        return entry
+
+    def release(self, entry):
+        ''' Decrement the reference count of an entry
+
+        Parameters
+        ----------
+        entry : cache_entry
+        '''
+        entry.refcount -= 1
+        if entry.refcount == 0 and entry.evicted:
+            entry.destroy()
+
+    def evict(self, key=None):
+        ''' Remove entries from the cache, objects are destroyed if not used anymore
+
+        Parameters
+        ----------
+        key : tuple, None, optional
+            key of the entry to remove, all entries are removed if None
+        '''
+        if key is None:
+            keys = list(self._entries.keys())
+        else:
+            keys = [key] if key in self._entries else []
+        for k in keys:
+            entry = self._entries.pop(k)
+            entry.evicted = True
+            if entry.refcount == 0:
+                entry.destroy()
+
+
+# cache shared by all inversion objects of the process
+solvers = solver_cache()
+
+
+def solver_key(name, da, grid, bdy_type, **params):
+    ''' Cache key of an operator/solver: grid geometry (including the values of metric terms
+    and mask, see grid_digest), tiling, boundary conditions and parameters (stratification,
+    coriolis frequency, solver options)
+
+    Parameters
+    ----------
+    name : str
+        solver name, e.g. 'pvinversion'
+    da : petsc DMDA
+        holds the petsc grid
+    grid : qgsolver grid object
+        grid data holder
+    bdy_type : dict
+        vertical and lateral boundary conditions
+    params : dict
+        other parameters, arrays are hashed
+
+    Returns
+    -------
+    key : tuple
+        hashable key, identical on all processes
+    '''
+    geometry = []
+    for attr in ['Nx', 'Ny', 'Nz', 'istart', 'iend', 'jstart', 'jend', 'kdown', 'kup',
+                 'i0', 'j0', 'k0', 'dx', 'dy', 'dz', 'dzt', 'dzw', 'hgrid_file', 'vgrid_file',
+                 'mask']:
+        geometry.append((attr, _hashable(getattr(grid, attr, None))))
+    geometry.append(('D', grid_digest(da, grid)))
+    tiling = (da.getSizes(), da.getProcSizes(),
+              tuple(tuple(r) for r in da.getOwnershipRanges()),
+              str(da.getBoundaryType()), str(da.getStencilType()), da.getStencilWidth())
+    return (name, tuple(geometry), tiling,
+            tuple(sorted((k, str(v)) for k, v in bdy_type.items())),
+            tuple(sorted((k, _hashable(v)) for k, v in params.items())))
+
+
+def grid_digest(da, grid):
+    ''' Digest of metric terms, coriolis parameter and mask (grid.D and 3D mask) of all
+    processes, collective
+
+    Parameters
+    ----------
+    da : petsc DMDA
+        holds the petsc grid
+    grid : qgsolver grid object
+        grid data holder
+
+    Returns
+    -------
+    digest : str
+        hexadecimal digest, identical on all processes
+    '''
+    local = hashlib.sha1()
+    for V in [getattr(grid, 'D', None), getattr(grid, 'mask3D', None)]:
+        if isinstance(V, PETSc.Vec):
+            local.update(V.getArray(readonly=True).tobytes())
+    digests = da.getComm().tompi4py().allgather(local.hexdigest())
+    return hashlib.sha1(''.join(digests).encode()).hexdigest()
+
+
+def _hashable(value):
+    ''' Digest of arrays, other values are returned unchanged
+    '''
+    if isinstance(value, (np.ndarray, list)):
+        value = np.ascontiguousarray(value, dtype=float)
+        return hashlib.sha1(value.tobytes()).hexdigest()
+    return value
+
+
+#
+#==================== On-disk cache of operators ============================================
+#
+
+
+def operator_hash(key, grid):
+    ''' Hash of an operator key (see solver_key, it holds the digest of metric terms and mask)
+    and of grid and mask input files (name, size and modification time)
+
+    Parameters
+    ----------
+    key : tuple
+        operator key
+    grid : qgsolver grid object
+        grid data holder
+
+    Returns
+    -------
+    hash : str
+        hexadecimal digest
+    '''
+    stats = []
+    for f in [getattr(grid, 'hgrid_file', None), getattr(grid, 'vgrid_file', None),
+              getattr(grid, 'mask_file', None)]:
+        if f is not None and os.path.isfile(f):
+            st = os.stat(f)
+            stats.append((f, st.st_size, int(st.st_mtime)))
+    return hashlib.sha1(repr((key, stats)).encode()).hexdigest()
+
+
+def load_operator(L, filename, hash, comm):
+    ''' Load an operator from filename.dat (petsc binary format) if filename.hash holds hash
+
+    Parameters
+    ----------
+    L : petsc Mat
+        operator created by the DMDA (da.createMat())
+    filename : str
+        file name without extension
+    hash : str
+        hash of the inputs, see operator_hash
+    comm : petsc Comm
+        communicator
+
+    Returns
+    -------
+    loaded : boolean
+        True if the operator has been loaded
+    '''
+    mpicomm = comm.tompi4py()
+    match = False
+    if mpicomm.Get_rank() == 0 and os.path.isfile(filename+'.dat'):
+        try:
+            with open(filename+'.hash') as f:
+                match = (f.read().strip() == hash)
+        except IOError:
+            match = False
+    match = mpicomm.bcast(match, root=0)
+    if match:
+        viewer = PETSc.Viewer().createBinary(filename+'.dat', mode='r', comm=comm)
+        L.load(viewer)
+        viewer.destroy()
+    return match
+
+
+def save_operator(L, filename, hash, comm):
+    ''' Store an operator in filename.dat (petsc binary format) and the hash of the inputs
+    in filename.hash
+
+    Parameters
+    ----------
+    L : petsc Mat
+        assembled operator
+    filename : str
+        file name without extension
+    hash : str
+        hash of the inputs, see operator_hash
+    comm : petsc Comm
+        communicator
+    '''
+    mpicomm = comm.tompi4py()
+    # the hash is written last: an interrupted write is not loaded
+    if mpicomm.Get_rank() == 0 and os.path.isfile(filename+'.hash'):
+        os.remove(filename+'.hash')
+    viewer = PETSc.Viewer().createBinary(filename+'.dat', mode='w', comm=comm)
+    L.view(viewer)
+    viewer.destroy()
+    if mpicomm.Get_rank() == 0:
+        with open(filename+'.hash', 'w') as f:
+            f.write(hash)
+    mpicomm.barrier()
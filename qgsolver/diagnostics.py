@@ -0,0 +1,93 @@
+#!/usr/bin/python
+# -*- encoding: utf8 -*-
+
+
+from .inout import write_nc
+
+#
+#==================== Diagnostics hooks ============================================
+#
+
+
+class diagnostics():
+    ''' Callbacks registered on named intermediate fields of a solver, e.g.:
+            omega.diagnostics.register('uv', nc_writer('uv.nc'))
+
+    Solvers hand fields over with fire at the points where they are computed. Nothing is
+    done when no callback is registered for a name, solvers thus do no extra work (and no
+    I/O) when diagnostics are not used. Callbacks are called on all processes and may be
+    collective (e.g. nc_writer): they must be registered identically on all processes.
+    '''
+
+    def __init__(self):
+        self._hooks = {}
+
+    def register(self, name, callback):
+        ''' Register a callback on a field
+
+        Parameters
+        ----------
+        name : str
+            name of the field, see the solver documentation
+        callback : function
+            called as callback(da, grid, **fields), fields are petsc Vec named after the
+            variables they hold, they must not be modified
+        '''
+        self._hooks.setdefault(name, []).append(callback)
+
+    def remove(self, name, callback=None):
+        ''' Remove a callback on a field, or all callbacks on the field if callback is None
+        '''
+        if callback is None:
+            self._hooks.pop(name, None)
+        elif name in self._hooks:
+            self._hooks[name].remove(callback)
+            if not self._hooks[name]:
+                del self._hooks[name]
+
+    def __contains__(self, name):
+        return name in self._hooks
+
+    def __bool__(self):
+        return bool(self._hooks)
+
+    def fire(self, name, da, grid, **fields):
+        ''' Call callbacks registered on a field
+
+        Parameters
+        ----------
+        name : str
+            name of the field
+        da : petsc DMDA
+            holds the petsc grid
+        grid : qgsolver grid object
+            grid data holder
+        fields : petsc Vec
+            vectors handed over to callbacks
+        '''
+        if name not in self._hooks:
+            return
+        for callback in self._hooks[name]:
+            callback(da, grid, **fields)
+
+
+def nc_writer(filename, parallel=False):
+    ''' Callback writing fields into a netcdf file (see inout.write_nc), the file is
+    overwritten at each call
+
+    Parameters
+    ----------
+    filename : str
+        output netcdf file
+    parallel : boolean, optional
+        if True, each process writes its tile collectively, see inout.write_nc
+
+    Returns
+    -------
+    callback : function
+        see diagnostics.register
+    '''
+    def callback(da, grid, **fields):
+        write_nc(list(fields.values()), list(fields.keys()), filename, da, grid,
+                 parallel=parallel)
+    return callback
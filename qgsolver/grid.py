@@ -3,6 +3,7 @@
 
 import sys
 import numpy as np
+from petsc4py import PETSc
 from .inout import read_nc, read_hgrid_dimensions
 # for curvilinear grids
 from netCDF4 import Dataset
@@ -212,21 +213,11 @@ class grid(object):
 
         """
 
-        # create a 3D vector containing metric terms
-        self.D = da.createGlobalVec()
+        # create a 2D vector containing metric terms
+        self._create_D(da)
         # load curvilinear metric terms
-        v = da.getVecArray(self.D)
-        v[:] = 0.
+        v = self.da2D.getVecArray(self.D)
         (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
-        # indexes along the third dimension of 
-        self._k_dxt = zs
-        self._k_dyt = zs+1
-        self._k_dxu = zs+2
-        self._k_dyu = zs+3
-        self._k_dxv = zs+4
-        self._k_dyv = zs+5
-        self._k_lon = zs+6
-        self._k_lat = zs+7
 
 
         # Initialize xt,yt,dxt,dyt
@@ -296,9 +287,93 @@ class grid(object):
 
             rootgrp.close()
         #
+        self._reset_local_D()
         comm = da.getComm()
         comm.barrier()
+
+    def _create_D(self, da):
+        """ Create the 2D DMDA (da2D) and vector (D) holding metric terms, coriolis parameter
+        and mask. Fields are dof of the DMDA, D[i, j, self._k_dxt] for example, and tiles are
+        those of the 3D DMDA.
+
+        Parameters
+        ----------
+        da : petsc DMDA
+            holds the 3D petsc grid
+
+        """
+        if hasattr(self, 'D'):
+            return
+        # indexes of fields
+        self._k_dxt = 0
+        self._k_dyt = 1
+        self._k_dxu = 2
+        self._k_dyu = 3
+        self._k_dxv = 4
+        self._k_dyv = 5
+        self._k_lon = 6
+        self._k_lat = 7
+        self._k_mask = 8
+        self._k_f = 9
+        #
+        Nx, Ny, _ = da.getSizes()
+        lx, ly, _ = da.getOwnershipRanges()
+        self.da2D = PETSc.DMDA().create(sizes=[Nx, Ny], dof=10,
+                                        proc_sizes=da.getProcSizes()[:2],
+                                        ownership_ranges=(lx, ly),
+                                        boundary_type=da.getBoundaryType()[:2],
+                                        stencil_width=da.getStencilWidth(), stencil_type='box')
+        self.D = self.da2D.createGlobalVec()
+        self.D.set(0.)
+        self._lD = None
+        # incremented when metric terms change, quantities derived from D may be cached
+        # against it
+        self._D_version = 0
+
+    def _reset_local_D(self):
+        """ Ghosted metric terms need to be updated (see get_local_D), quantities derived
+        from metric terms are outdated (see _D_version)
+        """
+        if self._lD is not None:
+            self._lD.destroy()
+            self._lD = None
+        self._D_version += 1
+
+    def get_local_D(self):
+        """ Ghosted metric terms, the halo exchange is carried out at the first call
+        after metric terms are loaded
+
+        Returns
+        -------
+        D : DMDA Vec array
+            ghosted metric terms, indexed with global indices D[i, j, self._k_dxt],
+            D[...] is the (x, y, field) ghosted array
+
+        """
+        if self._lD is None:
+            self._lD = self.da2D.createLocalVec()
+            self.da2D.globalToLocal(self.D, self._lD)
+        return self.da2D.getVecArray(self._lD)
     
+    def set_uniform_metric(self, da):
+        """ Set the constant metric terms of a uniform horizontal grid (dx, dy) in D, for
+        operators written for curvilinear grids. D is created if need be, other fields
+        (mask, coriolis parameter) are left unchanged.
+
+        Parameters
+        ----------
+        da : petsc DMDA
+            holds the 3D petsc grid
+
+        """
+        self._create_D(da)
+        D = self.da2D.getVecArray(self.D)
+        for k in [self._k_dxt, self._k_dxu, self._k_dxv]:
+            D[:, :, k] = self.dx
+        for k in [self._k_dyt, self._k_dyu, self._k_dyv]:
+            D[:, :, k] = self.dy
+        self._reset_local_D()
+
     def load_coriolis_parameter(self, coriolis_file, da):
         """ Load the Coriolis parameter
 
@@ -310,21 +385,21 @@ class grid(object):
             holds the petsc grid
 
         """
-        v = da.getVecArray(self.D)
+        self._create_D(da)
+        v = self.da2D.getVecArray(self.D)
         (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
-        # indexes along the third dimension 
-        self._k_f=zs+9
         # open and read netcdf file
         rootgrp = Dataset(coriolis_file, 'r')
         v[:, :, self._k_f] = np.transpose(rootgrp.variables['f'][ys+self.j0:ye+self.j0,xs+self.i0:xe+self.i0],(1,0))
         rootgrp.close()
         #
+        self._reset_local_D()
         comm=da.getComm()
         comm.barrier()
      
     def load_mask(self, mask_file, da, mask3D=False):
         """Load reference mask from metrics file
-        grid.D[grid._k_mask,:,:] will contain the mask
+        grid.D[:,:,grid._k_mask] will contain the mask
 
         Parameters
         ----------
@@ -336,16 +411,16 @@ class grid(object):
             flag for 3D masks, default is False
 
         """
+        self.mask_file = mask_file
         self.mask3D = mask3D
         if not mask3D:
-            v = da.getVecArray(self.D)
+            self._create_D(da)
+            v = self.da2D.getVecArray(self.D)
         else:
             self.mask3D = da.createGlobalVec()
             v = da.getVecArray(self.mask3D)
 
         (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
-        # index of the mask along the third dimension 
-        self._k_mask=zs+8
         if not mask3D:
             try:
                 # open the netcdf file and read the mask
@@ -376,6 +451,8 @@ class grid(object):
                 if self._verbose>0:
                     print('    The mask is 3D but no data was found')
         #
+        if not mask3D:
+            self._reset_local_D()
         comm=da.getComm()
         comm.barrier()
         pass   
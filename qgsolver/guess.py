@@ -0,0 +1,242 @@
+#!/usr/bin/python
+# -*- encoding: utf8 -*-
+
+
+import sys
+from collections import deque
+import numpy as np
+
+#
+#==================== Initial guess of Krylov solvers ============================================
+#
+
+
+class initial_guess():
+    ''' Initial guess of successive linear solves A x = b from previous solutions.
+
+    Kinds of initial guess:
+        'projection': projection of b onto the span of previous solutions (Fischer 1998),
+            the guess minimizes the residual norm over this span. Images A x of solutions are
+            kept orthonormal, the oldest basis vector is dropped once the basis is full
+        'extrapolation': Lagrange polynomial extrapolation in time of the last solutions,
+            solutions at identical times replace each other (e.g. RK stages 2 and 3)
+        'previous': x is left unchanged (previous solution in general), statistics only
+
+    Projection is the default: its guess is never worse than the best combination of the
+    stored solutions. Extrapolation only pays off when solutions form a smooth series at
+    equally spaced times, e.g. with a time step small compared to the time scales of the
+    flow; the stages of the time stepping are unequally spaced and the guess then saves few
+    iterations (about 20 out of 630 over the time stepping of dev/test_guess.py, against
+    300 for the projection).
+
+    Residuals are scaled by the inverse of the diagonal of A (Jacobi scaling): rows of the
+    operator have very different magnitudes (identity on boundaries, 1/dx**2 inside) and the
+    unscaled residual norm is dominated by boundary rows.
+
+    Iterations saved are estimated at each solve from the residual norms of the previous solution
+    and of the guess and from the mean convergence factor of the solve (see update).
+    '''
+
+    def __init__(self, A, x, kind='projection', size=3):
+        ''' Setup the initial guess
+
+        Parameters
+        ----------
+        A : petsc Mat
+            operator
+        x : petsc Vec
+            template of solution vectors
+        kind : str, optional
+            'projection' (default), 'extrapolation' or 'previous'
+        size : int, optional
+            number of solutions kept, default is 3 (extrapolation of order 2)
+        '''
+        if kind not in ['previous', 'extrapolation', 'projection']:
+            print('!Error: initial guess kind unknown: '+str(kind))
+            sys.exit()
+        self.kind = kind
+        self.size = size
+        self._A = A
+        # inverse of the diagonal of A, scaling of residuals
+        self._w = x.duplicate()
+        A.getDiagonal(self._w)
+        w = self._w.getArray()
+        w[w==0.] = 1.
+        w[:] = 1./np.abs(w)
+        self._b = x.duplicate()
+        # solutions and their scaled images by A (orthonormal for projection), times of solutions
+        self._X = deque(maxlen=size)
+        self._AX = deque(maxlen=size)
+        self._t = deque(maxlen=size)
+        # scaled image of the last solution, gives the residual of the previous solution
+        self._Ax = x.duplicate()
+        self._r = x.duplicate()
+        self._last = False
+        self._count = 0
+        # statistics
+        self.solves = 0
+        self.iterations = 0
+        self.saved = 0.
+        self._rnorm = None
+
+    def reset(self):
+        ''' Forget previous solutions, e.g. when the state is modified between solves
+        '''
+        for v in list(self._X)+list(self._AX):
+            v.destroy()
+        self._X.clear()
+        self._AX.clear()
+        self._t.clear()
+        self._last = False
+        self._rnorm = None
+
+    def destroy(self):
+        ''' Destroy petsc objects
+        '''
+        self.reset()
+        for v in [self._w, self._b, self._Ax, self._r]:
+            v.destroy()
+
+    def set(self, b, x, t=None):
+        ''' Set the initial guess of A x = b
+
+        Parameters
+        ----------
+        b : petsc Vec
+            right hand side
+        x : petsc Vec
+            initial guess, contains the previous solution on input
+        t : float, None, optional
+            time of the solution, the number of solves is used if None
+        '''
+        self._rnorm = None
+        if not self._last:
+            return
+        # scaled residual of the previous solution
+        self._b.pointwiseMult(b, self._w)
+        self._b.copy(self._r)
+        self._r.axpy(-1., self._Ax)
+        rnorm_prev = self._r.norm()
+        #
+        if self.kind == 'extrapolation':
+            t = self._get_time(t)
+            c = self._lagrange(list(self._t), t)
+            x.set(0.)
+            x.maxpy(c, list(self._X))
+            # residual of the guess
+            self._b.copy(self._r)
+            self._r.maxpy(-c, list(self._AX))
+            rnorm = self._r.norm()
+        elif self.kind == 'projection':
+            c = np.array(self._b.mDot(list(self._AX)))
+            x.set(0.)
+            x.maxpy(c, list(self._X))
+            # images are orthonormal: |b - AX.c|^2 = |b|^2 - |c|^2
+            rnorm = np.sqrt(max(self._b.norm()**2 - np.sum(c**2), 0.))
+        else:
+            rnorm = rnorm_prev
+        self._rnorm = (rnorm_prev, rnorm)
+
+    def update(self, x, niter, ksp=None, t=None):
+        ''' Store the solution of A x = b and update statistics
+
+        Parameters
+        ----------
+        x : petsc Vec
+            solution
+        niter : int
+            number of iterations of the solve
+        ksp : petsc KSP, None, optional
+            solver, its residual history gives the convergence factor used to estimate
+            iterations saved
+        t : float, None, optional
+            time of the solution, the number of solves is used if None
+        '''
+        t = self._get_time(t)
+        self._count += 1
+        self.solves += 1
+        self.iterations += niter
+        if self._rnorm is not None and ksp is not None and niter > 0:
+            self.saved += self._estimate_saved(ksp, niter, *self._rnorm)
+        #
+        self._A.mult(x, self._Ax)
+        self._Ax.pointwiseMult(self._Ax, self._w)
+        self._last = True
+        if self.kind == 'extrapolation':
+            if len(self._t) > 0 and self._t[-1] == t:
+                # identical times: replace the last solution
+                X, AX = self._X.pop(), self._AX.pop()
+                self._t.pop()
+            elif len(self._X) == self.size:
+                X, AX = self._X.popleft(), self._AX.popleft()
+                self._t.popleft()
+            else:
+                X, AX = x.duplicate(), x.duplicate()
+            x.copy(X)
+            self._Ax.copy(AX)
+            self._X.append(X)
+            self._AX.append(AX)
+            self._t.append(t)
+        elif self.kind == 'projection':
+            if len(self._X) == self.size:
+                # drop the oldest vector, remaining images are still orthonormal
+                X, AX = self._X.popleft(), self._AX.popleft()
+            else:
+                X, AX = x.duplicate(), x.duplicate()
+            x.copy(X)
+            self._Ax.copy(AX)
+            # Gram-Schmidt orthogonalization of images, applied to solutions as well
+            if len(self._AX) > 0:
+                c = np.array(AX.mDot(list(self._AX)))
+                AX.maxpy(-c, list(self._AX))
+                X.maxpy(-c, list(self._X))
+            norm = AX.norm()
+            if norm > 1.e-10*self._Ax.norm():
+                AX.scale(1./norm)
+                X.scale(1./norm)
+                self._X.append(X)
+                self._AX.append(AX)
+            else:
+                # solution lies in the span of previous ones
+                X.destroy()
+                AX.destroy()
+
+    def report(self):
+        ''' Summary of iterations
+
+        Returns
+        -------
+        summary : str
+        '''
+        if self.solves == 0:
+            return 'initial guess ('+self.kind+'): no solve'
+        return 'initial guess (%s): %i solves, %.1f iterations per solve, %.1f iterations saved per solve (estimate)' \
+               %(self.kind, self.solves, float(self.iterations)/self.solves, self.saved/self.solves)
+
+    def _get_time(self, t):
+        if t is None:
+            return float(self._count)
+        return t
+
+    def _lagrange(self, ts, t):
+        ''' Coefficients of the Lagrange extrapolation to t from values at times ts
+        '''
+        c = np.ones(len(ts))
+        for i, ti in enumerate(ts):
+            for j, tj in enumerate(ts):
+                if j != i:
+                    c[i] *= (t-tj)/(ti-tj)
+        return c
+
+    def _estimate_saved(self, ksp, niter, rnorm_prev, rnorm):
+        ''' Iterations needed to reduce the residual norm of the previous solution to that of
+        the guess, given the mean convergence factor of the solve
+        '''
+        history = ksp.getConvergenceHistory()
+        if len(history) < 2 or history[0] == 0. or history[-1] == 0. or rnorm == 0. \
+           or rnorm_prev == 0.:
+            return 0.
+        rate = np.log(history[0]/history[-1])/niter
+        if rate <= 0.:
+            return 0.
+        return np.log(rnorm_prev/rnorm)/rate
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+# -*- encoding: utf8 -*-
+
+
+from petsc4py import PETSc
+
+#
+#==================== Fused halo exchange ============================================
+#
+
+
+class halo_exchange():
+    ''' Halo exchange of several fields of a DMDA in a single scatter.
+
+    Fields are packed as degrees of freedom of a duplicate of the DMDA (same ownership ranges,
+    stencil type and width), so that ghost points of all fields travel in one message per
+    neighbour. The exchange is split into begin and end phases in order to overlap
+    communications with computations over the tile interior.
+    '''
+
+    def __init__(self, da, nfields):
+        ''' Setup the multi-field DMDA and the scatter
+
+        Parameters
+        ----------
+        da : petsc DMDA
+            holds the petsc grid
+        nfields : int
+            number of fields exchanged together
+        '''
+        self.nfields = nfields
+        self.da = da.duplicate(dof=nfields)
+        self._G = self.da.createGlobalVec()
+        self._L = self.da.createLocalVec()
+        # global indices of the points of the ghosted local vector
+        idx = PETSc.IS().createGeneral(self.da.getLGMap().getIndices(), comm=PETSc.COMM_SELF)
+        self._scatter = PETSc.Scatter().create(self._G, idx, self._L, None)
+        idx.destroy()
+        self._started = False
+
+    def begin(self, da, *V):
+        ''' Pack fields and start the exchange
+
+        Parameters
+        ----------
+        da : petsc DMDA
+            holds the petsc grid of fields
+        V : petsc Vec
+            global vectors of the fields, nfields of them
+        '''
+        G = self._fields(self.da.getVecArray(self._G)[...])
+        for f, v in enumerate(V):
+            G[..., f] = da.getVecArray(v)[...]
+        self._scatter.begin(self._G, self._L, PETSc.InsertMode.INSERT_VALUES,
+                            PETSc.ScatterMode.FORWARD)
+        self._started = True
+
+    def end(self):
+        ''' Complete the exchange
+
+        Returns
+        -------
+        fields : list of ndarray
+            ghosted (x, y, z) arrays of the fields, views of the local vector that are
+            valid until the next exchange
+        '''
+        if self._started:
+            self._scatter.end(self._G, self._L, PETSc.InsertMode.INSERT_VALUES,
+                              PETSc.ScatterMode.FORWARD)
+            self._started = False
+        L = self._fields(self.da.getVecArray(self._L)[...])
+        return [L[..., f] for f in range(self.nfields)]
+
+    def _fields(self, a):
+        ''' Arrays of vectors with a single degree of freedom have no field axis
+        '''
+        return a[..., None] if self.nfields == 1 else a
+
+    def exchange(self, da, *V):
+        ''' Exchange ghost points of fields, see begin and end
+        '''
+        self.begin(da, *V)
+        return self.end()
+
+    def destroy(self):
+        ''' Destroy petsc objects
+        '''
+        self._scatter.destroy()
+        self._G.destroy()
+        self._L.destroy()
+        self.da.destroy()
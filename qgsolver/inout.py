@@ -2,6 +2,7 @@
 # -*- encoding: utf8 -*-
 
 import sys, os
+import threading
 from petsc4py import PETSc
 
 import numpy as np
@@ -13,7 +14,7 @@ import netCDF4
 #
 
 
-def write_nc(V, vname, filename, da, grid, append=False):
+def write_nc(V, vname, filename, da, grid, append=False, parallel=False):
     """ Write a variable to a netcdf file
 
     Parameters
@@ -32,6 +33,10 @@ def write_nc(V, vname, filename, da, grid, append=False):
     append: boolean
         append data to an existing file if True, create new file otherwise
         default is False
+    parallel: boolean
+        if True, each process writes its tile collectively in the same file (netcdf4 library
+        with parallel hdf5 and mpi4py are required), variables are gathered on rank 0 and
+        written by rank 0 otherwise. Default is False
 
     """
 
@@ -39,42 +44,25 @@ def write_nc(V, vname, filename, da, grid, append=False):
     Nv=len(vname)
     # process rank
     rank = da.getComm().getRank()
-    #
-    if grid.mask:
-        # get global mask for rank 0 (None for other proc)
-        global_D = get_global(grid.D, da, rank)
 
     # test file existence
     if not os.path.isfile(filename):
         append=False 
 
-    if rank == 0 and not append:
+    if parallel and has_parallel_nc(da):
+        _write_nc_parallel(V, vname, filename, da, grid, append)
+        return
+    elif parallel and rank == 0:
+        print('Warning: parallel netcdf is not available, '+filename+' is written by rank 0')
 
-        # create a netcdf file to store QG pv for inversion
-        rootgrp = Dataset(filename, 'w',
-                          format='NETCDF4_CLASSIC', clobber=True)
+    #
+    if grid.mask:
+        # get global mask for rank 0 (None for other proc)
+        global_D = get_global(grid.D, grid.da2D, rank)
 
-        # create dimensions
-        rootgrp.createDimension('x', grid.Nx)
-        rootgrp.createDimension('y', grid.Ny)
-        rootgrp.createDimension('z', grid.Nz)
-        rootgrp.createDimension('t', None)
-        
-        # create variables
-        dtype='f8'
-        nc_x = rootgrp.createVariable('x',dtype,('x'))
-        nc_y = rootgrp.createVariable('y',dtype,('y'))
-        nc_z = rootgrp.createVariable('z',dtype,('z'))
-        #
-        nc_x[:], nc_y[:], nc_z[:] = grid.get_xyz()
-        if grid.mask:
-            # 2D mask
-            nc_mask = rootgrp.createVariable('mask',dtype,('y','x'))
-            nc_mask[:]= global_D[grid._k_mask,:,:]
-        # 3D variables
-        nc_V=[]
-        for name in vname:
-            nc_V.append(rootgrp.createVariable(name,dtype,('t','z','y','x',)))
+    if rank == 0 and not append:
+        # create a netcdf file
+        rootgrp, nc_V = _create_nc(filename, vname, grid, global_D if grid.mask else None)
     #
     elif rank == 0:
         # open netcdf file
@@ -100,11 +88,340 @@ def write_nc(V, vname, filename, da, grid, append=False):
         rootgrp.close()
 
 
+def has_parallel_nc(da):
+    """ Test whether netcdf files can be written in parallel: netcdf4 library with parallel hdf5
+    and mpi4py
+
+    Parameters
+    ----------
+    da : petsc DMDA
+        holds the petsc grid
+
+    Returns
+    -------
+    parallel : boolean
+    """
+    if not getattr(netCDF4, '__has_parallel4_support__', False):
+        return False
+    try:
+        da.getComm().tompi4py()
+    except ImportError:
+        return False
+    return True
+
+
+def _write_nc_parallel(V, vname, filename, da, grid, append):
+    """ Write variables to a netcdf file, each process writes its tile collectively,
+    see write_nc for parameters
+    """
+    (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
+    if not append:
+        rootgrp, nc_V = _create_nc(filename, vname, grid, da=da)
+        it = 0
+    else:
+        rootgrp = Dataset(filename, 'a', format='NETCDF4_CLASSIC', parallel=True,
+                          comm=da.getComm().tompi4py())
+        nc_V = [rootgrp.variables[name] for name in vname]
+        it = nc_V[0].shape[0]
+    for i in range(len(vname)):
+        # collective writes are required along the unlimited dimension
+        nc_V[i].set_collective(True)
+        nc_V[i][it, zs:ze, ys:ye, xs:xe] = da.getVecArray(V[i])[...].transpose(2, 1, 0)
+    rootgrp.close()
+
+
+def _create_nc(filename, vname, grid, global_D=None, da=None, record_dim='t'):
+    """ Create a netcdf file with grid coordinates, mask and (t, z, y, x) variables
+
+    Parameters
+    ----------
+    filename : str
+        netcdf output filename
+    vname : list of str
+        names of the 3D variables
+    grid : qgsolver grid object
+        grid data holder
+    global_D : ndarray, None, optional
+        global metric terms, the mask is stored if not None (serial file)
+    da : petsc DMDA, None, optional
+        if not None, the file is created in parallel on all processes of the DMDA, which write
+        the mask over their tile
+    record_dim : str, optional
+        name of the unlimited record dimension, default is 't'. A coordinate variable of the
+        same name is created if it is not 't'
+
+    Returns
+    -------
+    rootgrp : netCDF4 Dataset
+        opened file
+    nc_V : list of netCDF4 Variable
+        3D variables
+    """
+    # create a netcdf file to store QG pv for inversion
+    if da is None:
+        rootgrp = Dataset(filename, 'w',
+                          format='NETCDF4_CLASSIC', clobber=True)
+    else:
+        rootgrp = Dataset(filename, 'w',
+                          format='NETCDF4_CLASSIC', clobber=True,
+                          parallel=True, comm=da.getComm().tompi4py())
+
+    # create dimensions
+    rootgrp.createDimension('x', grid.Nx)
+    rootgrp.createDimension('y', grid.Ny)
+    rootgrp.createDimension('z', grid.Nz)
+    rootgrp.createDimension(record_dim, None)
+
+    # create variables
+    dtype='f8'
+    nc_x = rootgrp.createVariable('x',dtype,('x'))
+    nc_y = rootgrp.createVariable('y',dtype,('y'))
+    nc_z = rootgrp.createVariable('z',dtype,('z'))
+    #
+    nc_x[:], nc_y[:], nc_z[:] = grid.get_xyz()
+    if record_dim != 't':
+        rootgrp.createVariable(record_dim,dtype,(record_dim))
+    if global_D is not None:
+        # 2D mask
+        nc_mask = rootgrp.createVariable('mask',dtype,('y','x'))
+        nc_mask[:]= global_D[:,:,grid._k_mask]
+    elif da is not None and grid.mask:
+        # 2D mask, tile of each process
+        (xs, xe), (ys, ye), _ = da.getRanges()
+        nc_mask = rootgrp.createVariable('mask',dtype,('y','x'))
+        nc_mask[ys:ye, xs:xe] = grid.da2D.getVecArray(grid.D)[xs:xe, ys:ye, grid._k_mask].T
+    # 3D variables
+    nc_V=[]
+    for name in vname:
+        nc_V.append(rootgrp.createVariable(name,dtype,(record_dim,'z','y','x',)))
+    return rootgrp, nc_V
+
+
+#
+#==================== Time records ============================================
+#
+
+# netcdf/hdf5 calls of the background reader and of writers are serialized,
+# hdf5 is in general not thread safe
+_nc_lock = threading.Lock()
+
+
+class record_reader():
+    ''' Read the time records of variables of a netcdf file over the tile of each process.
+    The file is opened once and the next record may be read in a background thread.
+
+    The thread only runs while the main thread releases the python GIL: netcdf calls do,
+    petsc solves do not, so the read of the next record does not overlap a solve. Errors
+    of the background read are raised by the read of that record.
+    '''
+
+    def __init__(self, filename, vnames, da, grid, fillmask=None, prefetch=True):
+        """ Open the file
+
+        Parameters
+        ----------
+        filename : str
+            netcdf input filename
+        vnames : list of str
+            names of (t, z, y, x) variables
+        da : petsc DMDA
+            holds the petsc grid
+        grid : qgsolver grid object
+            grid data holder
+        fillmask : float, optional
+            value that will replace the default netCDF fill value for NaNs
+            default is None
+        prefetch : boolean, optional
+            read the next record in a background thread, default is True
+            (see test_records.py for timings with and without prefetch)
+        """
+        if not os.path.isfile(filename):
+            print('Error: read '+str(vnames)+': '+filename+' does not exist. Program will stop.')
+            sys.exit()
+        self.vnames = vnames
+        self.fillmask = fillmask
+        self._da = da
+        (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
+        self._lsl = (slice(xs, xe), slice(ys, ye), slice(zs, ze))
+        self._nsl = (slice(zs+grid.k0, ze+grid.k0), slice(ys+grid.j0, ye+grid.j0),
+                     slice(xs+grid.i0, xe+grid.i0))
+        self._rootgrp = Dataset(filename, 'r')
+        self.nt = self._rootgrp.variables[vnames[0]].shape[0]
+        # record being read in the background
+        self._next = None
+        self._prefetch = prefetch
+
+    def __len__(self):
+        return self.nt
+
+    def read(self, it, V, it_next=None):
+        """ Read a record into petsc vectors and start reading the next one
+
+        Parameters
+        ----------
+        it : int
+            time index
+        V : list of petsc Vec
+            vectors of variables vnames
+        it_next : int, None, optional
+            time index read in the background, it+1 by default (if in the file)
+        """
+        if self._next is not None and self._next[0] == it:
+            _, thread, vread, error = self._next
+            self._next = None
+            thread.join()
+            if error:
+                raise error[0]
+        else:
+            self._join()
+            vread = self._read(it)
+        if len(vread) != len(self.vnames):
+            raise RuntimeError('record %i: %i variables read out of %i' \
+                               %(it, len(vread), len(self.vnames)))
+        #
+        if it_next is None and it+1 < self.nt:
+            it_next = it+1
+        if it_next is not None and self._prefetch:
+            self._start(it_next)
+        for v, a in zip(V, vread):
+            self._da.getVecArray(v)[self._lsl] = a.transpose(2, 1, 0)
+
+    def close(self):
+        """ Wait for the reader thread and close the file
+        """
+        self._join()
+        self._rootgrp.close()
+
+    def _join(self):
+        """ Wait for the reader thread, the record it reads is discarded
+        """
+        if self._next is not None:
+            self._next[1].join()
+            self._next = None
+
+    def _start(self, it):
+        """ Read record it in a background thread, an exception is stored in error
+        """
+        vread, error = [], []
+        thread = threading.Thread(target=self._read, args=(it, vread, error))
+        thread.daemon = True
+        self._next = (it, thread, vread, error)
+        thread.start()
+
+    def _read(self, it, vread=None, error=None):
+        """ Read record it over the tile, arrays are (z, y, x). Exceptions are appended to
+        error if given (background read) and raised otherwise
+        """
+        if vread is None:
+            vread = []
+        try:
+            for name in self.vnames:
+                # the lock is held by variable, writers are not blocked by the whole record
+                with _nc_lock:
+                    a = self._rootgrp.variables[name][(it,)+self._nsl]
+                # replace the default fill value of netCDF by the input fillmask value
+                if self.fillmask is not None:
+                    a = np.ma.masked_values(a, netCDF4.default_fillvals['f8'])
+                    a = a.filled(fill_value=self.fillmask)
+                vread.append(np.ma.getdata(a))
+        except Exception as e:
+            if error is None:
+                raise
+            error.append(e)
+        return vread
+
+
+class record_writer():
+    ''' Write time records of variables to a netcdf file that is kept open, by rank 0 or by
+    all processes in parallel (see write_nc)
+    '''
+
+    def __init__(self, filename, vnames, da, grid, parallel=False, record_dim='t'):
+        """ Create the file
+
+        Parameters
+        ----------
+        filename : str
+            netcdf output filename
+        vnames : list of str
+            names of the 3D variables
+        da : petsc DMDA
+            holds the petsc grid
+        grid : qgsolver grid object
+            grid data holder
+        parallel : boolean, optional
+            if True, each process writes its tile collectively, default is False
+        record_dim : str, optional
+            name of the record dimension, default is 't'. Values of other record dimensions
+            (e.g. 'K') are stored in a coordinate variable (see write)
+        """
+        self._da = da
+        self._rank = da.getComm().getRank()
+        self.parallel = parallel and has_parallel_nc(da)
+        if parallel and not self.parallel and self._rank == 0:
+            print('Warning: parallel netcdf is not available, '+filename+' is written by rank 0')
+        if self.parallel:
+            with _nc_lock:
+                self._rootgrp, self._nc_V = _create_nc(filename, vnames, grid, da=da,
+                                                       record_dim=record_dim)
+            for v in self._nc_V:
+                v.set_collective(True)
+        else:
+            global_D = None
+            if grid.mask:
+                global_D = get_global(grid.D, grid.da2D, self._rank)
+            if self._rank == 0:
+                with _nc_lock:
+                    self._rootgrp, self._nc_V = _create_nc(filename, vnames, grid, global_D,
+                                                           record_dim=record_dim)
+        # coordinate of the record dimension
+        self._nc_r = None
+        if (self.parallel or self._rank == 0) and record_dim != 't':
+            self._nc_r = self._rootgrp.variables[record_dim]
+            if self.parallel:
+                self._nc_r.set_collective(True)
+        self.it = 0
+
+    def write(self, V, value=None):
+        """ Append a record
+
+        Parameters
+        ----------
+        V : list of petsc Vec
+            vectors of variables vnames
+        value : float, None, optional
+            value of the record coordinate, if the record dimension is not 't'
+        """
+        if value is not None and self._nc_r is not None:
+            with _nc_lock:
+                self._nc_r[self.it] = value
+        if self.parallel:
+            (xs, xe), (ys, ye), (zs, ze) = self._da.getRanges()
+            with _nc_lock:
+                for i, v in enumerate(V):
+                    self._nc_V[i][self.it, zs:ze, ys:ye, xs:xe] = \
+                        self._da.getVecArray(v)[...].transpose(2, 1, 0)
+        else:
+            for i, v in enumerate(V):
+                vglobal = get_global(v, self._da, self._rank)
+                if self._rank == 0:
+                    with _nc_lock:
+                        self._nc_V[i][self.it, ...] = vglobal
+        self.it += 1
+
+    def close(self):
+        """ Close the file
+        """
+        if self._rank == 0 or self.parallel:
+            with _nc_lock:
+                self._rootgrp.close()
+
+
 #
 #==================== read data ============================================
 #
 
-def read_nc_petsc(V, vname, filename, da, grid, fillmask=None):
+def read_nc_petsc(V, vname, filename, da, grid, fillmask=None, it=None):
     """
     Read a variable from a netcdf file and stores it in a petsc Vector
 
@@ -123,6 +440,9 @@ def read_nc_petsc(V, vname, filename, da, grid, fillmask=None):
     fillmask : float, optional
         value that will replace the default netCDF fill value for NaNs
         default is None
+    it : int, None, optional
+        time index of 4D variables, the last one if None (see record_reader to read
+        all time records)
 
     """
     (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
@@ -142,7 +462,9 @@ def read_nc_petsc(V, vname, filename, da, grid, fillmask=None):
         # line above does not work for early versions of netcdf4 python library
         # print netCDF4.__version__  1.1.1 has a bug and one cannot call -1 for last index:
         # https://github.com/Unidata/netcdf4-python/issues/306
-            vread = rootgrp.variables[vname][rootgrp.variables[vname].shape[0]-1,kdown:kup,jstart:jend,istart:iend]
+            if it is None:
+                it = rootgrp.variables[vname].shape[0]-1
+            vread = rootgrp.variables[vname][it,kdown:kup,jstart:jend,istart:iend]
         else:
             vread = rootgrp.variables[vname][kdown:kup,jstart:jend,istart:iend]        
         #vread = rootgrp.variables[vname][kdown:kup,jstart:jend,istart:iend]
@@ -294,7 +616,7 @@ def get_global(V, da, rank):
     Returns
     -------
     Vf : ndarray
-        Copyt of the global array
+        Copyt of the global array, (z, y, x) or (y, x, dof) for 2D DMDAs with several dof
 
     """    
     Vn = da.createNaturalVec()
@@ -303,7 +625,10 @@ def get_global(V, da, rank):
     scatter.scatter(Vn, Vn0, False, PETSc.Scatter.Mode.FORWARD)
     #
     if rank == 0:
-        Vf = Vn0[...].reshape(da.sizes[::-1], order='c')
+        shape = tuple(da.sizes[::-1])
+        if da.getDof() > 1:
+            shape += (da.getDof(),)
+        Vf = Vn0[...].reshape(shape, order='c')
     else:
         Vf = None
     1
@@ -2,10 +2,14 @@
 # -*- encoding: utf8 -*-
 
 
+import os
 import sys
+import numpy as np
 from petsc4py import PETSc
-from .inout import write_nc
-from .utils import g, rho0
+from .diagnostics import diagnostics
+from .halo import halo_exchange
+from .utils import g, rho0, _shift
+from .cache import solvers, solver_key, operator_hash, load_operator, save_operator
 
 #
 #==================== Parallel solver ============================================
@@ -15,7 +19,8 @@ class omegainv():
     """ Omega equation solver
     """
 
-    def __init__(self, da, grid, bdy_type, f0, N2, verbose=0, solver='gmres', pc=None):
+    def __init__(self, da, grid, bdy_type, f0, N2, verbose=0, solver='gmres', pc=None, cache=False,
+                 operator_dir=None):
         """ Setup the Omega equation solver
 
         Parameters
@@ -41,6 +46,14 @@ class omegainv():
         pc : str, optional
             what is default?
             preconditionner: 'icc', 'bjacobi', 'asm', 'mg', 'none'
+        cache : boolean, optional
+            if True, the operator and solver are shared with other omega inversion objects with
+            identical grid, stratification, boundary conditions and tiling
+            (see cache.solvers and release), default is False
+        operator_dir : str, optional
+            directory where the assembled operator is stored (omegainv_L.dat, petsc binary format)
+            along with a hash of the inputs (omegainv_L.hash). It is loaded instead of being
+            assembled if hashes match.
 
         """
 
@@ -55,26 +68,69 @@ class omegainv():
         self.f0 = f0
         self.N2 = N2
 
+        #
+        if self._verbose>0:
+            print('An Omega equation inversion object is being created')
+
+        # operator and solver, possibly shared with other omega inversion objects
+        self._cache_entry = None
+        if cache:
+            key = solver_key('omegainv', da, grid, self.bdy_type, f0=f0, N2=N2, solver=solver, pc=pc)
+            self._cache_entry = solvers.acquire(key)
+        if self._cache_entry is not None:
+            self.__dict__.update(self._cache_entry.objects)
+            if self._verbose>0:
+                print('  Operator L and solver retrieved from cache')
+        else:
+            self._create_solver(da, grid, solver, pc, operator_dir)
+            if cache:
+                self._cache_entry = solvers.add(key, {'L': self.L, 'ksp': self.ksp})
+
+        # global vector for Omega equation inversion
+        self._RHS = da.createGlobalVec()
+        # work vectors of the RHS, allocated once and reused across inversions
+        self._U, self._V, self._RHO, self._QXU, self._QYV = [da.createGlobalVec() for _ in range(5)]
+        # intermediate fields of set_rhs: 'uv' (u, v), 'rho' (rho), 'Q' (qxu, qyv) and 'rhs' (rhs)
+        self.diagnostics = diagnostics()
+        # ghost points of PSI, of U,V,RHO and of the Q vector, these are exchanged together
+        self._halo_PSI = halo_exchange(da, 1)
+        self._halo = halo_exchange(da, 3)
+        self._halo_Q = halo_exchange(da, 2)
+
+        if self._verbose>0:
+            print('  Omega equation inversion is set up')
+
+    def _create_solver(self, da, grid, solver, pc, operator_dir):
+        """ Create the operator and the solver, see __init__ for parameters
+        """
+
         # create the operator
         self.L = da.createMat()
         #
         if self._verbose>0:
-            print('An Omega equation inversion object is being created')
             print('  Operator L declared')
 
-        # Fill in operator values
-        if grid._flag_hgrid_uniform and grid._flag_vgrid_uniform:
-            self._set_L(self.L, da, grid)
-        else:
-            self._set_L_curv(self.L, da, grid)
+        # Fill in operator values, assembled operators may be stored in operator_dir
+        loaded = False
+        if operator_dir is not None:
+            filename = os.path.join(operator_dir, 'omegainv_L')
+            hash = operator_hash(solver_key('omegainv', da, grid, self.bdy_type,
+                                            f0=self.f0, N2=self.N2), grid)
+            loaded = load_operator(self.L, filename, hash, da.getComm())
+            if loaded and self._verbose>0:
+                print('  Operator L loaded from '+filename+'.dat')
+        if not loaded:
+            if grid._flag_hgrid_uniform and grid._flag_vgrid_uniform:
+                self._set_L(self.L, da, grid)
+            else:
+                self._set_L_curv(self.L, da, grid)
+            if operator_dir is not None:
+                save_operator(self.L, filename, hash, da.getComm())
 
         #
         if self._verbose>0:
             print('  Operator L filled')
 
-        # global vector for Omega equation inversion
-        self._RHS = da.createGlobalVec()
-
         # create solver
         self.ksp = PETSc.KSP()
         self.ksp.create(PETSc.COMM_WORLD)
@@ -92,15 +148,29 @@ class omegainv():
         for opt in sys.argv[1:]:
             PETSc.Options().setValue(opt, None)
         self.ksp.setFromOptions()
-        
-        if self._verbose>0:
-            print('  Omega equation inversion is set up')
+
+    def release(self):
+        """ Release the operator and solver: objects shared through the cache (see cache.solvers)
+        are destroyed once released by all users and evicted
+        """
+        if self._cache_entry is not None:
+            solvers.release(self._cache_entry)
+            self._cache_entry = None
+        else:
+            self.ksp.destroy()
+            self.L.destroy()
+        for V in [self._U, self._V, self._RHO, self._QXU, self._QYV]:
+            V.destroy()
+        self._halo_PSI.destroy()
+        self._halo.destroy()
+        self._halo_Q.destroy()
 
 #
 # ==================== perform inversion ===================================
 #
 
-    def solve(self, da, grid, state, W=None, PSI=None, U=None, V=None, RHO=None):
+    def solve(self, da, grid, state, W=None, PSI=None, U=None, V=None, RHO=None, guess=False,
+              numit=False):
         """ Compute the omega equation inversion
         The result of the inversion is held in state.W
 
@@ -118,13 +188,18 @@ class omegainv():
             streamfunction, use state.PSI if None
         U, V, RHO : petsc Vec, None, optional
             vectors used for computations of the Q vector
+        guess : boolean, optional
+            if True, state.W (e.g. the solution of the previous snapshot) is the initial guess
+            of the inversion, default is False (zero initial guess)
+        numit : boolean, optional
+            if True, returns the number of iterations
 
         """
 
+        if not hasattr(state,'W'):
+            state.W = da.createGlobalVec()
+            state.W.set(0.)
         if W is None:
-            if not hasattr(state,'W'):
-                state.W = da.createGlobalVec()
-                state.W.set(0.)
             W = state.W
 
         if PSI is None:
@@ -134,12 +209,14 @@ class omegainv():
         self.set_rhs(da, grid, W, PSI, U, V, RHO)
 
         # actually solves the pb
+        self.ksp.setInitialGuessNonzero(guess)
         self.ksp.solve(self._RHS, state.W)
-
-        # should destroy: self._U, self._V, self._RHO
+        niter = self.ksp.getIterationNumber()
 
         if self._verbose>0:
-            print('Omega equation solved (%i iterations)' %(self.ksp.getIterationNumber()))
+            print('Omega equation solved (%i iterations)' %(niter))
+        if numit:
+            return niter
 
 #
 # ==================== utils methods for inversions ===================================
@@ -167,34 +244,37 @@ class omegainv():
 
         """
 
+        # ghost points of PSI are loaded once for u/v and rho
+        if U is None or V is None or RHO is None:
+            psi = self._get_local_psi(da, PSI)
+
         # get u/v
         if U is None or V is None:
             # Initialize u=-dpsidy and v=dpsidx
-            self.set_uv_from_psi(da, grid, PSI)
-        else:
-            self._U = U
-            self._V = V
-        write_nc([self._U,self._V], ['u','v'], '../output/uv.nc', da, grid)
+            self._set_uv(da, grid, psi)
+            U, V = self._U, self._V
+        self.diagnostics.fire('uv', da, grid, u=U, v=V)
 
         # get rho
         if RHO is None:
             # Initialize rho=-f0/g dpsidz
-            self.set_rho_from_psi(da, grid, PSI)
-        else:
-            self._RHO = RHO
-        write_nc([self._RHO], ['rho'], '../output/rho.nc', da, grid)
+            self._set_rho(da, grid, psi)
+            RHO = self._RHO
+        self.diagnostics.fire('rho', da, grid, rho=RHO)
 
         # Initialize jacobian
-        self.set_Q(da, grid)
+        self.set_Q(da, grid, U, V, RHO)
+        self.diagnostics.fire('Q', da, grid, qxu=self._QXU, qyv=self._QYV)
 
         # compute Q vector divergence
         self.compute_divQ(da, grid)
 
         # fix boundaries
-        self.set_rhs_bdy(da, grid, W)
+        self._set_rhs_bdy(da, grid, W)
 
         # mask rhs
-        self.set_rhs_mask(da, grid, W)
+        self._set_rhs_mask(da, grid, W)
+        self.diagnostics.fire('rhs', da, grid, rhs=self._RHS)
 
     def set_uv_from_psi(self, da, grid, PSI):
         """ Compute U & V from Psi:
@@ -210,46 +290,7 @@ class omegainv():
             streamfunction
 
         """
-
-        # create global vectors
-        self._U = da.createGlobalVec()
-        self._V = da.createGlobalVec()
-
-        # create local vectors
-        local_PSI  = da.createLocalVec()
-        local_D = da.createLocalVec()
-
-        # load vector PSI used to compute U and V
-        da.globalToLocal(PSI, local_PSI)
-        da.globalToLocal(grid.D, local_D)
-
-        #
-        u = da.getVecArray(self._U)
-        v = da.getVecArray(self._V)
-        psi = da.getVecArray(local_PSI)
-        D = da.getVecArray(local_D)
-
-        mx, my, mz = da.getSizes()
-        (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
-
-        kdyu = grid._k_dyu
-        kdxv = grid._k_dxv
-
-        # set u=-dpsidy and v=dpsidx
-        for k in range(zs,ze):
-            for j in range(ys, ye):
-                for i in range(xs, xe): 
-                    if (i==0 or j==0 or i==mx-1 or j==my-1):
-                        # lateral boundaries
-                        u[i, j, k] = 0.
-                        v[i, j, k] = 0.
-                    else:
-                        u[i,j,k] = - 1. /D[i,j,kdyu] * \
-                             ( 0.25*(psi[i+1,j,k]+psi[i+1,j+1,k]+psi[i,j+1,k]+psi[i,j,k]) -
-                               0.25*(psi[i+1,j-1,k]+psi[i+1,j,k]+psi[i,j,k]+psi[i,j-1,k]) )
-                        v[i,j,k] =   1. /D[i,j,kdxv] * \
-                             ( 0.25*(psi[i+1,j,k]+psi[i+1,j+1,k]+psi[i,j+1,k]+psi[i,j,k]) -
-                               0.25*(psi[i,j,k]+psi[i,j+1,k]+psi[i-1,j+1,k]+psi[i-1,j,k]) )
+        self._set_uv(da, grid, self._get_local_psi(da, PSI))
 
     def set_rho_from_psi(self, da, grid, PSI):
         """ Compute RHO from Psi
@@ -265,35 +306,56 @@ class omegainv():
             streamfunction
 
         """
-     
-        # declare local vectors
-        local_PSI  = da.createLocalVec()
+        self._set_rho(da, grid, self._get_local_psi(da, PSI))
 
-        # declare global vectors
-        self._RHO = da.createGlobalVec()
+    def _get_local_psi(self, da, PSI):
+        """ Exchange ghost points of PSI, returns the ghosted (x, y, z) array
+        """
+        return self._halo_PSI.exchange(da, PSI)[0]
 
-        # load vector PSI used to compute RHO
-        da.globalToLocal(PSI, local_PSI)
+    def _set_uv(self, da, grid, psi):
+        """ Compute U & V from the ghosted array psi, see set_uv_from_psi
+        """
 
-        #
-        psi = da.getVecArray(local_PSI)
-        rho = da.getVecArray(self._RHO)
+        u = da.getVecArray(self._U)[...]
+        v = da.getVecArray(self._V)[...]
+        D = grid.get_local_D()[...]
 
-        mx, my, mz = da.getSizes()
-        (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
+        kdyu = grid._k_dyu
+        kdxv = grid._k_dxv
 
+        # lateral boundaries
+        u[...] = 0.
+        v[...] = 0.
+        # set u=-dpsidy and v=dpsidx
+        sl, lsl = self._get_slices(da, lateral=True, vertical=False)
+        p = lambda di, dj: psi[_shift(sl, di, dj)]
+        dyu = D[sl[:2]+(kdyu,)][..., None]
+        dxv = D[sl[:2]+(kdxv,)][..., None]
+        u[lsl] = - 1. /dyu * \
+                 ( 0.25*(p(1,0)+p(1,1)+p(0,1)+p(0,0)) -
+                   0.25*(p(1,-1)+p(1,0)+p(0,0)+p(0,-1)) )
+        v[lsl] =   1. /dxv * \
+                 ( 0.25*(p(1,0)+p(1,1)+p(0,1)+p(0,0)) -
+                   0.25*(p(0,0)+p(0,1)+p(-1,1)+p(-1,0)) )
+
+    def _set_rho(self, da, grid, psi):
+        """ Compute RHO from the ghosted array psi, see set_rho_from_psi
+        """
+
+        rho = da.getVecArray(self._RHO)[...]
+
+        # top and bottom boundaries
+        rho[...] = 0.
         # set rho=-rho0*f0/g dpsidz
-        for k in range(zs,ze):
-            for j in range(ys, ye):
-                for i in range(xs, xe): 
-                    if (k==0 or k==mz-1):
-                        # top and bottom boundaries
-                        rho[i, j, k] = 0.
-                    else:
-                        rho[i,j,k] = - rho0*self.f0/g/grid.dzt[k] * \
-                                        ( 0.5*(psi[i,j,k+1]+psi[i,j,k]) -
-                                        0.5*(psi[i,j,k]+psi[i,j,k-1]) )
-   
+        sl, lsl = self._get_slices(da, lateral=False, vertical=True)
+        p = lambda dk: psi[_shift(sl, 0, 0, dk)]
+        (zs, ze) = da.getRanges()[2]
+        dzt = np.asarray(grid.dzt)[lsl[2].start+zs:lsl[2].stop+zs]
+        rho[lsl] = - rho0*self.f0/g/dzt * \
+                     ( 0.5*(p(1)+p(0)) -
+                       0.5*(p(0)+p(-1)) )
+
     def set_Q(self, da, grid, U=None, V=None, RHO=None):
         """ Compute Q vector
             qxu = g/f0/rho0 * (dudx*drhodx + dvdx*drhody) at u point
@@ -314,68 +376,42 @@ class omegainv():
 
         """
 
-        # declare local vectors
-        local_U = da.createLocalVec()
-        local_V = da.createLocalVec()
-        local_RHO = da.createLocalVec()
-        local_D = da.createLocalVec()
-
-        # declare global vectors
-        self._QXU = da.createGlobalVec()
-        self._QYV = da.createGlobalVec()
-
-        # load vector U,V,RHO used to compute the jacobian
-        da.globalToLocal(grid.D, local_D)
-        if U is None:
-            da.globalToLocal(self._U, local_U)
-        else:
-            da.globalToLocal(U, local_U)
-        if V is None:
-            da.globalToLocal(self._V, local_V)
-        else:
-            da.globalToLocal(V, local_V)
-        if RHO is None:
-            da.globalToLocal(self._RHO, local_RHO)
-        else:
-            da.globalToLocal(RHO, local_RHO)
+        # ghost points of U,V,RHO used to compute the jacobian are exchanged together
+        u, v, rho = self._halo.exchange(da, self._U if U is None else U,
+                                        self._V if V is None else V,
+                                        self._RHO if RHO is None else RHO)
         #
-        u = da.getVecArray(local_U)
-        v = da.getVecArray(local_V)
-        rho = da.getVecArray(local_RHO)
-        D = da.getVecArray(local_D)
-        qxu = da.getVecArray(self._QXU)
-        qyv = da.getVecArray(self._QYV)
-
-        mx, my, mz = da.getSizes()
-        (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
+        D = grid.get_local_D()[...]
+        qxu = da.getVecArray(self._QXU)[...]
+        qyv = da.getVecArray(self._QYV)[...]
 
         kdxu = grid._k_dxu
         kdyu = grid._k_dyu
         kdxv = grid._k_dxv
         kdyv = grid._k_dyv
 
+        # lateral boundaries
+        qxu[...] = 0.
+        qyv[...] = 0.
         # qxu = g/f0/rho0 * (dudx*drhodx + dvdx*drhody) at u point
-        # qyv = g/f0/rho0 * (dudy*drhodx + dvdy*drhody) at v point 
-        for k in range(zs,ze):
-            for j in range(ys, ye):
-                for i in range(xs, xe): 
-                    if (i==0 or j==0 or i==mx-1 or j==my-1 ):
-                        # lateral boundaries
-                        qxu[i, j, k] = 0.
-                        qyv[i, j, k] = 0. 
-                    else:
-                        qxu[i,j,k] = g/self.f0/rho0 * (
-                              (0.5*(u[i+1,j,k]+u[i,j,k])-0.5*(u[i,j,k]+u[i-1,j,k]))/D[i,j,kdxu] *
-                              (rho[i+1,j,k]-rho[i,j,k])/D[i,j,kdxu] +
-                              (0.5*(v[i+1,j,k]+v[i+1,j-1,k])-0.5*(v[i,j,k]+v[i,j-1,k]))/D[i,j,kdxu] *
-                              (0.25*(rho[i+1,j,k]+rho[i+1,j+1,k]+rho[i,j+1,k]+rho[i,j,k]) -
-                               0.25*(rho[i+1,j-1,k]+rho[i+1,j,k]+rho[i,j,k]+rho[i,j-1,k]) )/D[i,j,kdyu])
-                        qyv[i,j,k] = g/self.f0/rho0 * (
-                              (0.5*(u[i,j+1,k]+u[i-1,j+1,k])-0.5*(u[i,j,k]+u[i-1,j,k]))/D[i,j,kdyv] *
-                              (0.25*(rho[i+1,j,k]+rho[i+1,j+1,k]+rho[i,j+1,k]+rho[i,j,k]) -
-                               0.25*(rho[i,j,k]+rho[i,j+1,k]+rho[i-1,j+1,k]+rho[i-1,j,k]))/D[i,j,kdxv] +
-                              (0.5*(v[i,j,k]+v[i,j+1,k]) - 0.5*(v[i,j,k]+v[i,j-1,k]))/D[i,j,kdyv] *
-                              (rho[i,j+1,k]-rho[i,j,k])/D[i,j,kdyv] )
+        # qyv = g/f0/rho0 * (dudy*drhodx + dvdy*drhody) at v point
+        sl, lsl = self._get_slices(da, lateral=True, vertical=False)
+        su = lambda di, dj: u[_shift(sl, di, dj)]
+        sv = lambda di, dj: v[_shift(sl, di, dj)]
+        sr = lambda di, dj: rho[_shift(sl, di, dj)]
+        dxu, dyu, dxv, dyv = [D[sl[:2]+(k,)][..., None] for k in [kdxu, kdyu, kdxv, kdyv]]
+        qxu[lsl] = g/self.f0/rho0 * (
+              (0.5*(su(1,0)+su(0,0))-0.5*(su(0,0)+su(-1,0)))/dxu *
+              (sr(1,0)-sr(0,0))/dxu +
+              (0.5*(sv(1,0)+sv(1,-1))-0.5*(sv(0,0)+sv(0,-1)))/dxu *
+              (0.25*(sr(1,0)+sr(1,1)+sr(0,1)+sr(0,0)) -
+               0.25*(sr(1,-1)+sr(1,0)+sr(0,0)+sr(0,-1)) )/dyu)
+        qyv[lsl] = g/self.f0/rho0 * (
+              (0.5*(su(0,1)+su(-1,1))-0.5*(su(0,0)+su(-1,0)))/dyv *
+              (0.25*(sr(1,0)+sr(1,1)+sr(0,1)+sr(0,0)) -
+               0.25*(sr(0,0)+sr(0,1)+sr(-1,1)+sr(-1,0)))/dxv +
+              (0.5*(sv(0,0)+sv(0,1)) - 0.5*(sv(0,0)+sv(0,-1)))/dyv *
+              (sr(0,1)-sr(0,0))/dyv )
 
     def compute_divQ(self, da, grid):
         """ Compute Q vector divergence
@@ -388,47 +424,66 @@ class omegainv():
             grid data holder
         
         """
-        # declare local vectors
-        local_QXU = da.createLocalVec()
-        local_QYV = da.createLocalVec()
-        local_D = da.createLocalVec()
+        qxu, qyv = self._halo_Q.exchange(da, self._QXU, self._QYV)
         #
-        da.globalToLocal(self._QXU, local_QXU)
-        da.globalToLocal(self._QYV, local_QYV)
-        da.globalToLocal(grid.D, local_D)
-        #
-        qxu = da.getVecArray(local_QXU)
-        qyv = da.getVecArray(local_QYV)
-        D = da.getVecArray(local_D)
+        D = grid.get_local_D()[...]
 
-        rhs = da.getVecArray(self._RHS)
-
-        mx, my, mz = da.getSizes()
-        (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
+        rhs = da.getVecArray(self._RHS)[...]
 
         kdyu = grid._k_dyu
         kdxv = grid._k_dxv
         kdxt = grid._k_dxt
         kdyt = grid._k_dyt
 
-        for k in range(zs,ze):
-            for j in range(ys, ye):
-                for i in range(xs, xe):
-                    if (i==0 or j==0 or i==mx-1 or j==my-1 or k==0 or k==mz-1 ):
-                        # lateral boundaries
-                        rhs[i, j, k] = 0.
-                    else:
-                        # qx = qxu averaged at level w, qy = qyv averaged at level w
-                        qxi = 0.5*(qxu[i,j,k+1]+qxu[i,j,k])
-                        qxim = 0.5*(qxu[i-1,j,k+1]+qxu[i-1,j,k])
-                        qyj = 0.5*(qyv[i,j,k+1]+qyv[i,j,k])
-                        qyjm = 0.5*(qyv[i,j-1,k+1]+qyv[i,j-1,k])
-                        # rhs = 2*f0* nabla.Q with
-                        # nabla:curvilinear operator =1/dx/dy(di(dy.QX) + dj(dx*QY))
-                        # Q = vector(QX,QY)
-                        rhs[i,j,k] = 2.*self.f0 / D[i,j,kdxt] / D[i,j,kdyt] * (
-                                     (D[i,j,kdyu]*qxi - D[i-1,j,kdyu]*qxim) +
-                                     (D[i,j,kdxv]*qyj - D[i,j-1,kdxv]*qyjm) )
+        # lateral, top and bottom boundaries
+        rhs[...] = 0.
+        sl, lsl = self._get_slices(da, lateral=True, vertical=True)
+        d = lambda di, dj, kd: D[_shift(sl, di, dj)[:2]+(kd,)][..., None]
+        # qx = qxu averaged at level w, qy = qyv averaged at level w
+        qxi = 0.5*(qxu[_shift(sl,0,0,1)]+qxu[sl])
+        qxim = 0.5*(qxu[_shift(sl,-1,0,1)]+qxu[_shift(sl,-1,0)])
+        qyj = 0.5*(qyv[_shift(sl,0,0,1)]+qyv[sl])
+        qyjm = 0.5*(qyv[_shift(sl,0,-1,1)]+qyv[_shift(sl,0,-1)])
+        # rhs = 2*f0* nabla.Q with
+        # nabla:curvilinear operator =1/dx/dy(di(dy.QX) + dj(dx*QY))
+        # Q = vector(QX,QY)
+        rhs[lsl] = 2.*self.f0 / d(0,0,kdxt) / d(0,0,kdyt) * (
+                   (d(0,0,kdyu)*qxi - d(-1,0,kdyu)*qxim) +
+                   (d(0,0,kdxv)*qyj - d(0,-1,kdxv)*qyjm) )
+
+    def _get_slices(self, da, lateral, vertical):
+        """ Block of the local tile where fields are computed
+
+        Parameters
+        ----------
+        da : petsc DMDA
+            holds the petsc grid
+        lateral : boolean
+            exclude lateral boundary points
+        vertical : boolean
+            exclude top and bottom points
+
+        Returns
+        -------
+        gsl : tuple of slices
+            block indices in local (ghosted) arrays
+        lsl : tuple of slices
+            block indices in global (tile) arrays
+
+        """
+        mx, my, mz = da.getSizes()
+        (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
+        (gxs, gxe), (gys, gye), (gzs, gze) = da.getGhostRanges()
+        i0, i1, j0, j1, k0, k1 = xs, xe, ys, ye, zs, ze
+        if lateral:
+            i0, j0 = max(xs, 1), max(ys, 1)
+            i1, j1 = max(i0, min(xe, mx-1)), max(j0, min(ye, my-1))
+        if vertical:
+            k0 = max(zs, 1)
+            k1 = max(k0, min(ze, mz-1))
+        gsl = (slice(i0-gxs, i1-gxs), slice(j0-gys, j1-gys), slice(k0-gzs, k1-gzs))
+        lsl = (slice(i0-xs, i1-xs), slice(j0-ys, j1-ys), slice(k0-zs, k1-zs))
+        return gsl, lsl
 
     def _set_rhs_bdy(self, da, grid, W):
         """
@@ -570,7 +625,7 @@ class omegainv():
         """
 
         rhs = da.getVecArray(self._RHS)
-        mask = da.getVecArray(grid.D)
+        mask = grid.da2D.getVecArray(grid.D)
         (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
 
         kmask = grid._k_mask
@@ -695,9 +750,7 @@ class omegainv():
         if self._verbose>0:
             print('  ... assumes a curvilinear and/or vertically stretched grid')
         #
-        local_D  = da.createLocalVec()
-        da.globalToLocal(grid.D, local_D)
-        D = da.getVecArray(local_D)
+        D = grid.get_local_D()
         kmask = grid._k_mask
         kdxu = grid._k_dxu
         kdyu = grid._k_dyu
@@ -781,4 +834,3 @@ class omegainv():
                             col.field = 0
                             L.setValueStencil(row, col, value)
         L.assemble()
-
@@ -0,0 +1,140 @@
+#!/usr/bin/python
+# -*- encoding: utf8 -*-
+
+
+import numpy as np
+
+#
+#==================== Pencil redistribution of DMDA tiles ============================================
+#
+
+
+class pencils():
+    ''' Redistribution of DMDA tiles into x-pencils (or y-pencils) and back.
+
+    Tiles sharing the same y (x) range exchange data with an MPI all-to-all so that each
+    process holds complete x (y) lines. Lines (all other dimensions flattened) are evenly
+    split between processes. This allows 1D transforms along x and y over distributed arrays.
+    '''
+
+    def __init__(self, da):
+        ''' Setup communicators and partitions
+
+        Parameters
+        ----------
+        da : petsc DMDA
+            holds the petsc grid
+        '''
+        comm = da.getComm().tompi4py()
+        px, py, _ = da.getProcSizes()
+        rank = comm.Get_rank()
+        # DMDA processes are ordered x first
+        ix, iy = rank % px, rank // px
+        # processes sharing the same y range (x-pencils) and x range (y-pencils)
+        self._comms = [comm.Split(color=iy, key=ix), comm.Split(color=ix, key=iy)]
+        # tile sizes along x and y of processes within each communicator
+        self._sizes = [np.asarray(l) for l in da.getOwnershipRanges()[:2]]
+
+    def destroy(self):
+        ''' Free the communicators of x and y pencils
+        '''
+        for comm in self._comms:
+            comm.Free()
+        self._comms = []
+
+    def _split_lines(self, nlines, nprocs):
+        ''' Number of lines of each process in a pencil
+        '''
+        return np.array([len(c) for c in np.array_split(np.arange(nlines), nprocs)])
+
+    def to_pencil(self, a, axis):
+        ''' Redistribute a tile array into a pencil
+
+        Parameters
+        ----------
+        a : ndarray
+            tile array, first two dimensions are x and y
+        axis : int
+            0 for x-pencils, 1 for y-pencils
+
+        Returns
+        -------
+        p : ndarray
+            (N, nlines) pencil: N is the global size along axis and lines are a subset of the
+            other dimensions of the tile (flattened)
+        '''
+        comm, sizes = self._comms[axis], self._sizes[axis]
+        a = np.moveaxis(a, axis, 0)
+        m = a.shape[0]
+        a = a.reshape((m, -1))
+        nl = self._split_lines(a.shape[1], comm.Get_size())
+        lstarts = np.concatenate([[0], np.cumsum(nl)])
+        me = comm.Get_rank()
+        #
+        sendbuf = np.concatenate([a[:, l0:l1].ravel() for l0, l1 in zip(lstarts[:-1], lstarts[1:])])
+        scounts = m*nl
+        rcounts = sizes*nl[me]
+        recvbuf = np.empty(rcounts.sum(), dtype=a.dtype)
+        comm.Alltoallv([sendbuf, _layout(scounts)], [recvbuf, _layout(rcounts)])
+        # blocks from successive processes are successive ranges along axis
+        return recvbuf.reshape((-1, nl[me]))
+
+    def from_pencil(self, p, axis, shape):
+        ''' Redistribute a pencil into tile arrays, inverse of to_pencil
+
+        Parameters
+        ----------
+        p : ndarray
+            (N, nlines) pencil array
+        axis : int
+            0 for x-pencils, 1 for y-pencils
+        shape : tuple
+            shape of the tile array
+
+        Returns
+        -------
+        a : ndarray
+            tile array
+        '''
+        comm, sizes = self._comms[axis], self._sizes[axis]
+        shape = (shape[axis],)+tuple(s for d, s in enumerate(shape) if d != axis)
+        m = shape[0]
+        nl = self._split_lines(int(np.prod(shape[1:])), comm.Get_size())
+        me = comm.Get_rank()
+        #
+        sendbuf = np.ascontiguousarray(p).ravel()
+        scounts = sizes*nl[me]
+        rcounts = m*nl
+        recvbuf = np.empty(rcounts.sum(), dtype=p.dtype)
+        comm.Alltoallv([sendbuf, _layout(scounts)], [recvbuf, _layout(rcounts)])
+        # blocks from successive processes are successive line ranges
+        a = np.concatenate([b.reshape((m, -1)) for b in np.split(recvbuf, np.cumsum(rcounts)[:-1])],
+                           axis=1)
+        return np.moveaxis(a.reshape(shape), 0, axis)
+
+    def transform(self, a, axis, func):
+        ''' Apply a 1D transform along x or y to a distributed tile array
+
+        Parameters
+        ----------
+        a : ndarray
+            tile array, first two dimensions are x and y
+        axis : int
+            0 for x, 1 for y
+        func : function
+            func(p) returns the transform along the first axis of a pencil p (2D array),
+            with the same shape
+
+        Returns
+        -------
+        a : ndarray
+            transformed tile array
+        '''
+        return self.from_pencil(func(self.to_pencil(a, axis)), axis, a.shape)
+
+
+def _layout(counts):
+    ''' Counts and displacements of contiguous blocks (MPI vector collectives)
+    '''
+    displs = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    return (counts.tolist(), displs.astype(int).tolist())
@@ -2,9 +2,17 @@
 # -*- encoding: utf8 -*-
 
 
+import os
 import sys
+import copy
 from petsc4py import PETSc
+import numpy as np
 from .utils import g, rho0
+from .vmodes import vmode_solver
+from .cache import solvers, solver_key, operator_hash, load_operator, save_operator
+from .guess import initial_guess
+from .recycle import deflation_space
+from .diagnostics import diagnostics
 
 #
 #==================== PV inversion solver object ============================================
@@ -15,7 +23,9 @@ class pvinversion():
     ''' PV inversion solver
     '''
     
-    def __init__(self, da, grid, bdy_type, sparam, verbose=0, solver='gmres', pc=None):
+    def __init__(self, da, grid, bdy_type, sparam, verbose=0, solver='gmres', pc=None,
+                 matrix_free=False, mf_pc='jacobi', mg_levels=None, cache=False,
+                 operator_dir=None, guess=None, guess_size=3, recycle=None):
         ''' Setup the PV inversion solver
 
         Parameters
@@ -36,9 +46,44 @@ class pvinversion():
             degree of verbosity, 0 means no outputs
         solver : str, optional
             petsc solver: 'gmres' (default), 'bicg', 'cg'
+            or 'vmodes': direct solver for uniform grids without land points based on vertical
+            modes and horizontal fourier/sine transforms (see vmodes.vmode_solver)
         pc : str, optional
             what is default?
             preconditionner: 'icc', 'bjacobi', 'asm', 'mg', 'none'
+            'mg' is a geometric multigrid on the DMDA, operators are rebuilt on coarse grids.
+            Its smoothers need an assembled fine operator: with matrix_free, 'mg' requires
+            mf_pc='assembled'
+        matrix_free : boolean, optional
+            if True, L is not assembled but applied directly from ghosted local arrays
+            (petsc python Mat), default is False
+        mf_pc : str, optional
+            preconditioner used in matrix free mode: 'jacobi' (default, uses the diagonal of L),
+            'assembled' (L is assembled and only used for preconditioning) or 'none' (gmres
+            may break down: rows of L have very different magnitudes)
+        mg_levels : int, optional
+            number of multigrid levels (pc='mg'), default is the largest number allowed by the
+            horizontal grid dimensions and the tiling
+        cache : boolean, optional
+            if True, the operator and solver are shared with other PV inversion objects with
+            identical grid, stratification, boundary conditions, tiling and solver options
+            (see cache.solvers and release), default is False
+        operator_dir : str, optional
+            directory where the assembled operator is stored (pvinv_L.dat, petsc binary format)
+            along with a hash of the inputs (pvinv_L.hash). It is loaded instead of being
+            assembled if hashes match. Not used in matrix free mode.
+        guess : str, None, optional
+            initial guess of the iterative solver computed from previous solutions:
+            'projection' (onto the span of previous solutions, also selected by True),
+            'extrapolation' (polynomial in time) or 'previous' (state.PSI, statistics only),
+            see guess.initial_guess. Projection is the robust choice, extrapolation only pays
+            off for smooth series of solutions at equally spaced times.
+            Default is None: state.PSI without statistics
+        guess_size : int, optional
+            number of previous solutions kept for the initial guess, default is 3
+        recycle : int, None, optional
+            size of a deflation space of slowly converging modes recycled across solves
+            (see recycle.deflation_space), default is None (no recycling)
 
         '''
 
@@ -50,34 +95,124 @@ class pvinversion():
         else:
             self.petscBoundaryType = None
 
-        # create the operator
-        self.L = da.createMat()
+        self.matrix_free = matrix_free
         #
         if self._verbose>0:
             print('A PV inversion object is being created')
+
+        # operator and solver, possibly shared with other PV inversion objects
+        self._cache_entry = None
+        if cache:
+            key = solver_key('pvinversion', da, grid, self.bdy_type, sparam=sparam, solver=solver,
+                             pc=pc, matrix_free=matrix_free, mf_pc=mf_pc, mg_levels=mg_levels,
+                             recycle=recycle)
+            self._cache_entry = solvers.acquire(key)
+        if self._cache_entry is not None:
+            self.__dict__.update(self._cache_entry.objects)
+            if self._verbose>0:
+                print('  Operator L and solver retrieved from cache')
+        else:
+            self._create_solver(da, grid, sparam, solver, pc, mf_pc, mg_levels, operator_dir,
+                                recycle)
+            if cache:
+                self._cache_entry = solvers.add(key, {'L': self.L, '_P': self._P,
+                                                      'ksp': self.ksp, '_vmodes': self._vmodes,
+                                                      '_recycle': self._recycle})
+
+        # global vector for PV inversion
+        self._RHS = da.createGlobalVec()
+        # intermediate fields: 'rhs' (rhs) and, in solve, 'psi' (psi) before the background
+        # state is added back
+        self.diagnostics = diagnostics()
+        # dense matrices of batches of right hand sides and solutions (see solve_batch)
+        self._B, self._X, self._batch_n = None, None, None
+        # land points of the tile, updated with the mask (see _get_land)
+        self._land, self._land_version = None, None
+        # initial guess from previous solutions, residual history gives iterations saved
+        self._guess = None
+        if guess is True:
+            guess = 'projection'
+        if guess is not None:
+            self._guess = initial_guess(self.L, self._RHS, kind=guess, size=guess_size)
+            self.ksp.setConvergenceHistory(reset=True)
+            if self._verbose>0:
+                print('  Initial guess: '+guess)
+
+        if self._verbose>0:
+            print('  PV inversion is set up')
+
+    def _create_solver(self, da, grid, sparam, solver, pc, mf_pc, mg_levels, operator_dir,
+                       recycle):
+        ''' Create the operator and the solver, see __init__ for parameters
+        '''
+        if pc == 'mg' and self.matrix_free and mf_pc != 'assembled':
+            print("!Error: pc='mg' requires an assembled operator, use mf_pc='assembled' "
+                  +"with matrix_free")
+            sys.exit()
+
+        # create the operator
+        if not self.matrix_free:
+            self.L = da.createMat()
+        else:
+            self.L = None
+        #
+        if self._verbose>0:
             print('  Operator L declared')
 
-        # Fill in operator values
-        if grid._flag_hgrid_uniform and grid._flag_vgrid_uniform:
-            self._set_L(self.L, da, grid, sparam)
+        # Fill in operator values, assembled operators may be stored in operator_dir
+        loaded = False
+        if operator_dir is not None and not self.matrix_free:
+            filename = os.path.join(operator_dir, 'pvinv_L')
+            hash = operator_hash(solver_key('pvinversion', da, grid, self.bdy_type, sparam=sparam),
+                                 grid)
+            loaded = load_operator(self.L, filename, hash, da.getComm())
+            if loaded and self._verbose>0:
+                print('  Operator L loaded from '+filename+'.dat')
+        if not loaded:
+            if grid._flag_hgrid_uniform and grid._flag_vgrid_uniform:
+                Lop = self._set_L(self.L, da, grid, sparam)
+            else:
+                Lop = self._set_L_curv(self.L, da, grid, sparam)
+            if operator_dir is not None and not self.matrix_free:
+                save_operator(self.L, filename, hash, da.getComm())
+
+        # matrix free operator and preconditioning matrix
+        if self.matrix_free:
+            self.L = Lop.create_python_mat(da)
+            if mf_pc == 'assembled':
+                self._P = da.createMat()
+                Lop.set_values(self._P)
+            else:
+                self._P = self.L
         else:
-            self._set_L_curv(self.L, da, grid, sparam)
+            self._P = self.L
 
         #
         if self._verbose>0:
+            if self.matrix_free:
+                print('  Operator L is matrix free, preconditioner: '+mf_pc)
             print('  Operator L filled')
 
-        # global vector for PV inversion
-        self._RHS = da.createGlobalVec()
+        # direct solver, the petsc solver is still created (default gmres)
+        if solver == 'vmodes':
+            self._vmodes = vmode_solver(da, grid, self.bdy_type, sparam, self.petscBoundaryType,
+                                        verbose=self._verbose)
+            solver = 'gmres'
+        else:
+            self._vmodes = None
 
         # create solver
         self.ksp = PETSc.KSP()
         self.ksp.create(PETSc.COMM_WORLD)
-        self.ksp.setOperators(self.L)
+        self.ksp.setOperators(self.L, self._P)
         self.ksp.setType(solver)
         self.ksp.setInitialGuessNonzero(True)
         if pc is not None:
             self.ksp.getPC().setType(pc)
+        elif self.matrix_free and mf_pc != 'assembled':
+            self.ksp.getPC().setType(mf_pc)
+        if pc == 'mg':
+            self._set_mg(da, grid, sparam, mg_levels)
         # set tolerances
         self.ksp.setTolerances(rtol=1e-4)
         self.ksp.setTolerances(max_it=100)
@@ -90,16 +225,46 @@ class pvinversion():
         for opt in sys.argv[1:]:
             PETSc.Options().setValue(opt, None)
         self.ksp.setFromOptions()
-        
-        if self._verbose>0:
-            print('  PV inversion is set up')
+
+        # deflation space recycled across solves, replaces the operator of the solver
+        self._recycle = None
+        if recycle and self._vmodes is None:
+            V = da.createGlobalVec()
+            self._recycle = deflation_space(self.L, self._P, self.ksp, V, size=recycle)
+            V.destroy()
+            if self._verbose>0:
+                print('  Deflation space of %i vectors recycled across solves' %recycle)
+
+    def release(self):
+        ''' Release the operator and solver: objects shared through the cache (see cache.solvers)
+        are destroyed once released by all users and evicted
+        '''
+        if self._guess is not None:
+            self._guess.destroy()
+            self._guess = None
+        if self._B is not None:
+            self._B.destroy()
+            self._X.destroy()
+            self._B, self._X, self._batch_n = None, None, None
+        if self._cache_entry is not None:
+            solvers.release(self._cache_entry)
+            self._cache_entry = None
+        else:
+            if self._recycle is not None:
+                self._recycle.destroy()
+            if self._vmodes is not None:
+                self._vmodes.destroy()
+            self.ksp.destroy()
+            if self._P is not self.L:
+                self._P.destroy()
+            self.L.destroy()
 
 #
 # ==================== perform inversion ===================================
 #
 
     def solve(self, da, grid, state, Q=None, PSI=None, RHO=None, \
-              bstate=None, addback_bstate=True, topdown_rho=False, numit=False):
+              bstate=None, addback_bstate=True, topdown_rho=False, numit=False, t=None):
         ''' Compute the PV inversion
         Uses prioritarily optional Q, PSI, RHO for RHS and bdy conditions
 
@@ -126,6 +291,9 @@ class pvinversion():
             is contained in state.Q at indices kdown and kup
         numit : boolean
             if True, returns the number of iterations
+        t : float, None, optional
+            time of the state, used by the polynomial extrapolation of the initial guess
+            (see guess.initial_guess), successive solves are assumed equally spaced if None
 
         Returns
         -------
@@ -157,16 +325,11 @@ class pvinversion():
             PSI += - bstate.PSI
             RHO += - bstate.RHO
         #
-        # copy Q into RHS
-        Q.copy(self._RHS)
-        # fix boundaries
-        self.set_rhs_bdy(da, grid, state, PSI, RHO, topdown_rho)
-        # apply mask
-        if grid.mask:
-            # mask rhs
-            self.set_rhs_mask(da, grid, PSI)
+        # copy Q into RHS, fix boundaries and apply mask
+        self._set_rhs(da, grid, state, Q, PSI, RHO, topdown_rho)
         # actually solves the pb
-        self.ksp.solve(self._RHS, state.PSI)
+        niter = self._solve(da, state.PSI, t=t)
+        self.diagnostics.fire('psi', da, grid, psi=state.PSI)
         # add back background state
         if bstate is not None and addback_bstate:
             if self._verbose>1:
@@ -176,15 +339,204 @@ class pvinversion():
             RHO += bstate.RHO
 
         if self._verbose>1:
-            print('Inversion done (%i iterations)' %(self.ksp.getIterationNumber()), flush=True)
+            print('Inversion done (%i iterations)' %(niter), flush=True)
+        if numit:
+            return niter
+
+    def _solve(self, da, PSI, t=None):
+        ''' Solve L PSI = RHS (self._RHS) with the initial guess and deflation space if any
+
+        Parameters
+        ----------
+        da : petsc DMDA
+            holds the petsc grid
+        PSI : petsc Vec
+            initial guess on input, solution on output
+        t : float, None, optional
+            time of the solution (see solve)
+
+        Returns
+        -------
+        niter : int
+            number of iterations
+        '''
+        if self._vmodes is not None:
+            self._vmodes.solve(da, self._RHS, PSI)
+            return 0
+        if self._guess is not None:
+            self._guess.set(self._RHS, PSI, t=t)
+        if self._recycle is not None:
+            niter = self._recycle.solve(self.ksp, self._RHS, PSI)
+        else:
+            self.ksp.solve(self._RHS, PSI)
+            niter = self.ksp.getIterationNumber()
+        if self._guess is not None:
+            self._guess.update(PSI, niter, ksp=self.ksp, t=t)
+        return niter
+
+    def needs_psi(self, da, grid):
+        ''' True if boundary conditions take values from the streamfunction (see set_rhs_bdy and
+        set_rhs_mask): lateral boundaries of non periodic grids, land points, 'N_PSI' and 'D'
+        vertical boundary conditions or levels below kdown and above kup
+
+        Parameters
+        ----------
+        da : petsc DMDA
+            holds the petsc grid
+        grid : qgsolver grid object
+            grid data holder
+        '''
+        return (self.petscBoundaryType != 'periodic' or bool(grid.mask)
+                or self.bdy_type['bottom'] in ['N_PSI', 'D']
+                or self.bdy_type['top'] in ['N_PSI', 'D']
+                or grid.kdown > 0 or grid.kup < da.getSizes()[2]-1)
+
+    def block_solver(self):
+        ''' True if the Krylov solver is a block solver, which solve_batch applies to all
+        fields at once. Block solvers (-ksp_type hpddm) require petsc built with the optional
+        HPDDM package, other solvers invert fields one after the other.
+        '''
+        return (self._vmodes is None and self._recycle is None
+                and self.ksp.getType() == 'hpddm')
+
+    def solve_batch(self, da, grid, state, Q, PSI=None, RHO=None, topdown_rho=False,
+                    numit=False):
+        ''' Compute the PV inversion of a batch of PV fields with the same operator.
+        With a block Krylov solver (see block_solver: -ksp_type hpddm, petsc must be built
+        with HPDDM), right hand sides are stored as columns of a dense matrix and the operator
+        and preconditioner are applied to all columns at once (KSPMatSolve). Otherwise fields
+        are inverted one after the other, as with solve: there is no gain over successive calls
+        of solve but the initial guess applies to successive fields.
+        The 'psi' diagnostic is fired for each field.
+
+        Parameters
+        ----------
+        da : petsc DMDA
+            holds the petsc grid
+        grid : qgsolver grid object
+            grid data holder
+        state : state object
+            ocean state
+        Q : list of petsc Vec or petsc Mat
+            potential vorticity fields, or dense matrix whose columns are the fields
+        PSI : list of petsc Vec, petsc Mat, None, optional
+            streamfunctions: initial guesses and boundary values on input, solutions on output.
+            If None, new vectors are initialized with state.PSI
+        RHO : list of petsc Vec, petsc Mat, None, optional
+            densities used for boundary conditions, state.RHO is used for all fields if None
+        topdown_rho : boolean
+            if True, indicates that RHO used for top down boundary conditions
+            is contained in Q at indices kdown and kup
+        numit : boolean
+            if True, returns the number of iterations as well
+
+        Returns
+        -------
+        PSI : list of petsc Vec or petsc Mat
+            solutions, a dense matrix if Q is a dense matrix
+        niter : int
+            total number of iterations over fields, if numit (block iterations times the
+            number of fields with a block solver)
+        '''
+        Qs = self._get_columns(Q)
+        n = len(Qs)
+        if PSI is None:
+            PSIs = [state.PSI.copy() for j in range(n)]
+        else:
+            PSIs = self._get_columns(PSI)
+        if RHO is not None:
+            RHOs = self._get_columns(RHO)
+        elif topdown_rho:
+            RHOs = Qs
+        else:
+            RHOs = [state.RHO]*n
+        #
+        if not self.block_solver():
+            # one after the other
+            niter = 0
+            for j in range(n):
+                self._set_rhs(da, grid, state, Qs[j], PSIs[j], RHOs[j], topdown_rho)
+                niter += self._solve(da, PSIs[j])
+        else:
+            # right hand sides and initial guesses are columns of dense matrices
+            B, X = self._get_batch_mats(n)
+            for j in range(n):
+                self._set_rhs(da, grid, state, Qs[j], PSIs[j], RHOs[j], topdown_rho)
+                if self._guess is not None:
+                    self._guess.set(self._RHS, PSIs[j])
+                self._RHS.copy(B.getDenseColumnVec(j, 'w'))
+                B.restoreDenseColumnVec(j, 'w')
+                PSIs[j].copy(X.getDenseColumnVec(j, 'w'))
+                X.restoreDenseColumnVec(j, 'w')
+            self.ksp.matSolve(B, X)
+            # block iterations apply to all columns
+            niter = n*self.ksp.getIterationNumber()
+            for j in range(n):
+                X.getDenseColumnVec(j, 'r').copy(PSIs[j])
+                X.restoreDenseColumnVec(j, 'r')
+                if self._guess is not None:
+                    self._guess.update(PSIs[j], self.ksp.getIterationNumber())
+        for j in range(n):
+            self.diagnostics.fire('psi', da, grid, psi=PSIs[j])
+        #
+        if self._verbose>1:
+            print('Inversion of %i fields done (%i iterations, %s)' \
+                  %(n, niter, 'block solver' if self.block_solver() else 'one after the other'),
+                  flush=True)
+        if isinstance(Q, PETSc.Mat):
+            if isinstance(PSI, PETSc.Mat):
+                PSI_out = PSI
+            else:
+                PSI_out = Q.duplicate()
+            for j in range(n):
+                PSIs[j].copy(PSI_out.getDenseColumnVec(j, 'w'))
+                PSI_out.restoreDenseColumnVec(j, 'w')
+        else:
+            PSI_out = PSIs
         if numit:
-            return self.ksp.getIterationNumber()
+            return PSI_out, niter
+        return PSI_out
 
 
 #
 # ==================== utils methods for inversions ===================================
 #
 
+    def _set_rhs(self, da, grid, state, Q, PSI, RHO, topdown_rho):
+        ''' Copy Q into the RHS and set boundary conditions and mask, see solve
+        '''
+        Q.copy(self._RHS)
+        self.set_rhs_bdy(da, grid, state, PSI, RHO, topdown_rho)
+        if grid.mask:
+            self.set_rhs_mask(da, grid, PSI)
+        self.diagnostics.fire('rhs', da, grid, rhs=self._RHS)
+
+    def _get_columns(self, V):
+        ''' Vectors of a batch: list of petsc Vec, or copies of the columns of a dense matrix
+        '''
+        if isinstance(V, PETSc.Mat):
+            cols = []
+            for j in range(V.getSize()[1]):
+                cols.append(V.getDenseColumnVec(j, 'r').copy())
+                V.restoreDenseColumnVec(j, 'r')
+            return cols
+        return list(V)
+
+    def _get_batch_mats(self, n):
+        ''' Dense matrices of right hand sides and solutions of a batch of n fields, kept
+        between batches of identical sizes
+        '''
+        if self._batch_n != n:
+            if self._B is not None:
+                self._B.destroy()
+                self._X.destroy()
+            size = (self._RHS.getSizes(), (PETSc.DECIDE, n))
+            self._B = PETSc.Mat().createDense(size, comm=self._RHS.getComm())
+            self._B.setUp()
+            self._X = self._B.duplicate()
+            self._batch_n = n
+        return self._B, self._X
+
     def q_from_psi(self, Q, PSI):
         ''' Compute PV from a streamfunction
         
@@ -248,40 +600,30 @@ class pvinversion():
             is contained in state.Q at indices kdown and kup
         '''
 
-        rhs = da.getVecArray(self._RHS)
+        rhs = da.getVecArray(self._RHS)[...]
         (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
 
         kdown = grid.kdown
 
         # load vector used to compute boundary conditions
-        psi = da.getVecArray(PSI)
+        psi = da.getVecArray(PSI)[...]
         if RHO is not None:
-            rho = da.getVecArray(RHO)
+            rho = da.getVecArray(RHO)[...]
         elif self.bdy_type['bottom'] == 'N_RHO' or topdown_rho:
             print('!Error: pvinv.set_rhs_bdy_bottom requires RHO, none provided')
             sys.exit()
            
         # lower ghost area
         if zs < kdown:
-            for k in range(zs,kdown):
-                for j in range(ys, ye):
-                    for i in range(xs, xe):                    
-                        # rhs[i,j,k]=sys.float_info.epsilon
-                        rhs[i,j,k]=psi[i, j, k]
+            rhs[:, :, :kdown-zs] = psi[:, :, :kdown-zs]
         # bottom bdy
-        k = kdown
+        k = kdown-zs
         if self.bdy_type['bottom'] == 'N_RHO' or topdown_rho:
-            for j in range(ys, ye):
-                for i in range(xs, xe):
-                    rhs[i, j, k] = - g*rho[i, j, k]/(rho0*state.f0)
+            rhs[:, :, k] = - g*rho[:, :, k]/(rho0*state.f0)
         elif self.bdy_type['bottom'] == 'N_PSI':
-            for j in range(ys, ye):
-                for i in range(xs, xe):
-                    rhs[i, j, k] = (psi[i,j,k+1]-psi[i,j,k])/grid.dzw[k]
+            rhs[:, :, k] = (psi[:, :, k+1]-psi[:, :, k])/grid.dzw[kdown]
         elif self.bdy_type['bottom'] == 'D':
-            for j in range(ys, ye):
-                for i in range(xs, xe):
-                    rhs[i, j, k] = psi[i,j,k]
+            rhs[:, :, k] = psi[:, :, k]
         else:
             print(self.bdy_type['bottom']+" unknown bottom boundary condition")
             sys.exit()
@@ -308,43 +650,33 @@ class pvinversion():
             is contained in state.Q at indices kdown and kup
         '''
         
-        rhs = da.getVecArray(self._RHS)
+        rhs = da.getVecArray(self._RHS)[...]
         (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
 
         kup = grid.kup
 
         # load vector used to compute boundary conditions
-        psi = da.getVecArray(PSI)
+        psi = da.getVecArray(PSI)[...]
         if RHO is not None:
-            rho = da.getVecArray(RHO)
+            rho = da.getVecArray(RHO)[...]
         elif self.bdy_type['top'] == 'N_RHO':
             print('!Error: pvinv.set_rhs_bdy_top requires RHO, none provided')
             sys.exit()
 
         if ze > kup+1:
-            for k in range(kup+1,ze):
-                for j in range(ys, ye):
-                    for i in range(xs, xe):
-                        # rhs[i,j,k]=sys.float_info.epsilon   
-                        rhs[i,j,k]= psi[i,j,k]            
+            rhs[:, :, kup+1-zs:] = psi[:, :, kup+1-zs:]
         # upper bdy
-        k = kup
+        k = kup-zs
         if self.bdy_type['top'] == 'N_RHO' or topdown_rho:
             if topdown_rho:
                 krho = k
             else:
                 krho = k-1
-            for j in range(ys, ye):
-                for i in range(xs, xe):
-                    rhs[i, j, k] = - g*rho[i, j, krho]/(rho0*state.f0)
+            rhs[:, :, k] = - g*rho[:, :, krho]/(rho0*state.f0)
         elif self.bdy_type['top'] == 'N_PSI':
-            for j in range(ys, ye):
-                for i in range(xs, xe):
-                    rhs[i, j, k] = (psi[i,j,k]-psi[i,j,k-1])/grid.dzw[k-1]
+            rhs[:, :, k] = (psi[:, :, k]-psi[:, :, k-1])/grid.dzw[kup-1]
         elif self.bdy_type['top'] == 'D':
-            for j in range(ys, ye):
-                for i in range(xs, xe):
-                    rhs[i, j, k] = psi[i,j,k]
+            rhs[:, :, k] = psi[:, :, k]
         else:
             print(self.bdy_type['top']+" unknown top boundary condition")
             sys.exit()
@@ -362,7 +694,10 @@ class pvinversion():
             streamfunction, use state.PSI if None
         '''
         
-        rhs = da.getVecArray(self._RHS)
+        if self.petscBoundaryType == 'periodic':
+            return
+
+        rhs = da.getVecArray(self._RHS)[...]
         (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
 
         istart = grid.istart
@@ -371,36 +706,24 @@ class pvinversion():
         jend = grid.jend
 
         # load vector used to compute boundary conditions
-        psi = da.getVecArray(PSI)
+        psi = da.getVecArray(PSI)[...]
 
         # south bdy
-        if ys <= jstart and self.petscBoundaryType is not 'periodic':
-            #j = 0
-            for k in range(zs, ze):
-                for j in range(ys,min(ye,jstart+1)):
-                    for i in range(xs, xe):
-                        rhs[i, j, k] = psi[i, j, k]
+        if ys <= jstart:
+            sl = (slice(None), slice(0, min(ye, jstart+1)-ys))
+            rhs[sl] = psi[sl]
         # north bdy
-        if ye >= jend and self.petscBoundaryType is not 'periodic':
-            #j = my - 1
-            for k in range(zs, ze):
-                for j in range(max(ys,jend),ye):
-                    for i in range(xs, xe):
-                        rhs[i, j, k] = psi[i, j, k]
+        if ye >= jend:
+            sl = (slice(None), slice(max(ys, jend)-ys, None))
+            rhs[sl] = psi[sl]
         # west bdy
-        if xs <= istart and self.petscBoundaryType is not 'periodic':
-            #i = 0
-            for k in range(zs, ze):
-                for j in range(ys, ye):
-                    for i in range(xs,min(xe,istart+1)):
-                        rhs[i, j, k] = psi[i, j, k]
+        if xs <= istart:
+            sl = slice(0, min(xe, istart+1)-xs)
+            rhs[sl] = psi[sl]
         # east bdy
-        if xe >= iend and self.petscBoundaryType is not 'periodic':
-            #i = mx - 1
-            for k in range(zs, ze):
-                for j in range(ys, ye):
-                    for i in range(max(xs,iend),xe):
-                        rhs[i, j, k] = psi[i, j, k]
+        if xe >= iend:
+            sl = slice(max(xs, iend)-xs, None)
+            rhs[sl] = psi[sl]
 
     def set_rhs_mask(self, da, grid, PSI):
         '''Set mask on rhs: where mask=0 (land) rhs=psi
@@ -415,24 +738,36 @@ class pvinversion():
             streamfunction used over masked areas
         '''
 
-        rhs = da.getVecArray(self._RHS)
-        mask = da.getVecArray(grid.D)
-        (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
-
-        kmask = grid._k_mask
-
-        psi = da.getVecArray(PSI)
+        rhs = da.getVecArray(self._RHS)[...]
+        psi = da.getVecArray(PSI)[...]
         
-        # interior
-        for k in range(zs,ze):
-            for j in range(ys, ye):
-                for i in range(xs, xe):
-                    if mask[i,j,kmask] == 0.:
-                        rhs[i, j, k] = psi[i,j,k]
+        # land columns of the tile
+        land = self._get_land(grid)
+        rhs[land] = psi[land]
 
         if self._verbose>1:
             print('  Set RHS mask for inversion ')
 
+    def _get_land(self, grid):
+        '''Indices of land points (mask=0) of the tile, computed again once the mask is
+        modified (grid._reset_local_D, called by grid.load_mask)
+
+        Parameters
+        ----------
+        grid : qgsolver grid object
+            grid data holder
+
+        Returns
+        -------
+        land : tuple of ndarray
+            (i, j) tile indices of land points
+        '''
+        if self._land_version != grid._D_version:
+            mask = grid.da2D.getVecArray(grid.D)[...]
+            self._land = np.nonzero(mask[:, :, grid._k_mask] == 0.)
+            self._land_version = grid._D_version
+        return self._land
+
 #
 # ==================== Define elliptical operators ===================================
 #
@@ -443,14 +778,19 @@ class pvinversion():
 
         Parameters
         ----------
-        L : petsc Mat
-            potential vorticity operator
+        L : petsc Mat, None
+            potential vorticity operator, not assembled if None
         da : petsc DMDA
             holds the petsc grid
         grid : qgsolver grid object
             grid data holder
         sparam : ndarray
             f0^2/N^2/ array
+
+        Returns
+        -------
+        op : stencil_operator
+            stencil description of the operator
         '''
         
         if self._verbose>0:
@@ -461,79 +801,58 @@ class pvinversion():
         idx, idy, idz = [1.0/dl for dl in [dx, dy, dz]]
         idx2, idy2, idz2 = [1.0/dl**2 for dl in [dx, dy, dz]]
         #
-        (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
-        istart = grid.istart
-        iend = grid.iend
-        jstart = grid.jstart
-        jend = grid.jend
         kdown = grid.kdown
         kup = grid.kup
         #
-        L.zeroEntries()
-        row = PETSc.Mat.Stencil()
-        col = PETSc.Mat.Stencil()
+        op = stencil_operator(da)
+        k = op.k
+        sparam = np.asarray(sparam)
         #
-    
-        for k in range(zs, ze):
-            for j in range(ys, ye):
-                for i in range(xs, xe):
-                    row.index = (i,j,k)
-                    row.field = 0
-
-                    # lateral points outside the domain: dirichlet, psi=...
-                    if (i <= istart or i >= iend or j <= jstart or j >= jend) \
-                            and self.petscBoundaryType is not 'periodic':
-                        L.setValueStencil(row, row, 1.0)
-    
-                    # bottom bdy condition: default Neuman dpsi/dz=...
-                    elif k == kdown:
-                        if self.bdy_type['bottom'] in ['N_RHO', 'N_PSI']:
-                            for index, value in [
-                                    ((i,j,k), -idz),
-                                    ((i,j,k+1),  idz)]:
-                                col.index = index
-                                col.field = 0
-                                L.setValueStencil(row, col, value)
-                        elif self.bdy_type['bottom'] == 'D':
-                            L.setValueStencil(row, row, 1.0)
-                        else:
-                            print('unknown bottom boundary condition')
-                            sys.exit()
-    
-                    # top bdy condition: default Neuman dpsi/dz=...
-                    elif k == kup:
-                        if self.bdy_type['top'] in ['N_RHO', 'N_PSI']:
-                            for index, value in [
-                                    ((i,j,k-1), -idz),
-                                    ((i,j,k),  idz)]:
-                                col.index = index
-                                col.field = 0
-                                L.setValueStencil(row, col, value)
-                        elif self.bdy_type['top'] == 'D':
-                            L.setValueStencil(row, row, 1.0)
-                        else:
-                            print('unknown top boundary condition')
-                            sys.exit()
-    
-                    # points below and above the domain
-                    elif k < kdown or k > kup:
-                        L.setValueStencil(row, row, 0.0)
-    
-                    # interior points: pv is prescribed
-                    else:
-                        for index, value in [
-                                ((i,j,k-1), sparam[k-1]*idz2),
-                                ((i,j-1,k), idy2),
-                                ((i-1,j,k), idx2),
-                                ((i, j, k), -2.*(idx2+idy2)-(sparam[k]*idz2+sparam[k-1]*idz2)),
-                                ((i+1,j,k), idx2),
-                                ((i,j+1,k), idy2),
-                                ((i,j,k+1), sparam[k]*idz2)]:
-                            col.index = index
-                            col.field = 0
-                            L.setValueStencil(row, col, value)
-        L.assemble()
-        return
+        # lateral points outside the domain: dirichlet, psi=...
+        lateral = self._get_lateral(op, grid)
+        op.add(lateral, (0,0,0), 1.0)
+        #
+        # bottom bdy condition: default Neuman dpsi/dz=...
+        bottom = ~lateral & (k == kdown)
+        if self.bdy_type['bottom'] in ['N_RHO', 'N_PSI']:
+            op.add(bottom, (0,0,0), -idz)
+            op.add(bottom, (0,0,1), idz)
+        elif self.bdy_type['bottom'] == 'D':
+            op.add(bottom, (0,0,0), 1.0)
+        else:
+            print('unknown bottom boundary condition')
+            sys.exit()
+        #
+        # top bdy condition: default Neuman dpsi/dz=...
+        top = ~lateral & (k == kup)
+        if self.bdy_type['top'] in ['N_RHO', 'N_PSI']:
+            op.add(top, (0,0,-1), -idz)
+            op.add(top, (0,0,0), idz)
+        elif self.bdy_type['top'] == 'D':
+            op.add(top, (0,0,0), 1.0)
+        else:
+            print('unknown top boundary condition')
+            sys.exit()
+        #
+        # points below and above the domain
+        outside = ~lateral & ((k < kdown) | (k > kup))
+        op.add(outside, (0,0,0), 0.0)
+        #
+        # interior points: pv is prescribed
+        interior = ~(lateral | bottom | top | outside)
+        for index, value in [
+                ((0,0,-1), sparam[k-1]*idz2),
+                ((0,-1,0), idy2),
+                ((-1,0,0), idx2),
+                ((0,0,0), -2.*(idx2+idy2)-(sparam[k]*idz2+sparam[k-1]*idz2)),
+                ((1,0,0), idx2),
+                ((0,1,0), idy2),
+                ((0,0,1), sparam[k]*idz2)]:
+            op.add(interior, index, value)
+        #
+        if L is not None:
+            op.set_values(L)
+        return op
 
     def _set_L_curv(self,L, da, grid, sparam):
         ''' Builds the laplacian operator along with boundary conditions
@@ -541,114 +860,510 @@ class pvinversion():
 
         Parameters
         ----------
-        L : petsc Mat
-            potential vorticity operator
+        L : petsc Mat, None
+            potential vorticity operator, not assembled if None
         da : petsc DMDA
             holds the petsc grid
         grid : qgsolver grid object
             grid data holder
         sparam : ndarray
             f0^2/N^2/ array
+
+        Returns
+        -------
+        op : stencil_operator
+            stencil description of the operator
         '''
         
         if self._verbose>0:
             print('  ... assumes a curvilinear and/or vertically stretched grid')
         #
-        local_D  = da.createLocalVec()
-        da.globalToLocal(grid.D, local_D)
-        D = da.getVecArray(local_D)
-        kmask = grid._k_mask
-        kdxu = grid._k_dxu
-        kdyu = grid._k_dyu
-        kdxv = grid._k_dxv
-        kdyv = grid._k_dyv
-        kdxt = grid._k_dxt
-        kdyt = grid._k_dyt
+        op = stencil_operator(da)
+        D = op.get_metric(grid)
+        dxu, dyu = D(grid._k_dxu), D(grid._k_dyu)
+        dxv, dyv = D(grid._k_dxv), D(grid._k_dyv)
+        dxt, dyt = D(grid._k_dxt), D(grid._k_dyt)
+        dyu_w, dxu_w = D(grid._k_dyu, di=-1), D(grid._k_dxu, di=-1)
+        dxv_s, dyv_s = D(grid._k_dxv, dj=-1), D(grid._k_dyv, dj=-1)
+        mask = D(grid._k_mask)
         #
         idzt = 1./grid.dzt
         idzw = 1./grid.dzw
         #
-        (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
-        istart = grid.istart
-        iend = grid.iend
-        jstart = grid.jstart
-        jend = grid.jend
         kdown = grid.kdown
         kup = grid.kup
         #
-        L.zeroEntries()
-        row = PETSc.Mat.Stencil()
-        col = PETSc.Mat.Stencil()
+        k = op.k
+        sparam = np.asarray(sparam)
+        #
+        # masked points (land=0), L=1
+        masked = (mask == 0.)
+        op.add(masked, (0,0,0), 1.)
+        #
+        # domain edges
+        lateral = ~masked & self._get_lateral(op, grid)
+        op.add(lateral, (0,0,0), 1.0)
+        #
+        # bottom bdy condition: default Neuman dpsi/dz=...
+        bottom = ~(masked | lateral) & (k == kdown)
+        if self.bdy_type['bottom'] in ['N_RHO', 'N_PSI']:
+            op.add(bottom, (0,0,0), -idzw[k])
+            op.add(bottom, (0,0,1), idzw[k])
+        elif self.bdy_type['bottom']=='D' :
+            op.add(bottom, (0,0,0), 1.0)
+        else:
+            print('unknown bottom boundary condition')
+            sys.exit()
+        #
+        # top bdy condition: default Neuman dpsi/dz=...
+        top = ~(masked | lateral) & (k == kup)
+        if self.bdy_type['top'] in ['N_RHO', 'N_PSI']:
+            op.add(top, (0,0,-1), -idzw[k-1])
+            op.add(top, (0,0,0), idzw[k-1])
+        elif self.bdy_type['top']=='D':
+            op.add(top, (0,0,0), 1.0)
+        else:
+            print('unknown top boundary condition')
+            sys.exit()
+        #
+        # points below and above the domain
+        outside = ~(masked | lateral) & ((k < kdown) | (k > kup))
+        op.add(outside, (0,0,0), 1.0)
         #
-        for k in range(zs, ze):
-            for j in range(ys, ye):
-                for i in range(xs, xe):
+        # interior points: pv is prescribed
+        interior = ~(masked | lateral | bottom | top | outside)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for index, value in [
+                    ((0,0,-1), sparam[k-1]*idzt[k]*idzw[k-1]),
+                    ((0,-1,0), 1./dxt/dyt * dxv_s/dyv_s),
+                    ((-1,0,0), 1./dxt/dyt * dyu_w/dxu_w),
+                    ((0,0,0), -1./dxt/dyt*(
+                                     dyu/dxu
+                                    +dyu_w/dxu_w
+                                    +dxv/dyv
+                                    +dxv_s/dyv_s)
+                                - (sparam[k]*idzt[k]*idzw[k]+sparam[k-1]*idzt[k]*idzw[k-1])),
+                    ((1,0,0), 1./dxt/dyt * dyu/dxu),
+                    ((0,1,0), 1./dxt/dyt * dxv/dyv),
+                    ((0,0,1), sparam[k]*idzt[k]*idzw[k])]:
+                op.add(interior, index, value)
+        #
+        if L is not None:
+            op.set_values(L)
+        return op
 
-                    # row index
-                    row.index = (i, j, k)
-                    row.field = 0
-    
-                    # masked points (land=0), L=1
-                    if D[i,j,kmask] == 0.:
-                        L.setValueStencil(row, row, 1.)
-   
-                    # domain edges 
-                    elif (i <= istart or i >= iend or j <= jstart or j >= jend) \
-                            and self.petscBoundaryType is not 'periodic':
-                        L.setValueStencil(row, row, 1.0)
-    
-                    # bottom bdy condition: default Neuman dpsi/dz=...
-                    elif k == kdown:
-                        if self.bdy_type['bottom'] in ['N_RHO', 'N_PSI']:
-                            for index, value in [
-                                    ((i,j,k), -idzw[k]),
-                                    ((i,j,k+1),  idzw[k])]:
-                                col.index = index
-                                col.field = 0
-                                L.setValueStencil(row, col, value)
-                        elif self.bdy_type['bottom']=='D' :
-                            L.setValueStencil(row, row, 1.0)
-                        else:
-                            print('unknown bottom boundary condition')
-                            sys.exit()
-    
-                    # top bdy condition: default Neuman dpsi/dz=...
-                    elif k == kup:
-                        if self.bdy_type['top'] in ['N_RHO', 'N_PSI']:
-                            for index, value in [
-                                    ((i,j,k-1), -idzw[k-1]),
-                                    ((i,j,k),  idzw[k-1])]:
-                                col.index = index
-                                col.field = 0
-                                L.setValueStencil(row, col, value)
-                        elif self.bdy_type['top']=='D':
-                            L.setValueStencil(row, row, 1.0)
-                        else:
-                            print('unknown top boundary condition')
-                            sys.exit()
-    
-                    # points below and above the domain
-                    elif k < kdown or k > kup:
-                        L.setValueStencil(row, row, 1.0)
-
-                    # interior points: pv is prescribed
-                    else:
-                        
-                        for index, value in [
-                                ((i,j,k-1), sparam[k-1]*idzt[k]*idzw[k-1]),
-                                ((i,j-1,k), 1./D[i,j,kdxt]/D[i,j,kdyt] * D[i,j-1,kdxv]/D[i,j-1,kdyv]),
-                                ((i-1,j,k), 1./D[i,j,kdxt]/D[i,j,kdyt] * D[i-1,j,kdyu]/D[i-1,j,kdxu]),
-                                ((i, j, k), -1./D[i,j,kdxt]/D[i,j,kdyt]*(
-                                                 D[i,j,kdyu]/D[i,j,kdxu]
-                                                +D[i-1,j,kdyu]/D[i-1,j,kdxu]
-                                                +D[i,j,kdxv]/D[i,j,kdyv]
-                                                +D[i,j-1,kdxv]/D[i,j-1,kdyv])
-                                            - (sparam[k]*idzt[k]*idzw[k]+sparam[k-1]*idzt[k]*idzw[k-1])),
-                                ((i+1,j,k), 1./D[i,j,kdxt]/D[i,j,kdyt] * D[i,j,kdyu]/D[i,j,kdxu]),
-                                ((i,j+1,k), 1./D[i,j,kdxt]/D[i,j,kdyt] * D[i,j,kdxv]/D[i,j,kdyv]),
-                                ((i,j,k+1), sparam[k]*idzt[k]*idzw[k])]:
-                            col.index = index
-                            col.field = 0
-                            L.setValueStencil(row, col, value)
+    def _get_lateral(self, op, grid):
+        ''' Flag lateral boundary points (none if periodic)
+
+        Parameters
+        ----------
+        op : stencil_operator object
+            holds tile indices
+        grid : qgsolver grid object
+            grid data holder
+
+        Returns
+        -------
+        lateral : ndarray
+            boolean array, True on lateral boundary points
+        '''
+        if self.petscBoundaryType == 'periodic':
+            return np.zeros(op.k.shape, dtype=bool)
+        i, j = op.i, op.j
+        return (i <= grid.istart) | (i >= grid.iend) | (j <= grid.jstart) | (j >= grid.jend)
+
+
+#
+# ==================== Geometric multigrid ===================================
+#
+
+    def _set_mg(self, da, grid, sparam, mg_levels):
+        ''' Geometric multigrid on a hierarchy of DMDAs coarsened horizontally: the fine operator
+        is the one provided to the solver, grid data is restricted to each coarse DMDA (see
+        _coarsen) and operators are rebuilt on them. Interpolations are those of the DMDAs on
+        periodic grids and linear interpolations on other grids (see _get_interpolation),
+        restrictions are their transposes: coarse operators, boundary rows included, are scaled
+        by the ratio of cell areas to be consistent with the restriction of residuals (sum over
+        4 fine cells).
+
+        Parameters
+        ----------
+        da : petsc DMDA
+            holds the petsc grid
+        grid : qgsolver grid object
+            grid data holder
+        sparam : ndarray
+            f0^2/N^2/ array, unchanged on coarse grids
+        mg_levels : int, None
+            number of multigrid levels, computed with _get_mg_levels if None
+        '''
+        if mg_levels is None:
+            mg_levels = self._get_mg_levels(da)
+        pc = self.ksp.getPC()
+        pc.setMGLevels(mg_levels)
+        # coarse DMDAs, grids and operators are held by the solver levels
+        daf, gridf = da, grid
+        for level in range(mg_levels-2, -1, -1):
+            dac, gridc = self._coarsen(daf, gridf)
+            L = dac.createMat()
+            if gridc._flag_hgrid_uniform and gridc._flag_vgrid_uniform:
+                self._set_L(L, dac, gridc, sparam)
+            else:
+                self._set_L_curv(L, dac, gridc, sparam)
+            L.scale(4.**(mg_levels-1-level))
+            if self.petscBoundaryType == 'periodic':
+                P, _ = dac.createInterpolation(daf)
+            else:
+                P = self._get_interpolation(dac, daf)
+            pc.setMGInterpolation(level+1, P)
+            if level == 0:
+                pc.getMGCoarseSolve().setOperators(L)
+            else:
+                pc.getMGSmoother(level).setOperators(L)
+            daf, gridf = dac, gridc
+        if self._verbose>0:
+            print('  Geometric multigrid with %i levels' %mg_levels)
+
+    def _get_mg_levels(self, da):
+        ''' Largest number of multigrid levels: periodic horizontal dimensions must be divisible
+        by 2 at each coarsening and coarse tiles keep at least 3 points (and the stencil width)
+
+        Parameters
+        ----------
+        da : petsc DMDA
+            holds the petsc grid
+
+        Returns
+        -------
+        levels : int
+            number of multigrid levels
+        '''
+        sizes = list(da.getSizes()[:2])
+        procs = da.getProcSizes()[:2]
+        nmin = max(3, da.getStencilWidth())
+        levels = 1
+        while True:
+            for d, (N, m) in enumerate(zip(sizes, procs)):
+                if self.petscBoundaryType == 'periodic':
+                    ok, sizes[d] = (N%2 == 0), N//2
+                else:
+                    ok, sizes[d] = True, (N+1)//2
+                if not ok or sizes[d] < nmin*m:
+                    return levels
+            levels += 1
+
+    def _coarsen(self, fine, grid):
+        ''' Coarsen a DMDA horizontally by 2 and restrict grid data
+
+        Coarse points coincide with fine points of even indices and belong to the same process.
+        Grid spacings are scaled by the coarsening ratio, metric terms, coriolis parameter and mask
+        are injected and horizontal lengths scaled.
+
+        Parameters
+        ----------
+        fine : petsc DMDA
+            fine DMDA
+        grid : qgsolver grid object
+            grid data holder on the fine DMDA
+
+        Returns
+        -------
+        coarse : petsc DMDA
+            coarse DMDA
+        cgrid : qgsolver grid object
+            grid data holder on the coarse DMDA
+        '''
+        Mf, Nf, Nz = fine.getSizes()
+        if self.petscBoundaryType == 'periodic':
+            Mc, Nc = Mf//2, Nf//2
+            rx, ry = Mf/Mc, Nf/Nc
+        else:
+            Mc, Nc = (Mf+1)//2, (Nf+1)//2
+            rx, ry = 2., 2.
+        # coarse tiles hold the points of even indices of fine tiles
+        lx, ly, lz = fine.getOwnershipRanges()
+        lxc = np.diff((np.concatenate([[0], np.cumsum(lx)])+1)//2).tolist()
+        lyc = np.diff((np.concatenate([[0], np.cumsum(ly)])+1)//2).tolist()
+        coarse = PETSc.DMDA().create(sizes=[Mc, Nc, Nz],
+                                     proc_sizes=fine.getProcSizes(),
+                                     ownership_ranges=(lxc, lyc, lz),
+                                     boundary_type=fine.getBoundaryType(),
+                                     stencil_width=fine.getStencilWidth(),
+                                     stencil_type=fine.getStencilType(),
+                                     comm=fine.getComm())
+        #
+        cgrid = copy.copy(grid)
+        cgrid.Nx, cgrid.Ny = Mc, Nc
+        cgrid.istart, cgrid.jstart = int(grid.istart/rx), int(grid.jstart/ry)
+        cgrid.iend, cgrid.jend = cgrid.istart+Mc-1, cgrid.jstart+Nc-1
+        if hasattr(grid, 'dx'):
+            cgrid.dx, cgrid.dy = grid.dx*rx, grid.dy*ry
+        if hasattr(grid, 'D'):
+            del cgrid.D
+            cgrid._create_D(coarse)
+            # coarse points are fine points of even indices on the same process
+            (xsc, xec), (ysc, yec) = cgrid.da2D.getRanges()
+            D = cgrid.da2D.getVecArray(cgrid.D)
+            D[xsc:xec, ysc:yec, :] = grid.da2D.getVecArray(grid.D)[2*xsc:2*xec-1:2,
+                                                                  2*ysc:2*yec-1:2, :]
+            for kD in [grid._k_dxt, grid._k_dxu, grid._k_dxv]:
+                D[:, :, kD] *= rx
+            for kD in [grid._k_dyt, grid._k_dyu, grid._k_dyv]:
+                D[:, :, kD] *= ry
+        return coarse, cgrid
+
+    def _get_interpolation(self, coarse, fine):
+        ''' Linear interpolation from a coarse DMDA (see _coarsen) to a non periodic fine DMDA
+
+        Fine points of even indices take coarse values, fine points of odd indices the mean
+        of their two coarse neighbours. With even fine dimensions, the last fine point has a
+        single coarse neighbour and receives no correction (DMDA interpolations require
+        odd dimensions).
+
+        Parameters
+        ----------
+        coarse : petsc DMDA
+            coarse DMDA
+        fine : petsc DMDA
+            fine DMDA
+
+        Returns
+        -------
+        P : petsc Mat
+            interpolation matrix
+        '''
+        Mf, Nf, Nz = fine.getSizes()
+        Mc, Nc, _ = coarse.getSizes()
+        (xs, xe), (ys, ye), (zs, ze) = fine.getRanges()
+        #
+        def weights(start, end, Nc):
+            # fine indices, coarse indices and weights along one direction
+            i = np.arange(start, end)
+            ie, io = i[i%2 == 0], i[(i%2 == 1) & (i//2+1 < Nc)]
+            return (np.concatenate([ie, io, io]),
+                    np.concatenate([ie//2, io//2, io//2+1]),
+                    np.concatenate([np.ones(ie.size), 0.5*np.ones(2*io.size)]))
+        i, I, wi = weights(xs, xe, Mc)
+        j, J, wj = weights(ys, ye, Nc)
+        a, b, k = np.meshgrid(np.arange(i.size), np.arange(j.size), np.arange(zs, ze),
+                              indexing='ij')
+        a, b, k = a.ravel(), b.ravel(), k.ravel()
+        rows = fine.getAO().app2petsc((i[a] + Mf*(j[b] + Nf*k)).astype(PETSc.IntType))
+        cols = coarse.getAO().app2petsc((I[a] + Mc*(J[b] + Nc*k)).astype(PETSc.IntType))
+        #
+        P = PETSc.Mat().create(comm=fine.getComm())
+        (xsc, xec), (ysc, yec), _ = coarse.getRanges()
+        P.setSizes((((xe-xs)*(ye-ys)*(ze-zs), Mf*Nf*Nz), ((xec-xsc)*(yec-ysc)*(ze-zs), Mc*Nc*Nz)))
+        P.setType(PETSc.Mat.Type.AIJ)
+        P.setPreallocationCOO(rows, cols)
+        P.setValuesCOO(wi[a]*wj[b])
+        P.assemble()
+        return P
+
+
+#
+# ==================== Operator assembly ===================================
+#
+
+class stencil_operator():
+    ''' 7 points stencil operator over the local tile of a DMDA, defined by a list of
+    entries L[(i,j,k), (i,j,k)+offset] = value over selected rows. A 2D DMDA is a single
+    level (k=0).
+    Entries are either inserted in bulk into a petsc Mat in coordinate (COO) format
+    or applied directly to ghosted arrays (matrix free mode).
+    '''
+
+    def __init__(self, da):
+        ''' Setup index arrays over the local tile
+
+        Parameters
+        ----------
+        da : petsc DMDA
+            holds the petsc grid
+        '''
+        ranges, granges = tuple(da.getRanges()), tuple(da.getGhostRanges())
+        if da.getDim() == 2:
+            ranges, granges = ranges+((0, 1),), granges+((0, 1),)
+        (xs, xe), (ys, ye), (zs, ze) = ranges
+        (gxs, gxe), (gys, gye), (gzs, gze) = granges
+        self._ranges = ((xs, xe), (ys, ye), (zs, ze))
+        self._granges = ((gxs, gxe), (gys, gye), (gzs, gze))
+        self._gstarts = (gxs, gys, gzs)
+        self._gxm, self._gym = gxe-gxs, gye-gys
+        # global indices of tile points, (i, j, k) arrays broadcastable to the tile shape
+        self.i = np.arange(xs, xe)[:, None, None]
+        self.j = np.arange(ys, ye)[None, :, None]
+        self.k = np.arange(zs, ze)[None, None, :]
+        self.shape = (xe-xs, ye-ys, ze-zs)
         #
+        self._entries = []
+
+    def _local_index(self, i, j, k):
+        ''' Ghosted local (natural x fastest) index of global indices i, j, k
+        '''
+        gxs, gys, gzs = self._gstarts
+        return (i-gxs) + self._gxm*((j-gys) + self._gym*(k-gzs))
+
+    def get_metric(self, grid):
+        ''' Returns a function extracting 2D metric terms over the tile from the
+        ghosted metric terms, possibly shifted horizontally
+
+        Parameters
+        ----------
+        grid : qgsolver grid object
+            grid data holder, metric terms are in grid.D (see grid.get_local_D)
+
+        Returns
+        -------
+        metric : function
+            metric(kD, di=0, dj=0) returns an (x, y, 1) array
+        '''
+        D = grid.get_local_D()[...]
+        (gxs, gxe), (gys, gye) = grid.da2D.getGhostRanges()
+        i, j = self.i[:, :, 0]-gxs, self.j[:, :, 0]-gys
+        def metric(kD, di=0, dj=0):
+            # shifted indices are clipped, values there are not used by operators
+            return D[np.maximum(i+di, 0), np.maximum(j+dj, 0), kD][:, :, None]
+        return metric
+
+    def add(self, sel, offset, value):
+        ''' Add entries L[(i,j,k), (i,j,k)+offset] = value for selected rows
+
+        Parameters
+        ----------
+        sel : ndarray
+            boolean array broadcastable to the tile shape, selects rows
+        offset : tuple
+            (di, dj, dk) column offset
+        value : float or ndarray
+            value, broadcastable to the tile shape
+        '''
+        if np.any(sel):
+            self._entries.append((sel, offset, value))
+
+    def set_values(self, L):
+        ''' Preallocate L with the nonzero pattern of the stencil and insert values
+
+        Parameters
+        ----------
+        L : petsc Mat
+            operator with the local to global mapping of the DMDA (da.createMat())
+        '''
+        rows, cols, vals = [], [], []
+        for sel, (di, dj, dk), value in self._entries:
+            sel = np.broadcast_to(sel, self.shape)
+            i, j, k = [np.broadcast_to(idx, self.shape)[sel] for idx in (self.i, self.j, self.k)]
+            rows.append(self._local_index(i, j, k))
+            cols.append(self._local_index(i+di, j+dj, k+dk))
+            vals.append(np.broadcast_to(value, self.shape)[sel])
+        rows = np.concatenate(rows).astype(PETSc.IntType)
+        cols = np.concatenate(cols).astype(PETSc.IntType)
+        vals = np.concatenate(vals).astype(PETSc.ScalarType)
+        L.setPreallocationCOOLocal(rows, cols)
+        L.setValuesCOO(vals)
         L.assemble()
+
+    def _get_blocks(self, offset):
+        ''' Tile and ghosted array slices of rows whose neighbour at offset
+        lies within the ghosted array
+
+        Parameters
+        ----------
+        offset : tuple
+            (di, dj, dk) column offset
+
+        Returns
+        -------
+        tsl, gsl : tuple of slices
+            rows in tile array and neighbours in ghosted array
+        '''
+        tsl, gsl = [], []
+        for d, (s, e), (gs, ge) in zip(offset, self._ranges, self._granges):
+            s0 = max(s, gs-d)
+            e0 = max(s0, min(e, ge-d))
+            tsl.append(slice(s0-s, e0-s))
+            gsl.append(slice(s0+d-gs, e0+d-gs))
+        return tuple(tsl), tuple(gsl)
+
+    def mult(self, x, y):
+        ''' Apply the operator: y = L x
+
+        Parameters
+        ----------
+        x : ndarray
+            ghosted (local) array
+        y : ndarray
+            tile (global) array where the result is stored
+        '''
+        y[...] = 0.
+        # values may be infinite over rows that are not selected (land)
+        with np.errstate(invalid='ignore', over='ignore'):
+            for sel, offset, value in self._entries:
+                tsl, gsl = self._get_blocks(offset)
+                sel = np.broadcast_to(sel, self.shape)[tsl]
+                value = np.broadcast_to(value, self.shape)[tsl]
+                y[tsl] += np.where(sel, value*x[gsl], 0.)
+
+    def get_diagonal(self, d):
+        ''' Diagonal of the operator
+
+        Parameters
+        ----------
+        d : ndarray
+            tile (global) array where the diagonal is stored
+        '''
+        d[...] = 0.
+        for sel, offset, value in self._entries:
+            if offset == (0,0,0):
+                d += np.where(np.broadcast_to(sel, self.shape), value, 0.)
+
+    def create_python_mat(self, da):
+        ''' Create a matrix free petsc Mat applying the stencil
+
+        Parameters
+        ----------
+        da : petsc DMDA
+            holds the petsc grid
+
+        Returns
+        -------
+        L : petsc Mat
+            python Mat, see stencil_mat
+        '''
+        V = da.createGlobalVec()
+        sizes = V.getSizes()
+        V.destroy()
+        L = PETSc.Mat().createPython([sizes, sizes], context=stencil_mat(da, self),
+                                     comm=da.getComm())
+        L.setUp()
+        return L
+
+
+class stencil_mat():
+    ''' Context of a matrix free petsc python Mat: the stencil is applied from
+    ghosted local arrays
+    '''
+
+    def __init__(self, da, op):
+        '''
+        Parameters
+        ----------
+        da : petsc DMDA
+            holds the petsc grid
+        op : stencil_operator
+            stencil description of the operator
+        '''
+        self.da = da
+        self.op = op
+        self._local = da.createLocalVec()
+
+    def mult(self, mat, x, y):
+        ''' y = L x
+        '''
+        self.da.globalToLocal(x, self._local)
+        self.op.mult(self.da.getVecArray(self._local)[...], self.da.getVecArray(y)[...])
+
+    def getDiagonal(self, mat, d):
+        ''' Diagonal of L, used for jacobi preconditioning
+        '''
+        self.op.get_diagonal(self.da.getVecArray(d)[...])
@@ -2,6 +2,7 @@
 # -*- encoding: utf8 -*-
 
 import sys
+import time
 import petsc4py
 #from Cython.Compiler.Main import verbose
 petsc4py.init(sys.argv)
@@ -10,7 +11,7 @@ from .state import *
 from .pvinv import *
 from .omegainv import *
 from .timestepper import *
-from .inout import write_nc
+from .inout import write_nc, record_reader, record_writer
 
 
 class qg_model():
@@ -67,6 +68,9 @@ class qg_model():
             turn on setup of PV inversion solver, default is True
         flag_omega: boolean, optional
             turn on setup of omega equation inversion solver, default is False
+        kwargs : dict
+            passed to the PV inversion solver (see pvinversion), cache and operator_dir are
+            also used by the omega equation solver
         '''
 
         #
@@ -137,14 +141,15 @@ class qg_model():
 
         # initiate pv inversion solver
         if flag_pvinv:
-            self.pvinv = pvinversion(self.da, self.grid, self.bdy_type, sparam=self.state._sparam,
+            self.pvinv = pvinversion(self.da_op, self.grid, self.bdy_type, sparam=self.state._sparam,
                                      verbose=self._verbose, **kwargs)
 
         # initiate omega inversion
         if flag_omega:
             self.W = self.da.createGlobalVec()
-            self.omegainv = omegainv(self.da, self.grid, self.bdy_type, self.state.f0, self.state.N2,
-                                     verbose=self._verbose)
+            self.omegainv = omegainv(self.da_op, self.grid, self.bdy_type, self.state.f0, self.state.N2,
+                                     verbose=self._verbose, cache=kwargs.get('cache', False),
+                                     operator_dir=kwargs.get('operator_dir'))
 
         # initiate time stepper
         if dt is not None:
@@ -168,10 +173,14 @@ class qg_model():
                   % (float(self.grid.Nx) / ncores_x, float(self.grid.Ny) / ncores_y))
             sys.exit()
 
-        # setup tiling
+        # setup tiling: box stencil of width 1 for the state and the time stepping (9 points
+        # Arakawa jacobian), star stencil of width 1 for the 7 points operators of the inversions
+        # (exact preallocation, smaller halos), both DMDAs share the same ownership ranges
         self.da = PETSc.DMDA().create(sizes=[self.grid.Nx, self.grid.Ny, self.grid.Nz],
                                       proc_sizes=[ncores_x, ncores_y, 1],
-                                      stencil_width=2, boundary_type=self.petscBoundaryType)
+                                      stencil_width=1, stencil_type='box',
+                                      boundary_type=self.petscBoundaryType)
+        self.da_op = self.da.duplicate(stencil_type='star')
         # http://lists.mcs.anl.gov/pipermail/petsc-dev/2016-April/018889.html
 
         self.comm = self.da.getComm()
@@ -242,10 +251,146 @@ class qg_model():
         else:
             print('!Error qg.inver_pv requires qg.state (with Q/PSI and RHO depending on bdy conditions)')
 
+    def invert_pv_batch(self, Q, PSI=None, RHO=None):
+        ''' wrapper around batched pv inversion solver pvinv.solve_batch
+
+        Parameters
+        ----------
+        Q : list of petsc Vec or petsc Mat
+            potential vorticity fields, or dense matrix whose columns are the fields
+        PSI : list of petsc Vec, petsc Mat, None, optional
+            initial guesses and boundary values, initialized with qg.state.PSI if None
+        RHO : list of petsc Vec, petsc Mat, None, optional
+            densities used for boundary conditions, qg.state.RHO if None
+
+        Returns
+        -------
+        PSI : list of petsc Vec or petsc Mat
+            streamfunctions
+        '''
+        return self.pvinv.solve_batch(self.da, self.grid, self.state, Q, PSI=PSI, RHO=RHO)
+
+    def invert_pv_records(self, input_file, output_file='output.nc', qname='q', psiname='psi',
+                          rhoname=None, bpsiname=None, records=None, parallel=False,
+                          prefetch=True):
+        ''' Invert the PV of all time records of a netcdf file and write the streamfunction.
+        Each inversion starts from the previous solution, the next record may be read in a
+        background thread (see inout.record_reader).
+
+        Parameters
+        ----------
+        input_file : str
+            netcdf file containing PV (t, z, y, x)
+        output_file : str, optional
+            netcdf output file, one record of psi per input record, default is 'output.nc'
+        qname : str, optional
+            name of PV in the input file, default is 'q'
+        psiname : str, optional
+            name of the streamfunction in the output file, default is 'psi'
+        rhoname : str, None, optional
+            name of density in the input file, required for 'N_RHO' boundary conditions
+        bpsiname : str, None, optional
+            name of the streamfunction in the input file, read with each record for boundary
+            values. Required if boundary conditions take values from psi (see
+            pvinv.needs_psi): non periodic grids, land points, 'N_PSI' and 'D' conditions
+        records : list of int, None, optional
+            time indices inverted, all records if None
+        parallel : boolean, optional
+            if True, each process writes its tile collectively (see inout.write_nc),
+            default is False
+        prefetch : boolean, optional
+            read the next record in a background thread, default is True
+        '''
+        if bpsiname is None and self.pvinv.needs_psi(self.da, self.grid):
+            print('!Error: qg.invert_pv_records requires bpsiname, boundary conditions '
+                  +'take values from psi')
+            sys.exit()
+        vnames, V = [qname], [self.state.Q]
+        if rhoname is not None:
+            vnames.append(rhoname)
+            V.append(self.state.RHO)
+        BPSI = None
+        if bpsiname is not None:
+            BPSI = self.da.createGlobalVec()
+            vnames.append(bpsiname)
+            V.append(BPSI)
+        reader = record_reader(input_file, vnames, self.da, self.grid, fillmask=0.,
+                               prefetch=prefetch)
+        writer = None
+        try:
+            if records is None:
+                records = range(len(reader))
+            records = list(records)
+            writer = record_writer(output_file, [psiname], self.da, self.grid, parallel=parallel)
+            for n, it in enumerate(records):
+                it_next = records[n+1] if n+1 < len(records) else None
+                reader.read(it, V, it_next=it_next)
+                niter = self.pvinv.solve(self.da, self.grid, self.state, PSI=BPSI, numit=True)
+                writer.write([self.state.PSI])
+                if self._verbose>0:
+                    print('Record %i inverted (%i iterations)' %(it, niter), flush=True)
+        finally:
+            reader.close()
+            if writer is not None:
+                writer.close()
+            if BPSI is not None:
+                BPSI.destroy()
+
     def invert_omega(self):
         ''' wrapper around solver solve method omegainv.solve
         '''
-        self.omegainv.solve(self)
+        self.omegainv.solve(self.da, self.grid, self.state)
+
+    def invert_omega_records(self, input_file, output_file='output.nc', psiname='psi', wname='w',
+                             records=None, parallel=False, prefetch=True):
+        ''' Diagnose the vertical velocity of all time records of a streamfunction netcdf file
+        and write it. Each inversion starts from the vertical velocity of the previous record,
+        the next record may be read in a background thread (see inout.record_reader).
+        Work vectors are reused from one record to the next.
+
+        Parameters
+        ----------
+        input_file : str
+            netcdf file containing the streamfunction (t, z, y, x)
+        output_file : str, optional
+            netcdf output file, one record of w per input record, default is 'output.nc'
+        psiname : str, optional
+            name of the streamfunction in the input file, default is 'psi'
+        wname : str, optional
+            name of the vertical velocity in the output file, default is 'w'
+        records : list of int, None, optional
+            time indices inverted, all records if None
+        parallel : boolean, optional
+            if True, each process writes its tile collectively (see inout.write_nc),
+            default is False
+        prefetch : boolean, optional
+            read the next record in a background thread, default is True
+        '''
+        reader = record_reader(input_file, [psiname], self.da, self.grid, fillmask=0.,
+                               prefetch=prefetch)
+        writer = None
+        try:
+            if records is None:
+                records = range(len(reader))
+            records = list(records)
+            writer = record_writer(output_file, [wname], self.da, self.grid, parallel=parallel)
+            if not hasattr(self.state, 'W'):
+                self.state.W = self.da.createGlobalVec()
+                self.state.W.set(0.)
+            for n, it in enumerate(records):
+                t0 = time.time()
+                it_next = records[n+1] if n+1 < len(records) else None
+                reader.read(it, [self.state.PSI], it_next=it_next)
+                niter = self.omegainv.solve(self.da, self.grid, self.state, guess=(n>0),
+                                            numit=True)
+                writer.write([self.state.W])
+                if self._verbose>0:
+                    print('Record %i: w diagnosed in %.2f s (%i iterations)' \
+                          %(it, time.time()-t0, niter), flush=True)
+        finally:
+            reader.close()
+            if writer is not None:
+                writer.close()
 
     def tstep(self, nt=1, rho_sb=True, bstate=None):
         ''' Time step wrapper tstepper.go
@@ -257,7 +402,8 @@ class qg_model():
 # ==================== IO ============================================
 #
 
-    def write_state(self,v=['PSI','Q'], vname=['psi','q'], filename='output.nc', append=False):
+    def write_state(self,v=['PSI','Q'], vname=['psi','q'], filename='output.nc', append=False,
+                    parallel=False):
         ''' Outputs state to a netcdf file
 
         Parameters
@@ -270,6 +416,9 @@ class qg_model():
             netcdf output filename
         create : boolean, optional
             if true creates a new file, append otherwise (default is True)
+        parallel : boolean, optional
+            if True, each process writes its tile collectively (see inout.write_nc),
+            default is False
         '''
         V=[]
         for vv in v:
@@ -277,7 +426,7 @@ class qg_model():
                 V.append(getattr(self.state,vv))
             else:
                 print('Warning: variable '+vv+' not present in state vector and thus not outputted')
-        write_nc(V, vname, filename, self.da, self.grid, append=append)
+        write_nc(V, vname, filename, self.da, self.grid, append=append, parallel=parallel)
 
 #
 #==================== utils ============================================
@@ -312,7 +461,7 @@ class qg_model():
         # get u
         u = self.da.getVecArray(self.state._U)
         # get dx
-        D = self.da.getVecArray(self.grid.D)
+        D = self.grid.da2D.getVecArray(self.grid.D)
 
         kdxu = self.grid._k_dxu
         (xs, xe), (ys, ye), (zs, ze) = self.da.getRanges()
@@ -0,0 +1,209 @@
+#!/usr/bin/python
+# -*- encoding: utf8 -*-
+
+
+import numpy as np
+from petsc4py import PETSc
+
+#
+#==================== Krylov subspace recycling ============================================
+#
+
+
+class deflation_space():
+    ''' Deflation space recycled across solves of A x = b with a fixed operator A.
+
+    The space U holds approximations of the eigenvectors of A with smallest eigenvalues,
+    the slowest converging modes, and C = A U is orthonormal. Each solve is split between
+    the deflated system solved by the Krylov solver and a projection onto U:
+
+        (I - C C^T) A x' = (I - C C^T) b,    x = x' + U C^T (b - A x')
+
+    so that the Krylov solver does not need to resolve the modes spanned by U. The space is
+    updated after each solve with the solution, in which modes of smallest eigenvalues are
+    amplified (as in an inverse iteration), and U is reduced to its size by harmonic Ritz
+    extraction (GCRO-DR, Parks et al. 2006): Arnoldi vectors of the petsc solvers are not
+    exposed, Ritz vectors are extracted from the span of U and of the solution instead.
+    Each solve costs one additional application of A. U and C are stored in two banks of
+    2*size vectors allocated once: one holds the space, the other receives the extracted
+    Ritz vectors, and the banks are swapped after each update.
+    The tolerance of the Krylov solver is applied relative to the norm of b, the deflated
+    right hand side being much smaller once U captures the solutions.
+    '''
+
+    def __init__(self, A, P, ksp, x, size=4):
+        ''' Setup the deflation space and the deflated operator of the solver
+
+        Parameters
+        ----------
+        A : petsc Mat
+            operator
+        P : petsc Mat
+            preconditioning matrix
+        ksp : petsc KSP
+            solver, its operator is replaced by the deflated operator
+        x : petsc Vec
+            template of solution vectors
+        size : int, optional
+            maximum number of vectors of the deflation space, default is 4
+        '''
+        self.size = size
+        self._A = A
+        # deflation space and its orthonormal image by A, in two banks of vectors
+        self._bank = 0
+        self._U = [[x.duplicate() for _ in range(size)] for _ in range(2)]
+        self._C = [[x.duplicate() for _ in range(size)] for _ in range(2)]
+        self.U = []
+        self.C = []
+        self._b = x.duplicate()
+        self._x = x.duplicate()
+        self._Ax = x.duplicate()
+        # deflated operator (I - C C^T) A
+        self._Ad = PETSc.Mat().createPython([x.getSizes(), x.getSizes()],
+                                            context=deflated_mat(self), comm=x.getComm())
+        self._Ad.setUp()
+        ksp.setOperators(self._Ad, P)
+        # statistics
+        self.solves = 0
+        self.iterations = 0
+
+    def destroy(self):
+        ''' Destroy petsc objects
+        '''
+        for v in sum(self._U+self._C, [])+[self._b, self._x, self._Ax]:
+            v.destroy()
+        self._U, self._C = [[], []], [[], []]
+        self.U, self.C = [], []
+        self._Ad.destroy()
+
+    def project(self, y):
+        ''' y = (I - C C^T) y
+        '''
+        if len(self.C) > 0:
+            c = np.array(y.mDot(self.C))
+            y.maxpy(-c, self.C)
+
+    def solve(self, ksp, b, x):
+        ''' Solve A x = b
+
+        Parameters
+        ----------
+        ksp : petsc KSP
+            solver, with the deflated operator
+        b : petsc Vec
+            right hand side
+        x : petsc Vec
+            initial guess on input, solution on output
+
+        Returns
+        -------
+        niter : int
+            number of iterations of the Krylov solver
+        '''
+        # deflated right hand side
+        b.copy(self._b)
+        cb = np.array(b.mDot(self.C)) if len(self.C) > 0 else None
+        if cb is not None:
+            self._b.maxpy(-cb, self.C)
+        # the residual of the deflated system is the residual of A x = b after projection,
+        # the tolerance is made relative to the norm of b instead of the deflated one
+        rtol, atol, dtol, max_it = ksp.getTolerances()
+        ksp.setTolerances(rtol=0., atol=max(rtol*self._rhs_norm(ksp, b), atol))
+        ksp.solve(self._b, x)
+        ksp.setTolerances(rtol=rtol, atol=atol)
+        niter = ksp.getIterationNumber()
+        self._A.mult(x, self._Ax)
+        if cb is not None:
+            # projection onto U: x += U C^T (b - A x), A x is updated accordingly
+            c = np.array(self._Ax.mDot(self.C))
+            x.maxpy(cb-c, self.U)
+            self._Ax.maxpy(cb-c, self.C)
+        x.copy(self._x)
+        #
+        self.solves += 1
+        self.iterations += niter
+        self._update()
+        return niter
+
+    def report(self):
+        ''' Summary of iterations
+
+        Returns
+        -------
+        summary : str
+        '''
+        if self.solves == 0:
+            return 'deflation space: no solve'
+        return 'deflation space (%i vectors): %i solves, %.1f iterations per solve' \
+               %(len(self.U), self.solves, float(self.iterations)/self.solves)
+
+    def _rhs_norm(self, ksp, b):
+        ''' Norm of b used by the convergence test of the solver
+        '''
+        ksp.setUp()
+        norm_type = ksp.getNormType()
+        if norm_type == PETSc.KSP.NormType.PRECONDITIONED:
+            ksp.getPC().apply(b, self._x)
+            return self._x.norm()
+        elif norm_type == PETSc.KSP.NormType.NATURAL:
+            ksp.getPC().apply(b, self._x)
+            return np.sqrt(abs(b.dot(self._x)))
+        return b.norm()
+
+    def _update(self):
+        ''' Add the last solution to the space and extract harmonic Ritz vectors
+        '''
+        norm = self._Ax.norm()
+        if norm == 0.:
+            return
+        self._x.scale(1./norm)
+        self._Ax.scale(1./norm)
+        S, W = self.U+[self._x], self.C+[self._Ax]
+        m = len(S)
+        # small matrices W^T W and W^T S
+        G, F = np.zeros((m, m)), np.zeros((m, m))
+        for i in range(m):
+            G[i, :] = W[i].mDot(W)
+            F[i, :] = W[i].mDot(S)
+        if m > self.size:
+            # harmonic Ritz vectors: W^T W g = theta W^T S g, smallest |theta|
+            theta, g = np.linalg.eig(np.linalg.lstsq(F, G, rcond=None)[0])
+            order = np.argsort(np.abs(theta))[:self.size]
+            # complex pairs contribute their real and imaginary parts
+            Pk = np.hstack([g[:, order].real, g[:, order].imag])
+        else:
+            Pk = np.eye(m)
+        # orthonormalize images: (W Pk)^T (W Pk) = V diag(lambda) V^T
+        lbd, V = np.linalg.eigh(Pk.T.dot(G).dot(Pk))
+        keep = np.argsort(lbd)[::-1][:self.size]
+        keep = keep[lbd[keep] > 1.e-12*lbd.max()]
+        Q = Pk.dot(V[:, keep])/np.sqrt(lbd[keep])
+        # Ritz vectors are combined into the other bank, which then holds the space
+        bank = 1-self._bank
+        n = Q.shape[1]
+        for u, c, q in zip(self._U[bank][:n], self._C[bank][:n], Q.T):
+            u.set(0.)
+            u.maxpy(q, S)
+            c.set(0.)
+            c.maxpy(q, W)
+        self._bank = bank
+        self.U, self.C = self._U[bank][:n], self._C[bank][:n]
+
+
+class deflated_mat():
+    ''' Context of the petsc python Mat of the deflated operator (I - C C^T) A
+    '''
+
+    def __init__(self, space):
+        '''
+        Parameters
+        ----------
+        space : deflation_space
+        '''
+        self.space = space
+
+    def mult(self, mat, x, y):
+        ''' y = (I - C C^T) A x
+        '''
+        self.space._A.mult(x, y)
+        self.space.project(y)
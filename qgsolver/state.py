@@ -38,6 +38,8 @@ class state():
         self.PSI = da.createGlobalVec()
         # density
         self.RHO = da.createGlobalVec()
+        # ghosted work vector, ghosted metric terms are fetched once (see grid.get_local_D)
+        self._lPSI = da.createLocalVec()
 
         #
         # vertical stratification and Coriolis
@@ -347,26 +349,21 @@ class state():
         '''
 
         ### create global vectors
-        self._U = da.createGlobalVec()
-        self._V = da.createGlobalVec()
-
-        ### create local vectors
-        local_PSI = da.createLocalVec()
-        local_D = da.createLocalVec()
+        if not hasattr(self, '_U'):
+            self._U = da.createGlobalVec()
+            self._V = da.createGlobalVec()
 
         #### load vector PSI used to compute U and V
         if PSI is None:
-            da.globalToLocal(self.PSI, local_PSI)
+            da.globalToLocal(self.PSI, self._lPSI)
         else:
-            da.globalToLocal(PSI, local_PSI)
-
-        da.globalToLocal(grid.D, local_D)
+            da.globalToLocal(PSI, self._lPSI)
 
         #
         u = da.getVecArray(self._U)
         v = da.getVecArray(self._V)
-        psi = da.getVecArray(local_PSI)
-        D = da.getVecArray(local_D)
+        psi = da.getVecArray(self._lPSI)
+        D = grid.get_local_D()
 
         mx, my, mz = da.getSizes()
         (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
@@ -420,34 +417,27 @@ class state():
         # average spatially
         KE = self._lKE.sum()
         Vol = self._Vol.sum()
-        self._lKE.destroy()
-        self._Vol.destroy()
 
         return KE / Vol
 
     def _compute_local_KE(self, da, grid, PSI=None):
 
         # create global vectors
-        self._lKE = da.createGlobalVec()
-        self._Vol = da.createGlobalVec()
-
-        # create local vectors
-        local_PSI = da.createLocalVec()
-        local_D = da.createLocalVec()
+        if not hasattr(self, '_lKE'):
+            self._lKE = da.createGlobalVec()
+            self._Vol = da.createGlobalVec()
 
         # load vector PSI used to compute U and V
         if PSI is None:
-            da.globalToLocal(self.PSI, local_PSI)
+            da.globalToLocal(self.PSI, self._lPSI)
         else:
-            da.globalToLocal(PSI, local_PSI)
-
-        da.globalToLocal(grid.D, local_D)
+            da.globalToLocal(PSI, self._lPSI)
 
         #
         lKE = da.getVecArray(self._lKE)
         Vol = da.getVecArray(self._Vol)
-        psi = da.getVecArray(local_PSI)
-        D = da.getVecArray(local_D)
+        psi = da.getVecArray(self._lPSI)
+        D = grid.get_local_D()
 
         mx, my, mz = da.getSizes()
         (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
@@ -476,6 +466,7 @@ class state():
                         Vol[i, j, k] = grid.dzt[k] * D[i, j, kdxt] * D[i, j, kdyt]
                         lKE[i, j, k] = 0.5 * (u ** 2 + v ** 2) * Vol[i, j, k]
 
+
 def add(state1, state2, da=None, a1=1., a2=1.):
     ''' add fields of two states: a1*state1 + a2*state2 
 
@@ -7,7 +7,8 @@ import numpy as np
 
 #from .set_L import *
 from .inout import write_nc
-from .utils import g, rho0
+from .halo import halo_exchange
+from .utils import g, rho0, _shift
 
 
 #
@@ -45,15 +46,23 @@ class time_stepper():
         ### 4 steps explicit RungeKutta parameters
         self._b = [1./6., 1./3., 1./3., 1./6.]
         self._a = [0.5, 0.5, 1.]
+        # stage times, passed to the PV inversion for the extrapolation of initial guesses
+        self._c = [0., 0.5, 0.5, 1.]
 
         ### additional global vectors
         self._Q0 = da.createGlobalVec()
         self._Q1 = da.createGlobalVec()
         self._RHS = da.createGlobalVec()
         
-        # declare local vectors
-        #self.local_Q  = da.createLocalVec()
-        #self.local_PSI  = da.createLocalVec()
+        # ghost points of Q and PSI are exchanged together, once per RK stage
+        self._halo = halo_exchange(da, 2)
+        # ghosted background Q and PSI, see go
+        self._bq, self._bpsi = None, None
+        # tile interior and rim blocks, see _get_blocks
+        self._blocks = None
+        (xs, xe), (ys, ye), _ = da.getRanges()
+        (gxs, gxe), (gys, gye), _ = da.getGhostRanges()
+        self._tile_hsl = (slice(xs-gxs, xe-gxs), slice(ys-gys, ye-gys))
         
         if self._verbose>0:
             print('PV time stepper is set up')
@@ -95,6 +104,12 @@ class time_stepper():
             if bstate is not None:
                 self._copy_topdown_rho_to_q(da, grid, bstate, True)
 
+        # the background state is not time stepped, its ghost points are exchanged once
+        if bstate is not None:
+            self._bq, self._bpsi = [a.copy() for a in self._halo.exchange(da, bstate.Q, bstate.PSI)]
+        else:
+            self._bq, self._bpsi = None, None
+
         _tstep=0
         while _tstep < nt:
             # update time parameters and indexes
@@ -108,18 +123,12 @@ class time_stepper():
                 #if rho_sb:
                 #    self._reset_topdown_rho(da, grid, state)
                 #
-                numit += pvinv.solve(da, grid, state, Q=self._Q1, topdown_rho=True, numit=True)/4.
+                numit += pvinv.solve(da, grid, state, Q=self._Q1, topdown_rho=True, numit=True,
+                                     t=self.t+(self._c[rk]-1.)*self.dt)/4.
                 #
                 self._RHS.set(0.)
                 #
-                if bstate is None:
-                    self._computeADV(da, grid, state.Q, state.PSI)
-                else:
-                    self._computeADV(da, grid, state.Q, state.PSI)
-                    self._computeADV(da, grid, state.Q, bstate.PSI)
-                    self._computeADV(da, grid, bstate.Q, state.PSI)
-                #
-                self._computeDISS(da, grid, state.Q)
+                self._computeRHS(da, grid, state, bstate)
                 #
                 if rk < 3:
                     # Q = a[rk]*dt*_RHS + _Q0
@@ -136,7 +145,9 @@ class time_stepper():
                 #print('t = %f d' % (self.t/86400.), flush=True)
         # need to invert PV one final time in order to get right PSI
         da.getComm().barrier()
-        pvinv.solve(da, grid, state, topdown_rho=True)
+        pvinv.solve(da, grid, state, topdown_rho=True, t=self.t)
+        if self._verbose>0 and pvinv._guess is not None:
+            print(pvinv._guess.report(), flush=True)
         if rho_sb:
             #self._reset_topdown_rho(da, grid, state)
             # reset q
@@ -146,11 +157,77 @@ class time_stepper():
         if self._verbose>1:
             print('Time stepping done --->')
 
+#
+# ==================== Compute RHS ============================================
+#
+
+    def _computeRHS(self, da, grid, state, bstate=None):
+        ''' Compute the RHS of the pv evolution equation: advection and dissipation.
+        Ghost points of Q and PSI are exchanged in a single scatter, those of the
+        background state are exchanged at the beginning of the time stepping (see go).
+        The exchange is overlapped with the computation over the tile interior, whose
+        neighbours lie within the tile, the tile rim is computed once ghost points are received.
+
+        Parameters
+        ----------
+        da: Petsc DMDA
+            holds Petsc grid
+        grid: grid object
+            qgsolver grid object
+        state: state object
+            ocean state that is time stepped
+        bstate : state object, None, optional
+            background state that will be added in advective terms
+        '''
+        interior, rim = self._get_blocks(da, grid)
+        dq = da.getVecArray(self._RHS)[...]
+        # lateral boundaries
+        self._zero_tile_rim(dq, self._get_tile_slices(da, grid)[1])
+        #
+        self._halo.begin(da, state.Q, state.PSI)
+        # tile interior from tile arrays
+        q, psi = da.getVecArray(state.Q)[...], da.getVecArray(state.PSI)[...]
+        if bstate is None:
+            self._computeRHS_block(da, grid, interior, q, psi)
+        else:
+            self._computeRHS_block(da, grid, interior, q, psi,
+                                   da.getVecArray(bstate.Q)[...], da.getVecArray(bstate.PSI)[...])
+        # tile rim from ghosted arrays
+        q, psi = self._halo.end()
+        for block in rim:
+            if bstate is None:
+                self._computeRHS_block(da, grid, block, q, psi)
+            else:
+                self._computeRHS_block(da, grid, block, q, psi, self._bq, self._bpsi)
+
+    def _computeRHS_block(self, da, grid, block, q, psi, bq=None, bpsi=None):
+        ''' Compute advection and dissipation over a block of the tile
+
+        Parameters
+        ----------
+        da: Petsc DMDA
+            holds Petsc grid
+        grid: grid object
+            qgsolver grid object
+        block: tuple
+            block indices, see _get_blocks
+        q, psi: ndarray
+            potential vorticity and streamfunction arrays, tile or ghosted arrays (see block)
+        bq, bpsi: ndarray, None, optional
+            background potential vorticity and streamfunction arrays
+        '''
+        self._computeADV(da, grid, block, q, psi)
+        if bq is not None:
+            self._computeADV(da, grid, block, q, bpsi)
+            self._computeADV(da, grid, block, bq, psi)
+        #
+        self._computeDISS(da, grid, block, q)
+
 #
 # ==================== Compute RHS advection ============================================
 #
 
-    def _computeADV(self, da, grid, Q, PSI):
+    def _computeADV(self, da, grid, block, q, psi):
         ''' Wrapper around RHS computation code
         
         Parameters
@@ -159,15 +236,17 @@ class time_stepper():
             holds Petsc grid
         grid: grid object
             qgsolver grid object
-        Q, PSI: Petsc Vec
-            potential vorticity and streamfunction used
+        block: tuple
+            block indices, see _get_blocks
+        q, psi: ndarray
+            potential vorticity and streamfunction arrays
         '''
         if self._flag_hgrid_uniform and self._flag_vgrid_uniform:
-            self._computeADV_uniform(da, grid, Q, PSI)
+            self._computeADV_uniform(da, grid, block, q, psi)
         else:
-            self._computeADV_curv(da, grid, Q, PSI)
+            self._computeADV_curv(da, grid, block, q, psi)
 
-    def _computeADV_uniform(self, da, grid, Q, PSI):
+    def _computeADV_uniform(self, da, grid, block, q, psi):
         ''' Compute the advection of the pv evolution equation i.e: J(psi,q)
         Jacobian 9 points (from Q-GCM):
         Arakawa and Lamb 1981:
@@ -179,73 +258,25 @@ class time_stepper():
             holds Petsc grid
         grid: grid object
             qgsolver grid object
-        Q, PSI: Petsc Vec
-            potential vorticity and streamfunction used
+        block: tuple
+            block indices, see _get_blocks
+        q, psi: ndarray
+            potential vorticity and streamfunction arrays
         '''
         
-        # declare local vectors
-        local_Q  = da.createLocalVec()
-        local_PSI  = da.createLocalVec()
-        #local_Q = self.local_Q
-        #local_PSI = self.local_PSI
+        dq = da.getVecArray(self._RHS)[...]
         #
-        da.globalToLocal(Q, local_Q)
-        da.globalToLocal(PSI, local_PSI)
+        dx, dy = grid.dx, grid.dy
+        idx, idy = [1.0/dl for dl in [dx, dy]]
         #
-        q = da.getVecArray(local_Q)
-        psi = da.getVecArray(local_PSI)
-        dq = da.getVecArray(self._RHS)
-        #
-        mx, my, mz = da.getSizes()
-        dx, dy, dz = grid.dx, grid.dy, grid.dz
-        idx, idy, idz = [1.0/dl for dl in [dx, dy, dz]]
-        idx2, idy2, idz2 = [1.0/dl**2 for dl in [dx, dy, dz]]
-        #
-        (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
-        istart = grid.istart
-        iend = grid.iend
-        jstart = grid.jstart
-        jend = grid.jend
-        kdown = grid.kdown
-        kup = grid.kup
+        sl, lsl, hsl, ghosted = block
         #
         # advect PV:
         # RHS= -u x dq/dx - v x dq/dy = -J(psi,q) = - (-dpsi/dy x dq/dx + dpsi/dx x dq/dy)
         #
-        for k in range(zs, ze):
-            for j in range(ys, ye):
-                for i in range(xs, xe):
-                    if (i <= istart or i >= iend or j <= jstart or j >= jend) \
-                            and self.petscBoundaryType is not 'periodic':
-                        # lateral boundaries
-                        dq[i, j, k] = 0.
-                    else:
-                        ### Jacobian
-                        #
-                        # naive approach leads to noodling (see Arakawa 1966, J_pp)
-                        # dq[i, j, k] = - ( -dpsidy * dqdx + dpsidx * dqdy)
-                        # 
-                        # Arakawa Jacobian
-                        #
-                        J_pp =   ( q[i+1,j,k] - q[i-1,j,k] ) * ( psi[i,j+1,k] - psi[i,j-1,k] ) \
-                               - ( q[i,j+1,k] - q[i,j-1,k] ) * ( psi[i+1,j,k] - psi[i-1,j,k] )
-                        J_pp *= idx*idy*0.25
-                        #
-                        J_pc =   q[i+1,j,k] * (psi[i+1,j+1,k]-psi[i+1,j-1,k]) \
-                               - q[i-1,j,k] * (psi[i-1,j+1,k]-psi[i-1,j-1,k]) \
-                               - q[i,j+1,k] * (psi[i+1,j+1,k]-psi[i-1,j+1,k]) \
-                               + q[i,j-1,k] * (psi[i+1,j-1,k]-psi[i-1,j-1,k])
-                        J_pc *= idx*idy*0.25
-                        #
-                        J_cp =   q[i+1,j+1,k] * (psi[i,j+1,k]-psi[i+1,j,k]) \
-                               - q[i-1,j-1,k] * (psi[i-1,j,k]-psi[i,j-1,k]) \
-                               - q[i-1,j+1,k] * (psi[i,j+1,k]-psi[i-1,j,k]) \
-                               + q[i+1,j-1,k] * (psi[i+1,j,k]-psi[i,j-1,k])
-                        J_cp *= idx*idy*0.25
-                        #
-                        dq[i, j, k] += ( J_pp + J_pc + J_cp )/3.
-
-    def _computeADV_curv(self,da, grid, Q, PSI):
+        dq[lsl] += _arakawa_jacobian(q, psi, sl, idx*idy*0.25)
+
+    def _computeADV_curv(self, da, grid, block, q, psi):
         ''' Compute the RHS of the pv evolution equation i.e: J(psi,q)
         Jacobian 9 points (from Q-GCM):
         Arakawa and Lamb 1981:
@@ -257,96 +288,35 @@ class time_stepper():
             holds Petsc grid
         grid: grid object
             qgsolver grid object
-        Q, PSI: Petsc Vec
-            potential vorticity and streamfunction used
+        block: tuple
+            block indices, see _get_blocks
+        q, psi: ndarray
+            potential vorticity and streamfunction arrays
         '''
 
-        # declare local vectors
-        local_Q  = da.createLocalVec()
-        local_PSI  = da.createLocalVec()
+        dq = da.getVecArray(self._RHS)[...]
         #
-        da.globalToLocal(Q, local_Q)
-        da.globalToLocal(PSI, local_PSI)
+        self._load_metric(da, grid)
         #
-        q = da.getVecArray(local_Q)
-        psi = da.getVecArray(local_PSI)
-        dq = da.getVecArray(self._RHS)
+        sl, lsl, hsl, ghosted = block
+        f = self._f if ghosted else self._f[self._tile_hsl]
         #
-        local_D  = da.createLocalVec()
-        da.globalToLocal(grid.D, local_D)
-        D = da.getVecArray(local_D)
-        kdxt, kdyt = grid._k_dxt, grid._k_dyt
-        kf = grid._k_f
-        kmask = grid._k_mask
+        # advect PV:
+        # RHS= -u x dq/dx - v x dq/dy = -J(psi,q) = - (-dpsi/dy x dq/dx + dpsi/dx x dq/dy)
         #
-        (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
+        adv = _arakawa_jacobian(q, psi, sl, 0.25)
         #
-        istart = grid.istart
-        iend = grid.iend
-        jstart = grid.jstart
-        jend = grid.jend
+        # Add advection of planetary vorticity, shouldn't f-f0 be part of q though !!!
+        adv += _arakawa_jacobian(np.broadcast_to(f, psi.shape), psi, sl, 0.25)
+        adv *= self._iA[hsl]
         #
-        # advect PV:
-        # RHS= -u x dq/dx - v x dq/dy = -J(psi,q) = - (-dpsi/dy x dq/dx + dpsi/dx x dq/dy)
-        # 
-        for k in range(zs, ze):
-            for j in range(ys, ye):
-                for i in range(xs, xe):
-                    if (( i <= istart or i >= iend or j <= jstart or j >= jend)
-                            and self.petscBoundaryType is not 'periodic') \
-                            or D[i,j,kmask] == 0.:
-                        # lateral boundaries
-                        dq[i, j, k] = 0.
-                    else:
-                        # Jacobian
-                        #
-                        # naive approach leads to noodling (see Arakawa 1966, J_pp)
-                        # dq[i, j, k] = - ( -dpsidy * dqdx + dpsidx * dqdy)
-                        # 
-                        # Arakawa Jacobian
-                        #
-                        J_pp =   ( q[i+1,j,k] - q[i-1,j,k] ) * ( psi[i,j+1,k] - psi[i,j-1,k] ) \
-                               - ( q[i,j+1,k] - q[i,j-1,k] ) * ( psi[i+1,j,k] - psi[i-1,j,k] )
-                        J_pp *= 0.25
-                        #
-                        J_pc =   q[i+1,j,k] * (psi[i+1,j+1,k]-psi[i+1,j-1,k]) \
-                               - q[i-1,j,k] * (psi[i-1,j+1,k]-psi[i-1,j-1,k]) \
-                               - q[i,j+1,k] * (psi[i+1,j+1,k]-psi[i-1,j+1,k]) \
-                               + q[i,j-1,k] * (psi[i+1,j-1,k]-psi[i-1,j-1,k])
-                        J_pc *= 0.25
-                        #
-                        J_cp =   q[i+1,j+1,k] * (psi[i,j+1,k]-psi[i+1,j,k]) \
-                               - q[i-1,j-1,k] * (psi[i-1,j,k]-psi[i,j-1,k]) \
-                               - q[i-1,j+1,k] * (psi[i,j+1,k]-psi[i-1,j,k]) \
-                               + q[i+1,j-1,k] * (psi[i+1,j,k]-psi[i,j-1,k])
-                        J_cp *= 0.25
-                        #
-                        dq[i, j, k] += ( J_pp + J_pc + J_cp )/3. /D[i,j,kdxt]/D[i,j,kdyt]
-                        #
-                        # Add advection of planetary vorticity, shouldn't f-f0 be part of q though !!!
-                        Jp_pp =   ( D[i+1,j,kf] - D[i-1,j,kf] ) * ( psi[i,j+1,k] - psi[i,j-1,k] ) \
-                               - ( D[i,j+1,kf] - D[i,j-1,kf] ) * ( psi[i+1,j,k] - psi[i-1,j,k] )
-                        Jp_pp *= 0.25
-                        #
-                        Jp_pc =  D[i+1,j,kf] * (psi[i+1,j+1,k]-psi[i+1,j-1,k]) \
-                               - D[i-1,j,kf] * (psi[i-1,j+1,k]-psi[i-1,j-1,k]) \
-                               - D[i,j+1,kf] * (psi[i+1,j+1,k]-psi[i-1,j+1,k]) \
-                               + D[i,j-1,kf] * (psi[i+1,j-1,k]-psi[i-1,j-1,k])
-                        Jp_pc *= 0.25
-                        #
-                        Jp_cp =  D[i+1,j+1,kf] * (psi[i,j+1,k]-psi[i+1,j,k]) \
-                               - D[i-1,j-1,kf] * (psi[i-1,j,k]-psi[i,j-1,k]) \
-                               - D[i-1,j+1,kf] * (psi[i,j+1,k]-psi[i-1,j,k]) \
-                               + D[i+1,j-1,kf] * (psi[i+1,j,k]-psi[i,j-1,k])
-                        Jp_cp *= 0.25
-                        #
-                        dq[i, j, k] += ( Jp_pp + Jp_pc + Jp_cp )/3. /D[i,j,kdxt]/D[i,j,kdyt]
+        self._add_masked(dq, lsl, hsl, adv)
 
 #
 # ==================== Compute RHS dissipation ============================================
 #
 
-    def _computeDISS(self, da, grid, Q):
+    def _computeDISS(self, da, grid, block, q):
         ''' Wrapper around RHS computation code
         
         Parameters
@@ -355,15 +325,17 @@ class time_stepper():
             holds Petsc grid
         grid: grid object
             qgsolver grid object
-        Q: Petsc Vec
-            potential vorticity used
+        block: tuple
+            block indices, see _get_blocks
+        q: ndarray
+            potential vorticity array
         '''
         if self._flag_hgrid_uniform and self._flag_vgrid_uniform:
-            self._computeDISS_uniform(da, grid, Q)
+            self._computeDISS_uniform(da, grid, block, q)
         else:
-            self._computeDISS_curv(da, grid, Q)
+            self._computeDISS_curv(da, grid, block, q)
 
-    def _computeDISS_uniform(self, da, grid, Q):
+    def _computeDISS_uniform(self, da, grid, block, q):
         ''' Compute potential vorticity diffusion, uniform grid
         
         Parameters
@@ -372,44 +344,25 @@ class time_stepper():
             holds Petsc grid
         grid: grid object
             qgsolver grid object
-        state: state object
-            qgsolver state object
+        block: tuple
+            block indices, see _get_blocks
+        q: ndarray
+            potential vorticity array
         '''
         
-        # declare local vectors
-        local_Q  = da.createLocalVec()
+        dq = da.getVecArray(self._RHS)[...]
         #
-        da.globalToLocal(Q, local_Q)
+        dx, dy = grid.dx, grid.dy
+        idx2, idy2 = [1.0/dl**2 for dl in [dx, dy]]
         #
-        q = da.getVecArray(local_Q)
-        dq = da.getVecArray(self._RHS)
-        #
-        dx, dy, dz = grid.dx, grid.dy, grid.dz
-        idx2, idy2, idz2 = [1.0/dl**2 for dl in [dx, dy, dz]]
-        #
-        (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
-        istart = grid.istart
-        iend = grid.iend
-        jstart = grid.jstart
-        jend = grid.jend
+        sl, lsl, hsl, ghosted = block
         #
         # PV dissipation
         # RHS= K*laplacian(q)
         #
-        for k in range(zs, ze):
-            for j in range(ys, ye):
-                for i in range(xs, xe):
-                    if (i <= istart or i >= iend or j <= jstart or j >= jend) \
-                            and self.petscBoundaryType is not 'periodic':
-                        # lateral boundaries
-                        dq[i, j, k] = 0.
-                    else:
-                        #
-                        # Dissipation
-                        dq[i, j, k] +=   self.K*(q[i+1,j,k]-2.*q[i,j,k]+q[i-1,j,k])*idx2 \
-                                       + self.K*(q[i,j+1,k]-2.*q[i,j,k]+q[i,j-1,k])*idy2  
-
-    def _computeDISS_curv(self, da, grid, Q):
+        dq[lsl] += _laplacian(q, sl, self.K, idx2, idy2)
+
+    def _computeDISS_curv(self, da, grid, block, q):
         ''' Compute potential vorticity diffusion, curvilinear grid
         
         Parameters
@@ -418,49 +371,29 @@ class time_stepper():
             holds Petsc grid
         grid: grid object
             qgsolver grid object
-        state: state object
-            qgsolver state object
+        block: tuple
+            block indices, see _get_blocks
+        q: ndarray
+            potential vorticity array
         '''
 
-        # declare local vectors
-        local_Q  = da.createLocalVec()
-        #
-        da.globalToLocal(Q, local_Q)
-        #
-        q = da.getVecArray(local_Q)
-        dq = da.getVecArray(self._RHS)
+        dq = da.getVecArray(self._RHS)[...]
         #
-        local_D = da.createLocalVec()
-        da.globalToLocal(grid.D, local_D)
-        D = da.getVecArray(local_D)
-        kdxu, kdyu = grid._k_dxu, grid._k_dyu
-        kdxv, kdyv = grid._k_dxv, grid._k_dyv
-        kdxt, kdyt = grid._k_dxt, grid._k_dyt
-        kmask = grid._k_mask
+        self._load_metric(da, grid)
         #
-        (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
-        istart = grid.istart
-        iend = grid.iend
-        jstart = grid.jstart
-        jend = grid.jend
+        sl, lsl, hsl, ghosted = block
+        if ghosted:
+            ryu, rxv = self._ryu, self._rxv
+        else:
+            ryu, rxv = self._ryu[self._tile_hsl], self._rxv[self._tile_hsl]
         #
         # PV dissipation
         # RHS= K*laplacian(q)
-        # 
-        for k in range(zs, ze):
-            for j in range(ys, ye):
-                for i in range(xs, xe):
-                    if ((i <= istart or i >= iend or j <= jstart or j >= jend)   \
-                            and self.petscBoundaryType is not 'periodic')        \
-                            or D[i,j,kmask]==0.:
-                        # lateral boundaries
-                        dq[i, j, k] = 0.
-                    else:
-                        dq[i, j, k] += self.K/D[i,j,kdxt]/D[i,j,kdyt] * (
-                                                (q[i+1,j,k]-q[i,j,k]) * D[i,j,kdyu]/D[i,j,kdxu]
-                                               -(q[i,j,k]-q[i-1,j,k]) * D[i-1,j,kdyu]/D[i-1,j,kdxu]
-                                               +(q[i,j+1,k]-q[i,j,k]) * D[i,j,kdxv]/D[i,j,kdyv]
-                                               -(q[i,j,k]-q[i,j-1,k]) * D[i,j-1,kdxv]/D[i,j-1,kdyv])
+        #
+        diss = _laplacian_curv(q, ryu, rxv, sl)
+        diss *= self.K*self._iA[hsl]
+        #
+        self._add_masked(dq, lsl, hsl, diss)
 
 
 #
@@ -592,3 +525,251 @@ class time_stepper():
                 q[i, j, kdown] = q[i, j, kdown+1]
                 q[i, j, kup] = q[i, j, kup-1]
 
+
+    def _load_metric(self, da, grid):
+        ''' Compute the ghosted metric coefficients used by the curvilinear
+        kernels and store them as (x, y, 1) arrays:
+        _iA = 1/dxt/dyt, _ryu = dyu/dxu, _rxv = dxv/dyv, _f and _wet (mask!=0).
+        Coefficients are computed again once metric terms are modified (grid._reset_local_D)
+
+        Parameters
+        ----------
+        da: Petsc DMDA
+            holds Petsc grid
+        grid: grid object
+            qgsolver grid object
+        '''
+        if getattr(self, '_metric_version', None) == grid._D_version:
+            return
+        #
+        # ghosted 2D metric terms, same ghost ranges as 3D arrays along x and y
+        D = grid.get_local_D()[...]
+        #
+        def metric(k):
+            return D[:, :, k, None]
+        #
+        # ghost points outside the domain are zero
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self._iA = 1./metric(grid._k_dxt)/metric(grid._k_dyt)
+            self._ryu = metric(grid._k_dyu)/metric(grid._k_dxu)
+            self._rxv = metric(grid._k_dxv)/metric(grid._k_dyv)
+        self._f = metric(grid._k_f).copy()
+        if grid.mask:
+            self._wet = metric(grid._k_mask) != 0.
+        else:
+            self._wet = None
+        self._metric_version = grid._D_version
+
+    def _add_masked(self, dq, lsl, hsl, incr):
+        ''' Add an increment to a block of the tile and set masked (land) points to 0
+
+        Parameters
+        ----------
+        dq: ndarray
+            tile array
+        lsl: tuple of slices
+            block indices in tile array
+        hsl: tuple of slices
+            block horizontal indices in ghosted arrays
+        incr: ndarray
+            increment over the block
+        '''
+        if self._wet is None:
+            dq[lsl] += incr
+        else:
+            dq[lsl] = np.where(self._wet[hsl], dq[lsl] + incr, 0.)
+
+    def _get_tile_slices(self, da, grid):
+        ''' Block of the local tile where the RHS is computed, i.e. tile points that
+        are not lateral boundary points (whole tile if periodic)
+
+        Parameters
+        ----------
+        da: Petsc DMDA
+            holds Petsc grid
+        grid: grid object
+            qgsolver grid object
+
+        Returns
+        -------
+        gsl: tuple of slices
+            block indices in local (ghosted) arrays
+        lsl: tuple of slices
+            block indices in global (tile) arrays
+        '''
+        (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
+        (gxs, gxe), (gys, gye), (gzs, gze) = da.getGhostRanges()
+        #
+        if self.petscBoundaryType == 'periodic':
+            i0, i1, j0, j1 = xs, xe, ys, ye
+        else:
+            i0 = max(xs, grid.istart+1)
+            i1 = max(i0, min(xe, grid.iend))
+            j0 = max(ys, grid.jstart+1)
+            j1 = max(j0, min(ye, grid.jend))
+        #
+        gsl = (slice(i0-gxs, i1-gxs), slice(j0-gys, j1-gys), slice(zs-gzs, ze-gzs))
+        lsl = (slice(i0-xs, i1-xs), slice(j0-ys, j1-ys), slice(0, ze-zs))
+        return gsl, lsl
+
+    def _get_blocks(self, da, grid):
+        ''' Split the block where the RHS is computed (see _get_tile_slices) into the tile
+        interior, whose -1/+1 neighbours lie within the tile, and strips along the tile rim,
+        which need ghost points
+
+        Parameters
+        ----------
+        da: Petsc DMDA
+            holds Petsc grid
+        grid: grid object
+            qgsolver grid object
+
+        Returns
+        -------
+        interior: tuple
+            (sl, lsl, hsl, ghosted): block indices in source arrays, in tile arrays,
+            horizontal indices in ghosted arrays and False, sources are tile arrays
+        rim: list of tuple
+            same for strips along the rim, sources are ghosted arrays (ghosted is True)
+        '''
+        if self._blocks is not None:
+            return self._blocks
+        #
+        (xs, xe), (ys, ye), (zs, ze) = da.getRanges()
+        (gxs, gxe), (gys, gye), (gzs, gze) = da.getGhostRanges()
+        gsl, lsl = self._get_tile_slices(da, grid)
+        i0, i1 = lsl[0].start+xs, lsl[0].stop+xs
+        j0, j1 = lsl[1].start+ys, lsl[1].stop+ys
+        # interior
+        ii0 = min(max(i0, xs+1), i1)
+        ii1 = max(ii0, min(i1, xe-1))
+        jj0 = min(max(j0, ys+1), j1)
+        jj1 = max(jj0, min(j1, ye-1))
+        #
+        def block(ia, ib, ja, jb, ghosted):
+            lsl = (slice(ia-xs, ib-xs), slice(ja-ys, jb-ys), slice(0, ze-zs))
+            hsl = (slice(ia-gxs, ib-gxs), slice(ja-gys, jb-gys))
+            if ghosted:
+                return (hsl+(slice(zs-gzs, ze-gzs),), lsl, hsl, True)
+            return (lsl, lsl, hsl, False)
+        #
+        interior = block(ii0, ii1, jj0, jj1, False)
+        # west and east strips span the whole block along j
+        rim = [block(i0, ii0, j0, j1, True), block(ii1, i1, j0, j1, True),
+               block(ii0, ii1, j0, jj0, True), block(ii0, ii1, jj1, j1, True)]
+        rim = [b for b in rim if b[1][0].stop > b[1][0].start and b[1][1].stop > b[1][1].start]
+        self._blocks = (interior, rim)
+        return self._blocks
+
+    def _zero_tile_rim(self, dq, lsl):
+        ''' Set to zero tile points that lie outside the block given by lsl
+
+        Parameters
+        ----------
+        dq: ndarray
+            tile array
+        lsl: tuple of slices
+            block indices in tile array, see _get_tile_slices
+        '''
+        dq[:lsl[0].start, :, :] = 0.
+        dq[lsl[0].stop:, :, :] = 0.
+        dq[:, :lsl[1].start, :] = 0.
+        dq[:, lsl[1].stop:, :] = 0.
+
+
+#
+# ==================== array kernels ============================================
+#
+
+def _arakawa_jacobian(q, psi, sl, factor):
+    ''' Jacobian 9 points J(psi,q) (Arakawa and Lamb 1981) computed over a block
+    of ghosted arrays. Operations are carried out in the same order as the
+    original point by point loops and results are thus identical.
+
+    Parameters
+    ----------
+    q, psi: ndarray
+        ghosted arrays, indexed as (i, j, k)
+    sl: tuple of slices
+        block where the jacobian is computed, neighbours at -1/+1 must be available
+    factor: float
+        factor applied to each of the three jacobian estimates
+
+    Returns
+    -------
+    J: ndarray
+        jacobian over the block
+    '''
+    qe, qw, qn, qs = q[_shift(sl,1,0)], q[_shift(sl,-1,0)], q[_shift(sl,0,1)], q[_shift(sl,0,-1)]
+    qne, qsw = q[_shift(sl,1,1)], q[_shift(sl,-1,-1)]
+    qnw, qse = q[_shift(sl,-1,1)], q[_shift(sl,1,-1)]
+    #
+    pe, pw, pn, ps = psi[_shift(sl,1,0)], psi[_shift(sl,-1,0)], psi[_shift(sl,0,1)], psi[_shift(sl,0,-1)]
+    pne, psw = psi[_shift(sl,1,1)], psi[_shift(sl,-1,-1)]
+    pnw, pse = psi[_shift(sl,-1,1)], psi[_shift(sl,1,-1)]
+    #
+    # naive approach leads to noodling (see Arakawa 1966, J_pp)
+    J_pp =   ( qe - qw ) * ( pn - ps ) \
+           - ( qn - qs ) * ( pe - pw )
+    J_pp *= factor
+    #
+    J_pc =   qe * (pne-pse) \
+           - qw * (pnw-psw) \
+           - qn * (pne-pnw) \
+           + qs * (pse-psw)
+    J_pc *= factor
+    #
+    J_cp =   qne * (pn-pe) \
+           - qsw * (pw-ps) \
+           - qnw * (pn-pw) \
+           + qse * (pe-ps)
+    J_cp *= factor
+    #
+    return ( J_pp + J_pc + J_cp )/3.
+
+def _laplacian(q, sl, K, idx2, idy2):
+    ''' Laplacian times K over a block of ghosted arrays, uniform grid
+
+    Parameters
+    ----------
+    q: ndarray
+        ghosted array, indexed as (i, j, k)
+    sl: tuple of slices
+        block where the laplacian is computed, neighbours at -1/+1 must be available
+    K: float
+        dissipation coefficient
+    idx2, idy2: float
+        inverse of squared grid spacings
+
+    Returns
+    -------
+    L: ndarray
+        K times the laplacian over the block
+    '''
+    qc = q[sl]
+    return   K*(q[_shift(sl,1,0)]-2.*qc+q[_shift(sl,-1,0)])*idx2 \
+           + K*(q[_shift(sl,0,1)]-2.*qc+q[_shift(sl,0,-1)])*idy2
+
+def _laplacian_curv(q, ryu, rxv, sl):
+    ''' Curvilinear laplacian times the cell area (dxt*dyt) over a block of ghosted arrays
+
+    Parameters
+    ----------
+    q: ndarray
+        ghosted array, indexed as (i, j, k)
+    ryu, rxv: ndarray
+        ghosted metric ratios dyu/dxu and dxv/dyv, indexed as (i, j, 1)
+    sl: tuple of slices
+        block where the laplacian is computed, neighbours at -1/+1 must be available
+
+    Returns
+    -------
+    L: ndarray
+        laplacian over the block
+    '''
+    qc = q[sl]
+    sw, ss = _shift(sl,-1,0), _shift(sl,0,-1)
+    return   (q[_shift(sl,1,0)]-qc) * ryu[sl[:2]] \
+           - (qc-q[sw]) * ryu[sw[:2]] \
+           + (q[_shift(sl,0,1)]-qc) * rxv[sl[:2]] \
+           - (qc-q[ss]) * rxv[ss[:2]]
@@ -6,6 +6,26 @@
 g = 9.81
 rho0 = 1000.
 
+
+def _shift(sl, di, dj, dk=0):
+    """ Shift a block of indices of ghosted arrays (see timestepper and omegainv kernels)
+
+    Parameters
+    ----------
+    sl : tuple of slices
+        block indices (i, j, k)
+    di, dj, dk : int
+        shifts along i, j and k
+
+    Returns
+    -------
+    tuple of slices
+
+    """
+    return (slice(sl[0].start+di, sl[0].stop+di), slice(sl[1].start+dj, sl[1].stop+dj),
+            slice(sl[2].start+dk, sl[2].stop+dk))
+
+
 class plt():
     """ perform online basic plots
     """
@@ -0,0 +1,249 @@
+#!/usr/bin/python
+# -*- encoding: utf8 -*-
+
+
+import sys
+import numpy as np
+from .pencils import pencils
+
+#
+#==================== Vertical modes PV inversion solver ============================================
+#
+
+
+class vmode_solver():
+    ''' Direct PV inversion solver for horizontally and vertically uniform grids without
+    land points
+
+    The vertical operator (with bottom and top boundary rows eliminated) is diagonalized once,
+    each vertical mode is then the solution of a 2D Helmholtz problem solved with discrete
+    Fourier transforms (periodic domain) or sine transforms (closed domain, lateral Dirichlet
+    boundary conditions). Transforms are distributed over x and y pencils (see pencils.pencils).
+    Solutions are identical to those of the operator assembled in pvinversion._set_L.
+    '''
+
+    def __init__(self, da, grid, bdy_type, sparam, petscBoundaryType, verbose=0):
+        ''' Setup the solver
+
+        Parameters
+        ----------
+        da : petsc DMDA
+            holds the petsc grid
+        grid : qgsolver grid object
+            grid data holder
+        bdy_type : dict
+            vertical boundary conditions: {'bottom': 'D' or 'N_RHO' or 'N_PSI', 'top': ...}
+        sparam : ndarray
+            numpy array containing f^2/N^2
+        petscBoundaryType : str, None
+            'periodic' or None
+        verbose : int, optional
+            degree of verbosity, 0 means no outputs
+        '''
+        self._verbose = verbose
+        if not (grid._flag_hgrid_uniform and grid._flag_vgrid_uniform):
+            print('!Error: vertical modes solver requires a uniform grid')
+            sys.exit()
+        if grid.mask:
+            print('!Error: vertical modes solver does not handle land points')
+            sys.exit()
+        if grid.kup-grid.kdown < 2:
+            print('!Error: vertical modes solver requires at least one interior level')
+            sys.exit()
+        #
+        self.periodic = (petscBoundaryType == 'periodic')
+        self.bottom_N = bdy_type['bottom'] in ['N_RHO', 'N_PSI']
+        self.top_N = bdy_type['top'] in ['N_RHO', 'N_PSI']
+        self.kdown, self.kup = grid.kdown, grid.kup
+        self.istart, self.iend = grid.istart, grid.iend
+        self.jstart, self.jend = grid.jstart, grid.jend
+        self.dz = grid.dz
+        self.idx2, self.idy2, self.idz2 = [1.0/dl**2 for dl in [grid.dx, grid.dy, grid.dz]]
+        self.sparam = np.asarray(sparam)
+        #
+        # tile indices, x and y transforms are computed over pencils
+        (xs, xe), (ys, ye), _ = da.getRanges()
+        (gxs, gxe), (gys, gye), _ = da.getGhostRanges()
+        self._i = np.arange(xs, xe)[:, None]
+        self._j = np.arange(ys, ye)[None, :]
+        self._gstarts, self._gends = (gxs, gys), (gxe, gye)
+        self._interior = ~self._lateral(self._i, self._j)
+        self._local = da.createLocalVec()
+        self._pencils = pencils(da)
+        #
+        self._set_modes(da)
+        if self._verbose>0:
+            print('  Vertical modes solver is set up')
+
+    def _lateral(self, i, j):
+        ''' Flag lateral boundary points (none if periodic)
+        '''
+        if self.periodic:
+            return np.zeros(np.broadcast(i, j).shape, dtype=bool)
+        return (i <= self.istart) | (i >= self.iend) | (j <= self.jstart) | (j >= self.jend)
+
+    def _set_modes(self, da):
+        ''' Eigen decomposition of the vertical operator and inverse of the eigenvalues
+        of the 3D operator over the tile
+        '''
+        kd, ku = self.kdown, self.kup
+        s, idz2 = self.sparam, self.idz2
+        # vertical operator over interior levels, symmetric tridiagonal
+        k = np.arange(kd+1, ku)
+        A = np.diag(-(s[k]+s[k-1])*idz2) \
+            + np.diag(s[k[:-1]]*idz2, 1) + np.diag(s[k[:-1]]*idz2, -1)
+        # Neumann bottom/top rows: psi[kdown] (psi[kup]) is eliminated
+        if self.bottom_N:
+            A[0, 0] += s[kd]*idz2
+        if self.top_N:
+            A[-1, -1] += s[ku-1]*idz2
+        self.lambda_z, self.modes = np.linalg.eigh(A)
+        #
+        # eigenvalues of the horizontal laplacian, wavenumbers are indexed as grid points
+        Nx, Ny, _ = da.getSizes()
+        if self.periodic:
+            mx, my = np.arange(Nx)/Nx, np.arange(Ny)/Ny
+        else:
+            mx = (np.arange(Nx)-self.istart)/(2.*(self.iend-self.istart))
+            my = (np.arange(Ny)-self.jstart)/(2.*(self.jend-self.jstart))
+        lambda_x = -4.*self.idx2*np.sin(np.pi*mx[self._i])**2
+        lambda_y = -4.*self.idy2*np.sin(np.pi*my[self._j])**2
+        #
+        lbd = (lambda_x + lambda_y)[:, :, None] + self.lambda_z[None, None, :]
+        # singular mode (periodic domain with Neumann bottom and top), solution has zero mean
+        scale = 4.*(self.idx2+self.idy2) + np.abs(self.lambda_z).max()
+        regular = self._interior[:, :, None] & (np.abs(lbd) > 1.e-12*scale)
+        self._ilambda = np.where(regular, 1./np.where(regular, lbd, 1.), 0.)
+
+    def destroy(self):
+        ''' Destroy petsc objects and free communicators
+        '''
+        self._local.destroy()
+        self._pencils.destroy()
+
+    def solve(self, da, RHS, PSI):
+        ''' Solve L PSI = RHS
+
+        Parameters
+        ----------
+        da : petsc DMDA
+            holds the petsc grid
+        RHS : petsc Vec
+            right hand side, with boundary conditions (see pvinversion.set_rhs_bdy)
+        PSI : petsc Vec
+            solution
+        '''
+        da.globalToLocal(RHS, self._local)
+        rhs = da.getVecArray(RHS)[...]
+        da.getVecArray(PSI)[...] = self._solve_array(rhs, da.getVecArray(self._local)[...])
+
+    def _solve_array(self, rhs, lrhs):
+        ''' Solve over the tile
+
+        Parameters
+        ----------
+        rhs : ndarray
+            right hand side, tile (x, y, z) array
+        lrhs : ndarray
+            right hand side, ghosted array
+
+        Returns
+        -------
+        psi : ndarray
+            solution, tile array
+        '''
+        kd, ku = self.kdown, self.kup
+        i, j = self._i, self._j
+        interior = self._interior[:, :, None]
+        s = self.sparam
+        #
+        q = rhs[:, :, kd+1:ku].copy()
+        # eliminate lateral boundary values
+        (gxs, gys), (gxe, gye) = self._gstarts, self._gends
+        for di, dj, c in [(-1, 0, self.idx2), (1, 0, self.idx2), (0, -1, self.idy2), (0, 1, self.idy2)]:
+            sel = self._interior & self._lateral(i+di, j+dj)
+            if np.any(sel):
+                nb = lrhs[np.clip(i+di-gxs, 0, gxe-gxs-1), np.clip(j+dj-gys, 0, gye-gys-1), kd+1:ku]
+                q -= np.where(sel[:, :, None], c*nb, 0.)
+        # eliminate bottom and top boundary values
+        rb, rt = rhs[:, :, kd], rhs[:, :, ku]
+        if self.bottom_N:
+            q[:, :, 0] += s[kd]*self.dz*self.idz2*rb
+        else:
+            q[:, :, 0] -= s[kd]*self.idz2*rb
+        if self.top_N:
+            q[:, :, -1] -= s[ku-1]*self.dz*self.idz2*rt
+        else:
+            q[:, :, -1] -= s[ku-1]*self.idz2*rt
+        q = np.where(interior, q, 0.)
+        #
+        # project on vertical modes, horizontal transforms
+        q = q.dot(self.modes)
+        P = self._pencils
+        if self.periodic:
+            q = P.transform(q.astype(complex), 0, lambda p: np.fft.fft(p, axis=0))
+            q = P.transform(q, 1, lambda p: np.fft.fft(p, axis=0))*self._ilambda
+            q = P.transform(q, 0, lambda p: np.fft.ifft(p, axis=0))
+            q = P.transform(q, 1, lambda p: np.fft.ifft(p, axis=0)).real
+        else:
+            dst_x = lambda p: _dst_range(p, self.istart+1, self.iend)
+            dst_y = lambda p: _dst_range(p, self.jstart+1, self.jend)
+            q = P.transform(P.transform(q, 0, dst_x), 1, dst_y)*self._ilambda
+            q = P.transform(P.transform(q, 0, dst_x), 1, dst_y) \
+                * (4./(self.iend-self.istart)/(self.jend-self.jstart))
+        q = q.dot(self.modes.T)
+        #
+        # lateral boundary values, levels below and above the domain are set to 0
+        psi = rhs.copy()
+        psi[:, :, :kd], psi[:, :, ku+1:] = 0., 0.
+        psi[:, :, kd+1:ku] = np.where(interior, q, psi[:, :, kd+1:ku])
+        if self.bottom_N:
+            rb = q[:, :, 0] - self.dz*rb
+        if self.top_N:
+            rt = q[:, :, -1] + self.dz*rt
+        psi[:, :, kd] = np.where(self._interior, rb, psi[:, :, kd])
+        psi[:, :, ku] = np.where(self._interior, rt, psi[:, :, ku])
+        return psi
+
+
+def _dst_range(p, i0, i1):
+    ''' Type I discrete sine transform along the first axis of p, over the [i0, i1[ range
+
+    Parameters
+    ----------
+    p : ndarray
+        input array, modified in place
+    i0, i1 : int
+        transform range
+
+    Returns
+    -------
+    p : ndarray
+        transformed array
+    '''
+    p[i0:i1] = _dst(p[i0:i1], 0)
+    return p
+
+
+def _dst(x, axis):
+    ''' Type I discrete sine transform along an axis: X_k = sum_n x_n sin(pi (n+1)(k+1)/(N+1)),
+    its inverse is 2/(N+1) times itself
+
+    Parameters
+    ----------
+    x : ndarray
+        input array
+    axis : int
+        axis along which the transform is computed
+
+    Returns
+    -------
+    X : ndarray
+        transformed array
+    '''
+    x = np.moveaxis(x, axis, -1)
+    n = x.shape[-1]
+    z = np.zeros(x.shape[:-1]+(1,))
+    y = np.concatenate([z, x, z, -x[..., ::-1]], axis=-1)
+    X = -0.5*np.fft.rfft(y, axis=-1).imag[..., 1:n+1]
+    return np.moveaxis(X, -1, axis)
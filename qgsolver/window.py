@@ -12,7 +12,8 @@ from petsc4py import PETSc
 
 import numpy as np
 from .inout import read_nc_petsc, read_nc_petsc_2D
-from .inout import write_nc
+from .inout import write_nc, record_writer
+from .pvinv import stencil_operator
 
 
 
@@ -28,16 +29,19 @@ class window():
                  ncores_x=None, ncores_y=None,
                  bdy_type_in={},
                  mask3D=False,
+                 decoupled=None,
                  verbose = 1,
                  ):
         """ Window model creation
         Parameters:
+            decoupled: solve levels as independent 2D problems (default when the mask is 2D),
+                       see wininversion
         """
 
         #
         # Build grid object
         #
-        self.grid = grid(hgrid, vgrid, vdom, hdom, verbose=verbose)
+        self.grid = grid(hgrid, vgrid, hdom, vdom, verbose=verbose)
 
         #
         # init petsc
@@ -52,7 +56,9 @@ class window():
         # setup tiling
         self.da = PETSc.DMDA().create(sizes = [self.grid.Nx, self.grid.Ny, self.grid.Nz],
                                       proc_sizes = [ncores_x,ncores_y,1],
-                                      stencil_width = 2)
+                                      stencil_width = 1)
+        # star stencil for the 7 points operator, same ownership ranges
+        self.da_op = self.da.duplicate(stencil_type = 'star')
         # http://lists.mcs.anl.gov/pipermail/petsc-dev/2016-April/018889.html
         self.comm = self.da.getComm()
         self.rank = self.comm.getRank()
@@ -77,11 +83,15 @@ class window():
 
         # for lon/lat grids should load metric terms over tiles
         if not self.grid._flag_hgrid_uniform or not self.grid._flag_vgrid_uniform:
-            self.grid.load_metric_terms(self.da, self.comm)
+            self.grid.load_metric_terms(self.da)
         
+        # uniform grids: constant metric terms for the curvilinear operator
+        if self.grid._flag_hgrid_uniform:
+            self.grid.set_uniform_metric(self.da)
+
         # initialize mask
         self.mask3D=mask3D
-        self.grid.load_mask(self.grid.hgrid_file, self.da, self.comm, mask3D=self.mask3D)
+        self.grid.load_mask(self.grid.hgrid_file, self.da, mask3D=self.mask3D)
 
         #
         if self._verbose>0:
@@ -109,7 +119,7 @@ class window():
         self.PSI = self.da.createGlobalVec()
 
         # initiate pv inversion solver
-        self.wininv = wininversion(self)
+        self.wininv = wininversion(self, decoupled=decoupled)
 
 
     def set_q(self, analytical_q=True, file_q=None):
@@ -119,7 +129,7 @@ class window():
         if file_q is not None:
             if self._verbose:
                 print('Set q from file '+file_q+' ...')
-            read_nc_petsc(self.Q, 'q', file_q, self, fillmask=0.)
+            read_nc_petsc(self.Q, 'q', file_q, self.da, self.grid, fillmask=0.)
         elif analytical_q:
             self.set_q_analytically()
 
@@ -132,10 +142,7 @@ class window():
         #
         if self._verbose:
             print('Set rhs analytically to k^⁻2')
-        for k in range(zs, ze):
-            for j in range(ys, ye):
-                for i in range(xs, xe):
-                    q[i, j, k] = -self._K2
+        q[xs:xe, ys:ye, zs:ze] = -self._K2
 
 
     def invert_win(self):
@@ -143,6 +150,46 @@ class window():
         """
         self.wininv.solve(self)
 
+    def set_K(self, K, reuse_pc=False):
+        """ Change the wavenumber K, only the diagonal of the operator is shifted
+        Parameters:
+            K: wavenumber
+            reuse_pc: keep the preconditioner built for the previous K
+        """
+        self.K = K
+        self._K2 = K**2
+        self.wininv.set_K(self, reuse_pc=reuse_pc)
+
+    def invert_win_K(self, Ks, output_file=None, analytical_q=True, reuse_pc=False,
+                     parallel=False):
+        """ Compute windows for a list of wavenumbers K in one pass: the operator is assembled
+        once and its diagonal is shifted for each K (see set_K)
+        Parameters:
+            Ks: list of wavenumbers
+            output_file: netcdf file where windows are stored along a K dimension
+                         (variable 'window'), windows are not stored if None
+            analytical_q: q is set to -K**2 for each K, q is unchanged otherwise
+            reuse_pc: the preconditioner of the first K is used for all K
+            parallel: netcdf file written in parallel (see inout.write_nc)
+        """
+        writer = None
+        try:
+            if output_file is not None:
+                writer = record_writer(output_file, ['window'], self.da, self.grid,
+                                       parallel=parallel, record_dim='K')
+            for n, K in enumerate(Ks):
+                self.set_K(K, reuse_pc=(reuse_pc and n>0))
+                if analytical_q:
+                    self.set_q_analytically()
+                self.invert_win()
+                if writer is not None:
+                    writer.write([self.PSI], value=K)
+                if self._verbose>0:
+                    print('Window computed for K=%e' %K)
+        finally:
+            if writer is not None:
+                writer.close()
+
 
 
 
@@ -153,22 +200,43 @@ class window():
 
 class wininversion():
     """ Window inversion, parallel
+
+    The operator has no vertical coupling: with a 2D mask, all levels share the same 2D
+    Helmholtz operator. The levels are then solved as independent 2D problems (decoupled
+    solve): the 2D operator is assembled and preconditioned once, and all levels are
+    passed as the columns of a dense matrix of right hand sides (KSPMatSolve), each rank
+    holding its horizontal tile of every level. Levels are only solved at once by block
+    Krylov solvers (-ksp_type hpddm, petsc built with HPDDM): other solvers loop over
+    levels, and the gain over the 3D solve comes from the smaller operator and
+    preconditioner only. The 3D operator is used with a 3D mask or if decoupled=False.
     """
     
-    def __init__(self, win):
+    def __init__(self, win, decoupled=None):
         """ Setup the PV inversion solver
         """
                 
         self._verbose = win._verbose
         
+        if decoupled is None:
+            decoupled = not win.mask3D
+        elif decoupled and win.mask3D:
+            if self._verbose>0:
+                print('Warning: levels cannot be decoupled with a 3D mask, 3D solve is used')
+            decoupled = False
+        self.decoupled = decoupled
+        if self.decoupled:
+            self._setup_2D(win)
+            return
+
         # create the operator
-        self.L = win.da.createMat()
+        self.L = win.da_op.createMat()
         #
         if self._verbose>0:
             print('Operator L declared')
 
         # Fill in operator values
         self._set_L_curv(self.L, win)
+        self._set_interior(win)
 
         #
         if self._verbose>0:
@@ -206,9 +274,67 @@ class wininversion():
             
             
 
+    def _setup_2D(self, win):
+        """ Setup the 2D operator and solver shared by all levels
+        """
+        Nx, Ny, _ = win.da.getSizes()
+        lx, ly, _ = win.da.getOwnershipRanges()
+        self.da2D = PETSc.DMDA().create(sizes=[Nx, Ny],
+                                        proc_sizes=win.da.getProcSizes()[:2],
+                                        ownership_ranges=(lx, ly),
+                                        stencil_width=1, stencil_type='star')
+        # create the operator
+        self.L = self.da2D.createMat()
+        self._set_L_curv_2D(self.L, win)
+        #
+        if self._verbose>0:
+            print('2D operator L declared and filled')
+
+        # points where the rhs is 0: masked points and lateral boundaries
+        (xs, xe), (ys, ye), _ = win.da.getRanges()
+        D = win.grid.get_local_D()
+        i = np.arange(xs, xe)[:,None]
+        j = np.arange(ys, ye)[None,:]
+        self._zero = ( (D[xs:xe, ys:ye, win.grid._k_mask]==0.)
+                      | (i<=win.grid.istart) | (j<=win.grid.jstart)
+                      | (i>=win.grid.iend) | (j>=win.grid.jend) )
+
+        self._set_interior(win)
+
+        # levels solved, PSI=0 above and below
+        self._levels = range(max(win.grid.kdown, 0), min(win.grid.kup, win.grid.Nz-1)+1)
+        # dense matrices of right hand sides and solutions, one column per level
+        x = self.da2D.createGlobalVec()
+        size = (x.getSizes(), (PETSc.DECIDE, len(self._levels)))
+        self._B = PETSc.Mat().createDense(size, comm=x.getComm())
+        self._B.setUp()
+        self._X = self._B.duplicate()
+        x.destroy()
+
+        # create solver
+        self.ksp = PETSc.KSP()
+        self.ksp.create(PETSc.COMM_WORLD)
+        self.ksp.setOperators(self.L)
+        self.ksp.setType('gmres')
+        self.ksp.setInitialGuessNonzero(False)
+        self.ksp.setTolerances(rtol=1e-7)
+        self.ksp.setTolerances(max_it=1000)
+        #
+        for opt in sys.argv[1:]:
+            PETSc.Options().setValue(opt, None)
+        self.ksp.setFromOptions()
+        # the preconditioner is built once for all levels and solves
+        self.ksp.setUp()
+
+        if self._verbose>0:
+            print('PV inversion is set up (%i decoupled levels)' %len(self._levels))
+
     def solve(self, win):
         """ Compute the PV inversion
         """
+        if self.decoupled:
+            self._solve_2D(win)
+            return
         # copy Q into RHS
         win.Q.copy(self._RHS)
         # fix boundaries
@@ -223,6 +349,63 @@ class wininversion():
 
         
 
+    def _solve_2D(self, win):
+        """ Solve all levels with the 2D operator
+        """
+        q = win.da.getVecArray(win.Q)[:]
+        xm, ym = self._zero.shape
+        # levels are stored in columns, in the natural ordering of the 2D tiles
+        B = self._B.getDenseArray(readonly=False)
+        for n, k in enumerate(self._levels):
+            B[:,n] = np.where(self._zero, 0., q[:,:,k]).ravel(order='F')
+        self.ksp.matSolve(self._B, self._X)
+        #
+        X = self._X.getDenseArray()
+        psi = win.da.getVecArray(win.PSI)
+        psi[:] = 0.
+        for n, k in enumerate(self._levels):
+            psi[:,:,k] = X[:,n].reshape((xm, ym), order='F')
+
+        if self._verbose>1:
+            print('Inversion done (%i iterations)' %self.ksp.getIterationNumber())
+
+    def set_K(self, win, reuse_pc=False):
+        """ Shift the diagonal of the operator from the previous K to win.K, the laplacian is
+        not rebuilt. The preconditioner is rebuilt at the next solve (with the same nonzero
+        pattern, symbolic factorizations are reused) unless reuse_pc is True
+        """
+        if win._K2 != self._K2:
+            shift = self._I.copy()
+            shift.scale(self._K2-win._K2)
+            self.L.setDiagonal(shift, addv=PETSc.InsertMode.ADD_VALUES)
+            shift.destroy()
+            self._K2 = win._K2
+        self.ksp.getPC().setReusePreconditioner(reuse_pc)
+
+    def _set_interior(self, win):
+        """ Flag rows of the operator holding -K2 on the diagonal (interior points) and store
+        the current K2
+        """
+        self._K2 = win._K2
+        if self.decoupled:
+            self._I = self.da2D.createGlobalVec()
+            self.da2D.getVecArray(self._I)[:] = np.where(self._zero, 0., 1.)
+            return
+        (xs, xe), (ys, ye), (zs, ze) = win.da.getRanges()
+        i = np.arange(xs, xe)[:,None,None]
+        j = np.arange(ys, ye)[None,:,None]
+        k = np.arange(zs, ze)[None,None,:]
+        lateral = ( (i<=win.grid.istart) | (j<=win.grid.jstart)
+                   | (i>=win.grid.iend) | (j>=win.grid.jend) )
+        if not win.mask3D:
+            D = win.grid.get_local_D()
+            land = (D[xs:xe, ys:ye, win.grid._k_mask]==0.)[:,:,None]
+        else:
+            land = win.da.getVecArray(win.grid.mask3D)[:]==0.
+        levels = (k<win.grid.kdown) | (k>win.grid.kup)
+        self._I = win.da.createGlobalVec()
+        win.da.getVecArray(self._I)[:] = np.where(land | lateral | levels, 0., 1.)
+
     def set_rhs_bdy(self, win):
         """
         Set South/North, East/West, Bottom/Top boundary conditions
@@ -303,7 +486,7 @@ class wininversion():
         rhs = win.da.getVecArray(self._RHS)
         #
         if not win.mask3D:
-            mask = win.da.getVecArray(win.grid.D)
+            mask = win.grid.da2D.getVecArray(win.grid.D)
             kmask = win.grid._k_mask
         else:
             mask = win.da.getVecArray(win.grid.mask3D)
@@ -346,9 +529,7 @@ class wininversion():
         #
         mx, my, mz = win.da.getSizes()
         #
-        local_D  = win.da.createLocalVec()
-        win.da.globalToLocal(win.grid.D, local_D)
-        D = win.da.getVecArray(local_D)
+        D = win.grid.get_local_D()
         if not win.mask3D:
             #mask = win.da.getVecArray(win.grid.D)
             kmask = win.grid._k_mask
@@ -420,6 +601,40 @@ class wininversion():
                    
         L.assemble()
         return
+
+    def _set_L_curv_2D(self, L, win):
+        """ Builds the 2D laplacian operator of one level, see _set_L_curv
+        """
+        grid = win.grid
+        op = stencil_operator(self.da2D)
+        D = op.get_metric(grid)
+        dxu, dyu = D(grid._k_dxu), D(grid._k_dyu)
+        dxv, dyv = D(grid._k_dxv), D(grid._k_dyv)
+        dxt, dyt = D(grid._k_dxt), D(grid._k_dyt)
+        dyu_w, dxu_w = D(grid._k_dyu, di=-1), D(grid._k_dxu, di=-1)
+        dxv_s, dyv_s = D(grid._k_dxv, dj=-1), D(grid._k_dyv, dj=-1)
+        i, j = op.i, op.j
+        #
+        # masked points (land=0) and lateral points outside the domain: L=1
+        outside = ( (D(grid._k_mask)==0.) | (i<=grid.istart) | (j<=grid.jstart)
+                   | (i>=grid.iend) | (j>=grid.jend) )
+        op.add(outside, (0,0,0), 1.)
+        #
+        # interior points: pv is prescribed
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for index, value in [
+                    ((0,-1,0), 1./dxt/dyt * dxv_s/dyv_s),
+                    ((-1,0,0), 1./dxt/dyt * dyu_w/dxu_w),
+                    ((0,0,0), -win._K2 -1./dxt/dyt*(
+                                     dyu/dxu
+                                    +dyu_w/dxu_w
+                                    +dxv/dyv
+                                    +dxv_s/dyv_s)),
+                    ((1,0,0), 1./dxt/dyt * dyu/dxu),
+                    ((0,1,0), 1./dxt/dyt * dxv/dyv)]:
+                op.add(~outside, index, value)
+        #
+        op.set_values(L)
     
     
 